@@ -0,0 +1,136 @@
+"""
+Synthetic data for the benchmarks.
+
+Run with ``pytest benchmarks`` (requires pytest-benchmark). Results are
+saved in .benchmarks/ with the commit id; compare runs with
+``pytest-benchmark compare``. Stack sizes are selected with
+``--stack-sizes`` (default: small), e.g. ``--stack-sizes small medium large``.
+"""
+import json
+
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from napari_flofish import _cache
+from napari_flofish._cache import StageCache
+
+STACK_SIZES = {
+    'small': (20, 512, 512),
+    'medium': (40, 1024, 1024),
+    'large': (60, 2048, 2048),
+}
+
+# spots per million voxels
+SPOT_DENSITIES = {
+    'sparse': 20,
+    'dense': 200,
+}
+
+SCALE = (200, 65, 65)
+SPOT_RADIUS = (800, 120, 120)
+
+
+def pytest_addoption(parser):
+    parser.addoption("--stack-sizes", nargs="+", default=["small"], choices=list(STACK_SIZES),
+                     help="synthetic stack sizes to benchmark")
+
+
+def pytest_configure(config):
+    # keep every run, so that regressions across commits show up in
+    # pytest-benchmark compare
+    if getattr(config.option, 'benchmark_save', True) is None and not config.option.benchmark_autosave:
+        from pytest_benchmark.utils import get_tag
+        config.option.benchmark_autosave = get_tag()
+
+
+def pytest_generate_tests(metafunc):
+    if "stack_size" in metafunc.fixturenames:
+        metafunc.parametrize("stack_size", metafunc.config.getoption("stack_sizes"), scope="session")
+    if "density" in metafunc.fixturenames:
+        metafunc.parametrize("density", list(SPOT_DENSITIES), scope="session")
+
+
+@pytest.fixture(autouse=True, scope="session")
+def no_stage_cache():
+    # benchmark the computations, not the stage cache
+    previous = _cache._cache
+    _cache._cache = StageCache(None, memory_bytes=0)
+    yield
+    _cache._cache = previous
+
+
+def make_spots(nb_spots, shape=(40, 1024, 1024), seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([ rng.integers(0, n, nb_spots) for n in shape ]).astype(np.int64)
+
+
+def make_cell_masks(shape=(1024, 1024), cell_size=32):
+    # a grid of square cells separated by one pixel of background
+    y, x = np.indices(shape)
+    labels = (y // cell_size) * (shape[1] // cell_size) + x // cell_size + 1
+    labels[(y % cell_size == 0) | (x % cell_size == 0)] = 0
+    return labels.astype(np.uint16)
+
+
+def make_stack(shape, density, seed=0):
+    """Return a uint16 smFISH-like stack and its spot coordinates.
+
+    Diffraction-limited spots (gaussian, sigma about the spot radius in
+    pixels) on a Poisson background.
+    """
+    rng = np.random.default_rng(seed)
+    nb_spots = int(density * np.prod(shape) / 1e6)
+    spots = make_spots(nb_spots, shape, seed)
+
+    signal = np.zeros(shape, dtype=np.float32)
+    np.add.at(signal, tuple(spots.T), rng.uniform(2000, 6000, nb_spots).astype(np.float32))
+    sigma = [ r / s for r, s in zip(SPOT_RADIUS, SCALE) ]
+    ndi.gaussian_filter(signal, sigma=sigma, output=signal)
+
+    rna = rng.poisson(100, shape).astype(np.float32)
+    rna += signal
+    return np.clip(rna, 0, 65535).astype(np.uint16), spots
+
+
+@pytest.fixture(scope="session")
+def cell_masks():
+    return make_cell_masks()
+
+
+@pytest.fixture(scope="session")
+def stack(stack_size, density):
+    """(rna, spots) for a size and density, generated once per session."""
+    return make_stack(STACK_SIZES[stack_size], SPOT_DENSITIES[density])
+
+
+@pytest.fixture(scope="session")
+def stack_cell_masks(stack_size):
+    return make_cell_masks(STACK_SIZES[stack_size][1:])
+
+
+@pytest.fixture(scope="session")
+def smfish_json(stack, stack_cell_masks, tmp_path_factory):
+    """img.json and layer files of one field of view, as read by read_smfish_json."""
+    from bigfish import stack as bfstack
+    from skimage import io
+
+    rna, spots = stack
+    directory = tmp_path_factory.mktemp("fov")
+    io.imsave(directory / 'DIC.tif', rna.max(axis=0), check_contrast=False)
+    io.imsave(directory / 'DIC_masks_pp.tif', stack_cell_masks, check_contrast=False)
+    io.imsave(directory / 'rpoD.tif', rna, check_contrast=False)
+    np.save(directory / 'rpoD_filtered.npy', bfstack.remove_background_gaussian(rna, (0.75, 2.3, 2.3)))
+    spot_table = np.column_stack([ spots, rna[tuple(spots.T)], rna[tuple(spots.T)],
+                                   stack_cell_masks[tuple(spots[:, 1:].T)] ]).astype(np.float64)
+    np.save(directory / 'rpoD_spots.npy', spot_table)
+    np.save(directory / 'rpoD_decomposed_spots.npy', spots.astype(np.float64))
+
+    img = {
+        'parameters': { 'scale': SCALE, 'spot_radius': SPOT_RADIUS },
+        'results': { 'rpoD': { 'colormap': 'magenta', 'threshold': 50 } },
+    }
+    with open(directory / 'img.json', 'w') as f:
+        json.dump(img, f)
+
+    return str(directory / 'img.json')
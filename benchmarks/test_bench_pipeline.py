@@ -0,0 +1,73 @@
+"""
+Benchmarks of the widget stages, run synchronously on synthetic stacks.
+"""
+import pytest
+from bigfish import detection
+from bigfish import stack as bfstack
+from conftest import SCALE, SPOT_RADIUS
+
+from napari_flofish._spots import ThresholdIndex
+from napari_flofish._widget import (
+    background_filtering,
+    get_labels,
+    run_stages,
+    spot_decomposition,
+    spot_detection,
+    threshold_spots,
+)
+
+THRESHOLD = 50
+
+
+@pytest.fixture(scope="session")
+def filtered(stack):
+    rna, _ = stack
+    return bfstack.remove_background_gaussian(rna, (0.75, 2.3, 2.3))
+
+
+@pytest.fixture(scope="session")
+def detected(filtered):
+    metadata = { 'channel': 'rpoD' }
+    layers = run_stages(spot_detection, filtered, metadata, THRESHOLD, *SCALE[:2], *SPOT_RADIUS[:2])
+    return layers, metadata
+
+
+@pytest.mark.parametrize("lean, z_batch", [(False, 0), (True, 0), (True, 8)])
+def test_background_filtering(benchmark, stack, lean, z_batch):
+    rna, _ = stack
+    benchmark.pedantic(run_stages, args=(background_filtering, rna, 'rpoD', 0.75, 2.3, lean, z_batch),
+                       rounds=3, iterations=1)
+
+
+@pytest.mark.parametrize("tile_size", [0, 512])
+def test_spot_detection(benchmark, filtered, stack_cell_masks, tile_size):
+    benchmark.pedantic(run_stages, args=(spot_detection, filtered, { 'channel': 'rpoD' }, THRESHOLD,
+                                         *SCALE[:2], *SPOT_RADIUS[:2], stack_cell_masks, tile_size),
+                       rounds=3, iterations=1)
+
+
+def test_threshold_index(benchmark, filtered):
+    spot_radius_px = detection.get_object_radius_pixel(voxel_size_nm=SCALE, object_radius_nm=SPOT_RADIUS, ndim=3)
+    rna_log = bfstack.log_filter(filtered, sigma=spot_radius_px)
+    mask = detection.local_maximum_detection(rna_log, min_distance=spot_radius_px)
+    benchmark.pedantic(ThresholdIndex.from_local_maxima, args=(rna_log, mask), rounds=3, iterations=1)
+
+
+@pytest.mark.parametrize("threshold", [THRESHOLD, 4 * THRESHOLD])
+def test_threshold_spots(benchmark, detected, stack_cell_masks, threshold):
+    layers, _ = detected
+    index = layers[0][1]['metadata']['threshold_index']
+    benchmark(threshold_spots, index, threshold, stack_cell_masks)
+
+
+def test_get_labels(benchmark, detected, stack_cell_masks):
+    layers, _ = detected
+    spots = layers[1][0]
+    benchmark(get_labels, stack_cell_masks, spots)
+
+
+def test_spot_decomposition(benchmark, stack, detected):
+    rna, _ = stack
+    layers, metadata = detected
+    spots = layers[1][0]
+    benchmark.pedantic(run_stages, args=(spot_decomposition, rna, spots, dict(metadata)), rounds=3, iterations=1)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from napari_flofish._reader import read_layer, read_smfish_json
+
+
+def load(path, lazy):
+    layers = read_smfish_json(path, lazy=lazy)
+    # what napari needs to show the first z-plane
+    for data, _, _ in layers:
+        np.asarray(data[0])
+    return layers
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_read_smfish_json(benchmark, smfish_json, lazy):
+    benchmark.pedantic(load, args=(smfish_json, lazy), rounds=3, iterations=1)
+
+
+@pytest.fixture(scope="session")
+def spot_files(tmp_path_factory):
+    """A million spots as a flofish .npy table and as a spot table."""
+    from napari_flofish._spot_table import write_spot_table
+
+    rng = np.random.default_rng(0)
+    nb_spots = 10**6
+    coordinates = rng.integers(0, (40, 2048, 2048), (nb_spots, 3))
+    features = {
+        'intensity': rng.random(nb_spots).astype(np.float32) * 1000,
+        'filtered_intensity': rng.random(nb_spots).astype(np.float32) * 1000,
+        'label': rng.integers(0, 300, nb_spots),
+    }
+    directory = tmp_path_factory.mktemp("spots")
+    np.save(directory / 'npy_spots.npy', np.column_stack([ coordinates, *features.values() ]).astype(np.float64))
+    write_spot_table(directory / 'table_spots', coordinates, features)
+    return directory
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+@pytest.mark.parametrize("spot_format", ['npy', 'table'])
+def test_read_spots(benchmark, spot_files, spot_format, lazy):
+    def read():
+        entry = { 'file': f'{spot_format}_spots.npy', 'layer_type': 'spots', 'add_kwargs': {} }
+        return read_layer(spot_files, entry, lazy)
+
+    benchmark.pedantic(read, rounds=5, iterations=1)
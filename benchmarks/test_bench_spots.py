@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from conftest import make_spots
+
+from napari_flofish._spots import cell_labels, spot_features
+
+
+def report_throughput(benchmark, nb_spots):
+    benchmark.extra_info['spots_per_second'] = nb_spots / benchmark.stats.stats.mean
+
+
+@pytest.mark.parametrize("nb_spots", [10_000, 100_000, 1_000_000])
+def test_cell_labels(benchmark, cell_masks, nb_spots):
+    spots = make_spots(nb_spots)
+    benchmark(cell_labels, cell_masks, spots)
+    report_throughput(benchmark, nb_spots)
+
+
+@pytest.mark.parametrize("nb_spots", [10_000, 100_000, 1_000_000])
+def test_spot_features(benchmark, cell_masks, nb_spots):
+    spots = make_spots(nb_spots)
+    log_intensities = np.random.default_rng(0).random(nb_spots)
+    benchmark(spot_features, spots, log_intensities, cell_masks)
+    report_throughput(benchmark, nb_spots)
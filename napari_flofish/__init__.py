@@ -1,23 +1,38 @@
 __version__ = "0.0.4"
 
-from ._reader import napari_get_reader
-from ._sample_data import make_sample_data, smRNAfish_Ecoli_rpoD_rnlAB_hipBA, get_smRNAfish_Ecoli_rpoD_rnlAB_hipBA
-from ._widget import (
-    read_in_vsi_widget,
-    background_filtering_magic_widget,
-    spot_detection_magic_widget,
-    spot_thresholding_magic_widget,
-    spot_decomposition_magic_widget,
-)
+import importlib
 
-__all__ = (
-    "napari_get_reader",
-    "read_in_vsi_widget",
-    "background_filtering_magic_widget",
-    "spot_detection_magic_widget",
-    "spot_thresholding_magic_widget",
-    "spot_decomposition_magic_widget",
-    "make_sample_data",
-    "smRNAfish_Ecoli_rpoD_rnlAB_hipBA",
-    "get_smRNAfish_Ecoli_rpoD_rnlAB_hipBA",
-)
+# module of each public name. Modules are imported on first access (PEP 562),
+# so that napari discovering the plugin does not import flofish, bigfish,
+# pandas or skimage before a reader, widget or sample data command is used.
+_exports = {
+    "napari_get_reader": "._reader",
+    "read_in_vsi_widget": "._widget",
+    "background_filtering_magic_widget": "._widget",
+    "spot_detection_magic_widget": "._widget",
+    "multi_channel_spot_detection_magic_widget": "._widget",
+    "spot_thresholding_magic_widget": "._widget",
+    "threshold_sweep_magic_widget": "._widget",
+    "spot_decomposition_magic_widget": "._widget",
+    "spot_statistics_magic_widget": "._widget",
+    "spot_display_magic_widget": "._widget",
+    "roi_spot_detection_magic_widget": "._widget",
+    "make_sample_data": "._sample_data",
+    "smRNAfish_Ecoli_rpoD_rnlAB_hipBA": "._sample_data",
+    "get_smRNAfish_Ecoli_rpoD_rnlAB_hipBA": "._sample_data",
+}
+
+__all__ = tuple(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,276 @@
+"""
+Run the widget pipeline headless over many images.
+
+For every image: read the VSI and DIC files, filter the background of each
+channel, detect and decompose spots, and write the results in the layout
+read by ``read_smfish_json`` (one directory per image with an img.json).
+Images are processed in parallel, one image per worker process.
+
+Usage::
+
+    napari-flofish-batch config.json --input-dir data/ --output output/
+    napari-flofish-batch config.json --images images.json --output output/ --workers 8
+
+where images.json is a list of ``{"vsi_file": ..., "cell_file": ...}``
+records (optionally with their own "cfg_file", and a "masks_file" of cell
+labels with which spots are assigned to cells).
+"""
+import argparse
+import json
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from skimage import io
+
+from . import _cache, _profiling
+from ._spot_table import write_spot_table
+from ._spots import cell_labels, sample_at, threshold_sweep
+from ._widget import (
+    background_filtering,
+    read_in_vsi,
+    run_stages,
+    spot_decomposition,
+    spot_detection,
+)
+
+
+def find_images(input_dir, cfg_file):
+    """Pair every ``<prefix>_DIC_<n>.tif`` with the ``<prefix>_*_<n>.vsi`` file.
+
+    Parameters
+    ----------
+    input_dir : str or Path
+        Directory containing the VSI and DIC files.
+    cfg_file : str or Path
+        Experiment configuration file used for all images.
+
+    Returns
+    -------
+    images : list of dict
+        One {"cfg_file", "vsi_file", "cell_file"} record per image.
+    """
+    input_dir = Path(input_dir)
+    vsi_files = sorted(input_dir.glob('*.vsi'))
+    images = []
+    for cell_file in sorted(input_dir.glob('*_DIC_*.tif')):
+        prefix, number = re.fullmatch(r'(.*)_DIC_(.*)', cell_file.stem).groups()
+        matches = [ f for f in vsi_files if f.stem.startswith(f'{prefix}_') and f.stem.endswith(f'_{number}') ]
+        if len(matches) == 1:
+            images.append({ 'cfg_file': str(cfg_file), 'vsi_file': str(matches[0]), 'cell_file': str(cell_file) })
+        else:
+            print(f'{cell_file.name}: found {len(matches)} matching VSI files, skipping')
+
+    return images
+
+
+def image_name(cell_file):
+    """Name of the output directory of an image: the DIC file name without "_DIC"."""
+    return Path(cell_file).stem.replace('_DIC', '')
+
+
+def process_image(image, output_dir, params):
+    """Run the full pipeline on one image and write its results.
+
+    Parameters
+    ----------
+    image : dict
+        {"cfg_file", "vsi_file", "cell_file"} record, with an optional
+        "masks_file" of cell labels. Without it, the spot tables have no
+        label column.
+    output_dir : str or Path
+        Parent directory of the image's output directory.
+    params : dict
+        Pipeline parameters, see ``main``.
+
+    Returns
+    -------
+    name : str
+        Name of the image.
+    timings : dict
+        Wall time in seconds of each stage, and in total.
+    """
+    if params.get('profile'):
+        # per-stage measurements of every image, one JSON line per stage run
+        _profiling.enable(params['profile'])
+
+    name = image_name(image['cell_file'])
+    out = Path(output_dir) / name
+    out.mkdir(parents=True, exist_ok=True)
+
+    timings = {}
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0) + now - start
+        start = now
+
+    layers = run_stages(read_in_vsi, image['cfg_file'], image['vsi_file'], image['cell_file'], use_cache=False)
+    masks = io.imread(image['masks_file']) if image.get('masks_file') else None
+    lap('read')
+
+    scale = (params['scale_z'], params['scale_yx'], params['scale_yx'])
+    spot_radius = (params['spot_radius_z'], params['spot_radius_yx'], params['spot_radius_yx'])
+    detected = {}
+    for data, add_kwargs, _ in layers:
+        ch = add_kwargs['name']
+        io.imsave(out / f'{ch}.tif', data, check_contrast=False)
+        lap('write')
+        if ch == 'DIC' or ch in params['skip_channels']:
+            continue
+
+        filtered, _, _ = run_stages(background_filtering, data, ch, params['sigma_z'], params['sigma_yx'],
+                                    lean=params['lean_filtering'], z_batch=params['z_batch'])
+        lap('background filtering')
+        # read back memory-mapped once all the channels are detected
+        np.save(out / f'{ch}_filtered.npy', filtered)
+        lap('write')
+
+        maxima, spots = run_stages(spot_detection, filtered, { 'channel': ch }, params['threshold'],
+                                   params['scale_z'], params['scale_yx'], params['spot_radius_z'],
+                                   params['spot_radius_yx'], tile_size=params['tile_size'])[-2:]
+        detected[ch] = (data, add_kwargs, spots[0], maxima[1]['metadata']['threshold_index'])
+        del filtered
+        lap('spot detection')
+
+    # every channel's spot count curve in one sweep, thresholded at its
+    # elbow when it has one
+    thresholds = dict.fromkeys(detected, params['threshold'])
+    if params.get('auto_threshold') and detected:
+        _, elbows = threshold_sweep({ ch: index for ch, (_, _, _, index) in detected.items() })
+        thresholds.update({ ch: elbow for ch, elbow in elbows.items() if elbow is not None })
+        lap('spot detection')
+
+    results = {}
+    for ch, (data, add_kwargs, spots, index) in detected.items():
+        threshold = thresholds[ch]
+        if threshold != params['threshold']:
+            spots, _ = index.threshold(threshold)
+
+        # images are already processed in parallel: decompose serially
+        metadata = { 'channel': ch, 'threshold': threshold, 'scale': scale, 'spot_radius': spot_radius }
+        decomposed = run_stages(spot_decomposition, data, spots, metadata, max_workers=1)
+        decomposed_spots = decomposed[1][0]
+        lap('spot decomposition')
+
+        # spot tables, read by read_smfish_json in place of {ch}_spots.npy
+        filtered = np.load(out / f'{ch}_filtered.npy', mmap_mode='r')
+        columns = {
+            'intensity': sample_at(data, spots, dtype=np.float32),
+            'filtered_intensity': sample_at(filtered, spots, dtype=np.float32),
+        }
+        decomposed_columns = { 'intensity': sample_at(data, decomposed_spots, dtype=np.float32) }
+        if masks is not None:
+            # the reader derives in_cell from the labels
+            columns['label'], _ = cell_labels(masks, spots, dtype=np.int32)
+            decomposed_columns['label'], _ = cell_labels(masks, decomposed_spots, dtype=np.int32)
+        write_spot_table(out / f'{ch}_spots', spots, columns)
+        write_spot_table(out / f'{ch}_decomposed_spots', decomposed_spots, decomposed_columns)
+        lap('write')
+
+        results[ch] = {
+            'colormap': add_kwargs['colormap'],
+            'threshold': threshold,
+            'auto_threshold': bool(params.get('auto_threshold')),
+            'nb_spots': len(spots),
+            'nb_decomposed_spots': len(decomposed_spots),
+        }
+
+    timings['total'] = sum(timings.values())
+    img = {
+        'image': image,
+        'parameters': { 'scale': scale, 'spot_radius': spot_radius,
+                        'sigma': (params['sigma_z'], params['sigma_yx'], params['sigma_yx']) },
+        'results': results,
+        'timings': timings,
+    }
+    with open(out / 'img.json', 'w') as f:
+        json.dump(img, f, indent=2, default=str)
+
+    return name, timings
+
+
+def disable_cache():
+    """Disable the stage cache of a batch worker.
+
+    Every image is processed once: its stage inputs are not worth hashing,
+    nor its results worth writing to the disk cache.
+    """
+    _cache._cache = _cache.StageCache(directory=None, memory_bytes=0)
+
+
+def run_batch(images, output_dir, params, max_workers=None):
+    """Process images in a process pool, one image per worker, without the stage cache.
+
+    Returns
+    -------
+    timings : dict
+        Per-stage timings of each image, by image name.
+    """
+    timings = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=disable_cache) as executor:
+        futures = { executor.submit(process_image, image, output_dir, params): image for image in images }
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                name, image_timings = future.result()
+            except Exception as e:  # noqa: BLE001 - one bad image must not stop the batch
+                print(f'{image["vsi_file"]}: failed: {e!r}')
+                continue
+            timings[name] = image_timings
+            stages = ', '.join(f'{k} {v:.1f}s' for k, v in image_timings.items() if k != 'total')
+            print(f'{name}: {image_timings["total"]:.1f}s ({stages})')
+
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='napari-flofish-batch',
+                                     description='Detect and decompose spots in many images.')
+    parser.add_argument('cfg_file', help='experiment configuration file')
+    images = parser.add_mutually_exclusive_group(required=True)
+    images.add_argument('--input-dir', help='directory with VSI and DIC files')
+    images.add_argument('--images',
+                        help='JSON list of {"vsi_file", "cell_file"[, "cfg_file"][, "masks_file"]} records')
+    parser.add_argument('--output', required=True, help='output directory, one sub-directory per image')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--sigma-z', type=float, default=0.75)
+    parser.add_argument('--sigma-yx', type=float, default=2.3)
+    parser.add_argument('--lean-filtering', action='store_true', help='filter the background in float32, with less memory')
+    parser.add_argument('--z-batch', type=int, default=0, help='z-planes filtered at a time with --lean-filtering (default: all)')
+    parser.add_argument('--threshold', type=int, default=50)
+    parser.add_argument('--auto-threshold', action='store_true',
+                        help="threshold each channel at the elbow of its spot count curve, or --threshold if it has none")
+    parser.add_argument('--scale-z', type=float, default=200)
+    parser.add_argument('--scale-yx', type=float, default=65)
+    parser.add_argument('--spot-radius-z', type=float, default=800)
+    parser.add_argument('--spot-radius-yx', type=float, default=120)
+    parser.add_argument('--tile-size', type=int, default=0, help='YX tile size for spot detection (default: no tiling)')
+    parser.add_argument('--profile', metavar='LOG', help='append per-stage wall/CPU time and peak memory to a JSON lines file')
+    parser.add_argument('--skip-channels', nargs='*', default=['DAPI'], help='channels without spot detection')
+    args = parser.parse_args(argv)
+
+    if args.input_dir is not None:
+        image_list = find_images(args.input_dir, args.cfg_file)
+    else:
+        with open(args.images) as f:
+            image_list = [ { 'cfg_file': args.cfg_file, **image } for image in json.load(f) ]
+
+    params = { k: v for k, v in vars(args).items()
+               if k not in ('cfg_file', 'input_dir', 'images', 'output', 'workers') }
+
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    timings = run_batch(image_list, args.output, params, max_workers=args.workers)
+    print(f'{len(timings)}/{len(image_list)} images in {time.perf_counter() - start:.1f}s')
+
+    with open(Path(args.output) / 'timings.json', 'w') as f:
+        json.dump(timings, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
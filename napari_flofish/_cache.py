@@ -0,0 +1,258 @@
+"""
+Content-addressed cache for the results of pipeline stages.
+
+A stage result is keyed by a hash of the stage name, the content of its
+input arrays and its other parameters. Results are kept in a small
+in-memory LRU tier, optionally in front of a size-bounded directory on
+disk, where arrays are stored as .npy files and read back memory-mapped, so
+a disk hit costs no more than opening the files.
+
+The disk tier is off unless ``NAPARI_FLOFISH_CACHE_DIR`` is set. Its size
+is set with ``NAPARI_FLOFISH_CACHE_SIZE`` (in bytes, default 4 GiB), and
+that of the memory tier with ``NAPARI_FLOFISH_CACHE_MEMORY_SIZE`` (default
+1 GiB, 0 disables it).
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        # memory-mapped arrays do not take memory
+        return 0 if isinstance(value, np.memmap) or isinstance(value.base, np.memmap) else value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    # other objects holding arrays, e.g. a ThresholdIndex, tell their size
+    return getattr(value, 'nbytes', 0)
+
+
+def _read_only(array):
+    # neither the array nor the arrays it is a view of can be written to
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return True
+
+
+class StageCache:
+    """Two-tier (memory, disk) LRU cache of stage results.
+
+    Parameters
+    ----------
+    directory : str or Path or None
+        Directory of the disk tier. None disables it.
+    max_bytes : int
+        Size of the disk tier. Least recently used entries are evicted
+        once it is exceeded.
+    memory_bytes : int
+        Size of the memory tier.
+    """
+
+    def __init__(self, directory=None, max_bytes=4 * 2**30, memory_bytes=2**30):
+        self.directory = None if directory is None or max_bytes == 0 else Path(directory)
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._digests = {}
+        self._lock = threading.RLock()
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self):
+        """Whether results are kept in either tier."""
+        return self.directory is not None or self.memory_bytes > 0
+
+    def digest(self, array):
+        """Hash of the content, shape and dtype of an array.
+
+        The digest of a read-only array is remembered for as long as the
+        array lives. Writeable ones, e.g. layer data edited in napari, are
+        hashed again on every call.
+        """
+        with self._lock:
+            known = self._digests.get(id(array))
+            if known is not None and known[0]() is array:
+                return known[1]
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((array.shape, array.dtype.str)).encode())
+        data = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        for start in range(0, data.size, 2**26):
+            h.update(data[start:start + 2**26])
+        digest = h.hexdigest()
+
+        if not _read_only(array):
+            return digest
+        try:
+            ref = weakref.ref(array, partial(self._forget, id(array)))
+        except TypeError:
+            return digest
+        with self._lock:
+            self._digests[id(array)] = (ref, digest)
+        return digest
+
+    def _forget(self, key, ref):
+        # called when an array whose digest is remembered is garbage
+        # collected; its id may already be reused by a newer array
+        with self._lock:
+            if self._digests.get(key, (None,))[0] is ref:
+                del self._digests[key]
+
+    def key(self, stage, *args):
+        """Cache key of ``stage`` run on ``args``; arrays are hashed by content.
+
+        A disabled cache hashes nothing and returns None, which ``get`` and
+        ``put`` ignore.
+        """
+        if not self.enabled:
+            return None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(stage.encode())
+        for arg in args:
+            h.update(self.digest(arg).encode() if isinstance(arg, np.ndarray) else repr(arg).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the cached value of ``key``, or None."""
+        if key is None:
+            return None
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+
+        value = self._load(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """Cache ``value``, a tuple of arrays and picklable objects."""
+        if key is None:
+            return
+        self._remember(key, value)
+        self._store(key, value)
+
+    def cached(self, stage, func, *args, **kwargs):
+        """Return ``func(*args, **kwargs)``, computed only if not cached yet."""
+        key = self.key(stage, *args, *sorted(kwargs.items()))
+        value = self.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            if self.directory is not None:
+                for entry in self.directory.iterdir():
+                    shutil.rmtree(entry, ignore_errors=True)
+
+    def _remember(self, key, value):
+        # entries are (value, size); the size of the tier is kept as a running
+        # total rather than summed on each insert
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_size -= previous[1]
+            size = _nbytes(value)
+            if size > self.memory_bytes:
+                # would flush the whole tier: left to the disk tier
+                return
+            self._memory[key] = (value, size)
+            self._memory_size += size
+            while self._memory and self._memory_size > self.memory_bytes:
+                _, (_, size) = self._memory.popitem(last=False)
+                self._memory_size -= size
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        entry = self.directory / key
+        try:
+            with open(entry / 'value.pkl', 'rb') as f:
+                items, is_tuple = pickle.load(f)
+            # copy-on-write: the arrays can be written to, e.g. as layer data,
+            # without changing the files
+            value = tuple(np.load(entry / f'{i}.npy', mmap_mode='c') if item is None else item
+                          for i, item in enumerate(items))
+            # the modification time orders entries for eviction
+            os.utime(entry)
+        except OSError:
+            # missing, or evicted by another process sharing the directory
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError):
+            # truncated, or written by an incompatible version
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        return value if is_tuple else value[0]
+
+    def _store(self, key, value):
+        if self.directory is None or (self.directory / key).is_dir():
+            return
+
+        is_tuple = isinstance(value, tuple)
+        items = value if is_tuple else (value,)
+        tmp = Path(tempfile.mkdtemp(dir=self.directory, prefix='.tmp-'))
+        try:
+            for i, item in enumerate(items):
+                if isinstance(item, np.ndarray):
+                    np.save(tmp / f'{i}.npy', item)
+            with open(tmp / 'value.pkl', 'wb') as f:
+                pickle.dump(([ None if isinstance(item, np.ndarray) else item for item in items ], is_tuple), f)
+            os.replace(tmp, self.directory / key)
+        except OSError:
+            # another process stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in self.directory.iterdir():
+            if entry.name.startswith('.tmp-'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                # removed by another process sharing the directory
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+_cache = None
+
+
+def get_cache():
+    """Return the cache used by the widgets, configured from the environment."""
+    global _cache
+    if _cache is None:
+        directory = os.environ.get('NAPARI_FLOFISH_CACHE_DIR')
+        _cache = StageCache(
+            directory=None if not directory else Path(directory) / 'stages',
+            max_bytes=int(os.environ.get('NAPARI_FLOFISH_CACHE_SIZE', 4 * 2**30)),
+            memory_bytes=int(os.environ.get('NAPARI_FLOFISH_CACHE_MEMORY_SIZE', 2**30)),
+        )
+    return _cache
@@ -0,0 +1,207 @@
+"""
+Dense region decomposition with the regions simulated in parallel.
+
+``decompose_dense`` follows ``bigfish.detection.decompose_dense`` step by
+step: the image is denoised, the reference spot is built and modelled once,
+and the dense regions are found on the whole image. Only the gaussian
+mixture simulation of each region, the slow part, is distributed over a
+process pool: each worker receives a chunk of regions as small crops of the
+denoised image. Chunks are merged in region order with bigfish's coordinate
+arithmetic, so the result is the same as the serial function's. Workers
+are spawned, not forked: the decomposition runs in a thread of napari's
+multithreaded Qt process, where forking can deadlock. The pool is kept
+between calls, spawning workers and importing bigfish in each being slow.
+
+This mirrors bigfish 0.6.2 and uses its private gaussian mixture functions:
+big-fish is pinned to that version in pyproject.toml.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+from bigfish import detection, stack
+from bigfish.detection.dense_decomposition import (
+    _gaussian_mixture_2d,
+    _gaussian_mixture_3d,
+)
+
+# below this number of regions, a process pool costs more than it saves
+MIN_PARALLEL_REGIONS = 64
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(max_workers):
+    # the pool of the previous call, unless its size differs
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._max_workers != max_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _as_tuple(value, ndim):
+    return tuple(value) if isinstance(value, (tuple, list)) else (value,) * ndim
+
+
+def _simulate_chunk(crops, voxel_size, sigma, amplitude, background, precomputed_gaussian):
+    # crops: (image crop, region with a bbox relative to the crop) pairs
+    ndim = len(voxel_size)
+    coords = []
+    for image, region in crops:
+        if ndim == 3:
+            _, _, coord_gaussian = _gaussian_mixture_3d(
+                image=image, region=region,
+                voxel_size_z=voxel_size[0], voxel_size_yx=voxel_size[-1],
+                sigma_z=sigma[0], sigma_yx=sigma[-1],
+                amplitude=amplitude, background=background,
+                precomputed_gaussian=precomputed_gaussian)
+        else:
+            _, _, coord_gaussian = _gaussian_mixture_2d(
+                image=image, region=region,
+                voxel_size_yx=voxel_size[-1], sigma_yx=sigma[-1],
+                amplitude=amplitude, background=background,
+                precomputed_gaussian=precomputed_gaussian)
+        coords.append(coord_gaussian)
+    return coords
+
+
+def _crop(image, region):
+    ndim = image.ndim
+    bbox = tuple(region.bbox)
+    box = tuple(slice(bbox[i], bbox[i + ndim]) for i in range(ndim))
+    relative = tuple([0] * ndim) + tuple(bbox[i + ndim] - bbox[i] for i in range(ndim))
+    return np.ascontiguousarray(image[box]), SimpleNamespace(bbox=relative)
+
+
+def simulate_gaussian_mixture(image, candidate_regions, voxel_size, sigma, amplitude, background,
+                              precomputed_gaussian, max_workers=None, chunk_size=None):
+    """Parallel ``bigfish.detection.simulate_gaussian_mixture``.
+
+    Parameters are those of the bigfish function, plus:
+
+    max_workers : int or None
+        Number of worker processes, by default the number of CPUs.
+    chunk_size : int or None
+        Number of regions sent to a worker at a time. By default the regions
+        are split in about four chunks per worker.
+
+    Returns
+    -------
+    spots_in_regions : np.ndarray, np.int64
+        Coordinate of the spots detected inside dense regions, with shape
+        (nb_spots, ndim + 1). The last column is the index of the region.
+    regions : np.ndarray, np.int64
+        Array with shape (nb_regions, ndim + 4), see bigfish.
+    """
+    ndim = image.ndim
+    max_workers = max_workers or os.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(candidate_regions) // (4 * max_workers)))
+
+    crops = [ _crop(image, region) for region in candidate_regions ]
+    chunks = [ crops[i:i + chunk_size] for i in range(0, len(crops), chunk_size) ]
+    executor = _get_pool(max_workers)
+    futures = [ executor.submit(_simulate_chunk, chunk, voxel_size, sigma, amplitude, background,
+                                precomputed_gaussian)
+                for chunk in chunks ]
+    coords_gaussian = [ coord for future in futures for coord in future.result() ]
+
+    # same arithmetic as bigfish, in the same region order
+    spots_in_regions = []
+    regions = []
+    for i_region, (region, coord_gaussian) in enumerate(zip(candidate_regions, coords_gaussian)):
+        origin = region.bbox[:ndim]
+        coord = np.array(coord_gaussian, dtype=np.float64)
+        coord[:, 0] = (coord[:, 0] / voxel_size[0]) + origin[0]
+        for axis in range(1, ndim):
+            coord[:, axis] = (coord[:, axis] / voxel_size[-1]) + origin[axis]
+        spots_in_region = np.zeros((coord.shape[0], ndim + 1), dtype=np.int64)
+        spots_in_region[:, :ndim] = coord
+        spots_in_region[:, ndim] = i_region
+        spots_in_regions.append(spots_in_region)
+        regions.append([*tuple(coord[0]), coord.shape[0], region.area, region.intensity_mean, i_region])
+
+    spots_in_regions = np.concatenate(spots_in_regions, axis=0).astype(np.int64)
+    regions = np.array(regions, dtype=np.int64)
+    return spots_in_regions, regions
+
+
+def decompose_dense(image, spots, voxel_size, spot_radius, kernel_size=None, alpha=0.5, beta=1, gamma=5,
+                    max_workers=None):
+    """``bigfish.detection.decompose_dense`` with dense regions simulated in parallel.
+
+    Parameters are those of the bigfish function, plus:
+
+    max_workers : int or None
+        Number of worker processes, by default the number of CPUs. With 1,
+        or with few dense regions, regions are simulated serially.
+
+    Returns
+    -------
+    spots, dense_regions, reference_spot : np.ndarray
+        Same as ``bigfish.detection.decompose_dense``.
+    """
+    if spots.size == 0:
+        return detection.decompose_dense(image, spots, voxel_size, spot_radius, kernel_size=kernel_size,
+                                         alpha=alpha, beta=beta, gamma=gamma)
+
+    ndim = image.ndim
+    dtype = spots.dtype
+    voxel_size = _as_tuple(voxel_size, ndim)
+    spot_radius = _as_tuple(spot_radius, ndim)
+    if kernel_size is not None:
+        kernel_size = _as_tuple(kernel_size, ndim)
+
+    # denoise the image
+    if kernel_size is None and gamma > 0:
+        spot_radius_px = detection.get_object_radius_pixel(
+            voxel_size_nm=voxel_size, object_radius_nm=spot_radius, ndim=ndim)
+        kernel_size = tuple([ r * gamma for r in spot_radius_px ])
+    if kernel_size is not None:
+        image_denoised = stack.remove_background_gaussian(image=image, sigma=kernel_size)
+    else:
+        image_denoised = image.copy()
+
+    # reference spot, once for all regions
+    reference_spot = detection.build_reference_spot(
+        image=image_denoised, spots=spots, voxel_size=voxel_size, spot_radius=spot_radius, alpha=alpha)
+    if reference_spot.sum() == 0:
+        return spots, np.array([], dtype=dtype).reshape((0, ndim + 4)), reference_spot
+
+    parameters_fitted = detection.modelize_spot(
+        reference_spot=reference_spot, voxel_size=voxel_size, spot_radius=spot_radius)
+    if ndim == 3:
+        sigma_z, sigma_yx, amplitude, background = parameters_fitted
+        sigma = (sigma_z, sigma_yx, sigma_yx)
+    else:
+        sigma_yx, amplitude, background = parameters_fitted
+        sigma = (sigma_yx, sigma_yx)
+
+    regions_to_decompose, spots_out_regions, region_size = detection.get_dense_region(
+        image=image_denoised, spots=spots, voxel_size=voxel_size, spot_radius=spot_radius, beta=beta)
+    if regions_to_decompose.size == 0:
+        return spots, np.array([], dtype=dtype).reshape((0, ndim + 4)), reference_spot
+
+    precomputed_gaussian = detection.precompute_erf(
+        ndim=ndim, voxel_size=voxel_size, sigma=sigma, max_grid=region_size + 1)
+    if max_workers == 1 or len(regions_to_decompose) < MIN_PARALLEL_REGIONS:
+        # not worth a process pool
+        spots_in_regions, dense_regions = detection.simulate_gaussian_mixture(
+            image=image_denoised, candidate_regions=regions_to_decompose, voxel_size=voxel_size, sigma=sigma,
+            amplitude=amplitude, background=background, precomputed_gaussian=precomputed_gaussian)
+    else:
+        spots_in_regions, dense_regions = simulate_gaussian_mixture(
+            image_denoised, regions_to_decompose, voxel_size, sigma, amplitude, background,
+            precomputed_gaussian, max_workers=max_workers)
+    spots_in_regions = spots_in_regions.astype(dtype)
+
+    spots = np.concatenate((spots_out_regions, spots_in_regions[:, :ndim]), axis=0)
+    return spots, dense_regions, reference_spot
@@ -0,0 +1,261 @@
+"""
+Reader of a whole experiment: every field of view (FOV) of an output folder.
+
+``find_fovs`` discovers the img.json files of the FOV directories of an
+output folder. Each image and labels file of the FOVs becomes one layer with
+an extra leading FOV axis, a dask array with one chunk per FOV, so napari
+shows a FOV slider and reads a FOV only when the slider reaches it. Loaded
+FOVs are kept in a small LRU cache, and the FOVs next to the one displayed
+are read in the background, so that moving the slider to a neighbour finds
+it already in memory.
+
+Points layers are read up front, spots files being small, and concatenated
+with the FOV index as their first coordinate.
+
+Files are matched across FOVs by name, taking the layers of the first FOV
+as the template. A FOV whose file is missing is shown empty, and one whose
+file has another shape is cropped or padded to the template's shape. 2D
+layers are given a single z-plane stretched over the z-stacks, so that they
+stay visible at every z.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ._reader import fov_layer_list, img_files, layer_path, read_layer
+
+
+def find_fovs(path):
+    """Return the img.json files of an experiment, sorted by path.
+
+    Parameters
+    ----------
+    path : str or Path or list
+        Output directory, searched with its immediate subdirectories, or
+        list of img.json files.
+
+    Returns
+    -------
+    files : list of Path
+    """
+    if isinstance(path, (list, tuple)):
+        return sorted(Path(p) for p in path)
+    return sorted(img_files(path))
+
+
+def fit(data, shape, dtype):
+    """Crop or zero-pad ``data`` to ``shape``; zeros if it is None or has another ndim."""
+    data = None if data is None else np.asarray(data)
+    if data is not None and data.shape == tuple(shape):
+        return data.astype(dtype, copy=False)
+    result = np.zeros(shape, dtype=dtype)
+    if data is not None and data.ndim == len(shape):
+        region = tuple(slice(0, min(a, b)) for a, b in zip(shape, data.shape))
+        result[region] = data[region]
+    return result
+
+
+class FovCache:
+    """Thread-safe LRU cache of FOV arrays, prefetching neighbouring FOVs.
+
+    Parameters
+    ----------
+    load : callable
+        ``load(fov, file)`` returns the array of a file of a FOV.
+    nb_fovs : int
+        Number of FOVs.
+    prefetch : int
+        Number of FOVs read in the background on each side of a requested one.
+    max_items : int
+        Number of arrays kept; the least recently used are released.
+    max_workers : int or None
+        Number of background reading threads. They are stopped by ``close``,
+        or once the cache is garbage collected with the layers using it.
+    """
+
+    def __init__(self, load, nb_fovs, prefetch=2, max_items=8, max_workers=None):
+        self.load = load
+        self.nb_fovs = nb_fovs
+        self.prefetch = prefetch
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or 2, thread_name_prefix='fov-prefetch')
+        self._finalizer = weakref.finalize(self, self._executor.shutdown, wait=False, cancel_futures=True)
+
+    def get(self, fov, file):
+        key = (fov, file)
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            pending = self._pending.get(key)
+            if value is None and pending is None:
+                # read here, but other readers of the same FOV wait for it
+                pending = self._pending[key] = Future()
+                loading = True
+            else:
+                loading = False
+
+        if loading:
+            try:
+                value = self._put(key, self.load(fov, file))
+                pending.set_result(value)
+            except BaseException as e:
+                pending.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+        elif value is None:
+            value = pending.result()
+        self.prefetch_around(fov, file)
+        return value
+
+    def prefetch_around(self, fov, file):
+        """Start reading the neighbours of a FOV that are not cached yet."""
+        neighbours = [ fov + sign * i for i in range(1, self.prefetch + 1) for sign in (1, -1) ]
+        with self._lock:
+            for other in neighbours:
+                key = (other, file)
+                if 0 <= other < self.nb_fovs and key not in self._items and key not in self._pending \
+                    and self._finalizer.alive:
+                    self._pending[key] = self._executor.submit(self._fetch, key)
+
+    def _fetch(self, key):
+        try:
+            return self._put(key, self.load(*key))
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def close(self):
+        """Stop the prefetching threads and release the cached arrays."""
+        self._finalizer()
+        with self._lock:
+            # reads cancelled before they started
+            self._pending = { key: f for key, f in self._pending.items() if not f.cancelled() }
+            self._items.clear()
+
+
+def read_experiment(path, prefetch=2, max_workers=None):
+    """Read all the FOVs of an experiment as layers with a leading FOV axis.
+
+    Parameters
+    ----------
+    path : str or Path or list
+        Output directory containing img.json files in its subdirectories, or
+        list of img.json files.
+    prefetch : int
+        Number of FOVs read in the background on each side of the displayed one.
+    max_workers : int or None
+        Number of threads reading points files and prefetching FOVs.
+
+    Returns
+    -------
+    layer_tuples : list of tuples
+        LayerData tuples, in the order of the first FOV's layer list. The
+        metadata of each layer has a 'fovs' entry, the directory of each FOV.
+    """
+    import dask.array as da
+    from dask import delayed
+
+    files = find_fovs(path)
+    if not files:
+        return []
+    directories = [ f.parent for f in files ]
+    fov_names = [ str(d) for d in directories ]
+    layer_lists = [ fov_layer_list(f) for f in files ]
+
+    # the first FOV having each file gives its layer, shape and dtype
+    template = {}
+    for directory, layer_list in zip(directories, layer_lists):
+        for entry in layer_list:
+            if entry['file'] in template or layer_path(directory, entry) is None:
+                continue
+            if entry['layer_type'] in ('image', 'labels'):
+                data = read_layer(directory, entry, lazy=True)[0]
+                template[entry['file']] = (entry, data.shape, data.dtype)
+            else:
+                template[entry['file']] = (entry, None, None)
+    nb_planes = max([ shape[0] for _, shape, _ in template.values() if shape is not None and len(shape) == 3 ] or [1])
+
+    def load(fov, file):
+        entry, shape, dtype = template[file]
+        entries = { e['file']: e for e in layer_lists[fov] }
+        layer_data = read_layer(directories[fov], entries.get(file, entry))
+        return fit(None if layer_data is None else layer_data[0], shape, dtype)
+
+    volumes = [ file for file, (_, shape, _) in template.items() if shape is not None ]
+    cache = FovCache(load, len(files), prefetch, max_items=(2 * prefetch + 2) * max(len(volumes), 1),
+                     max_workers=max_workers)
+
+    def stacked(file):
+        entry, shape, dtype = template[file]
+        token = f'fov-{id(cache):x}-{file}'
+        blocks = [ da.from_delayed(delayed(cache.get)(fov, file, dask_key_name=f'{token}-{fov}'),
+                                   shape=shape, dtype=dtype)
+                   for fov in range(len(files)) ]
+        data = da.stack(blocks)
+        add_kwargs = dict(entry['add_kwargs'])
+        add_kwargs['metadata'] = { **add_kwargs.get('metadata', {}), 'fovs': fov_names }
+        if len(shape) == 2 and nb_planes > 1:
+            # one plane covering all the z-planes of the stacks
+            data = data[:, np.newaxis]
+            add_kwargs.update(scale=(1, nb_planes, 1, 1), translate=(0, (nb_planes - 1) / 2, 0, 0))
+        return (data, add_kwargs, entry['layer_type'])
+
+    def points(file):
+        entry = template[file][0]
+
+        def read(fov):
+            entries = { e['file']: e for e in layer_lists[fov] }
+            if file not in entries:
+                return None
+            return read_layer(directories[fov], { **entries[file], 'add_kwargs': dict(entries[file]['add_kwargs']) })
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            layers = list(executor.map(read, range(len(files))))
+        fovs = [ fov for fov, layer in enumerate(layers) if layer is not None and len(layer[0]) ]
+        coordinates = [ np.asarray(layers[fov][0], dtype=np.float64) for fov in fovs ]
+        data = np.concatenate([ np.column_stack([np.full(len(c), fov), c]) for fov, c in zip(fovs, coordinates) ]) \
+            if fovs else np.zeros((0, 4))
+
+        add_kwargs = dict(entry['add_kwargs'])
+        add_kwargs['metadata'] = { **add_kwargs.get('metadata', {}), 'fovs': fov_names }
+        if entry['layer_type'] == 'spots':
+            features = [ layers[fov][1]['features'].assign(fov=fov) for fov in fovs ]
+            if features:
+                features = pd.concat(features, ignore_index=True)
+                add_kwargs['features'] = features
+                add_kwargs['border_color'] = 'in_cell'
+                add_kwargs['border_color_cycle'] = ['cyan', 'red'] if features['in_cell'].iloc[0] else ['red', 'cyan']
+            thresholds = { layers[fov][1]['metadata'].get('threshold') for fov in fovs }
+            if len(thresholds) > 1:
+                # FOVs were thresholded differently
+                add_kwargs['name'] = add_kwargs['name'].split(' thr=')[0]
+        return (data, add_kwargs, 'points')
+
+    return [ stacked(file) if shape is not None else points(file) for file, (_, shape, _) in template.items() ]
@@ -0,0 +1,261 @@
+"""
+Process pool backend for the CPU-bound stages of the widgets.
+
+The widgets run their stages in a thread, where the Python and NumPy heavy
+parts of LoG filtering, local maximum detection and dense decomposition
+still hold the GIL and compete with napari's event loop. ``offload`` runs
+a function in a persistent pool of worker processes instead.
+
+Large arrays do not go through pickle: they are written once to a file in
+shared memory (``/dev/shm`` where it exists) and memory-mapped by the other
+side, in both directions. Arrays that are already memory-mapped from a
+file, e.g. by the stage cache or the lazy reader, are mapped by the worker
+from that file without being copied. Returned arrays are memory-mapped
+from files that are unlinked at once, so that their memory is released
+with the last reference to them.
+
+The widgets use the pool when the environment variable
+``NAPARI_FLOFISH_PROCESSES`` is set to a number of worker processes.
+"""
+import atexit
+import contextlib
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# smaller arrays are pickled
+SHARED_MIN_BYTES = 2**20
+
+
+def nb_processes():
+    """Number of worker processes of the widgets, 0 to compute in their thread."""
+    try:
+        return max(int(os.environ.get('NAPARI_FLOFISH_PROCESSES', 0)), 0)
+    except ValueError:
+        return 0
+
+
+class SharedArray:
+    """Picklable reference to an array in a memory-mapped file.
+
+    Parameters
+    ----------
+    path : str
+        File holding the array's data.
+    shape : tuple of int
+    dtype : np.dtype
+    offset : int
+        Offset of the data in the file.
+    order : str
+        'C' or 'F'.
+    """
+
+    def __init__(self, path, shape, dtype, offset=0, order='C'):
+        self.path = str(path)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.order = order
+
+    def open(self, mode='r'):
+        """Memory-map the array."""
+        if int(np.prod(self.shape)) == 0:
+            return np.empty(self.shape, dtype=self.dtype, order=self.order)
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, offset=self.offset, shape=self.shape,
+                         order=self.order)
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def shared_directory():
+    """Directory of the shared memory files, removed at exit."""
+    global _directory
+    with _directory_lock:
+        if _directory is None:
+            parent = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            _directory = Path(tempfile.mkdtemp(prefix='napari-flofish-', dir=parent))
+            atexit.register(shutil.rmtree, _directory, ignore_errors=True)
+    return _directory
+
+
+def share(array, directory=None, mapped=True):
+    """Return a SharedArray with the data of ``array``.
+
+    Parameters
+    ----------
+    array : np.ndarray
+    directory : Path or None
+        Where the data is written, by default ``shared_directory()``.
+    mapped : bool
+        Refer to the file of an array memory-mapped from a file instead of
+        writing its data.
+
+    Returns
+    -------
+    shared : SharedArray
+    owned : bool
+        Whether the file was written here, and is to be unlinked by the
+        caller; False for an array mapped from an existing file.
+    """
+    if mapped and isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename \
+            and (array.flags.c_contiguous or array.flags.f_contiguous):
+        # the whole mapping of a file: the worker maps the same file
+        order = 'C' if array.flags.c_contiguous else 'F'
+        return SharedArray(array.filename, array.shape, array.dtype, array.offset, order), False
+
+    directory = shared_directory() if directory is None else directory
+    shared = SharedArray(Path(directory) / f'{uuid.uuid4().hex}.dat', array.shape, array.dtype)
+    if array.size:
+        out = shared.open('w+')
+        out[...] = array
+        out.flush()
+        del out
+    return shared, True
+
+
+def receive(shared):
+    """Map a SharedArray written by ``share`` and unlink its file.
+
+    The array is a plain np.ndarray over the mapping, not a np.memmap, so
+    that the stage cache counts it in its memory size: its file is gone.
+    """
+    if int(np.prod(shared.shape)) == 0:
+        return np.empty(shared.shape, dtype=shared.dtype, order=shared.order)
+    with open(shared.path, 'r+b') as f:
+        buffer = mmap.mmap(f.fileno(), 0)
+    # still open elsewhere (Windows): removed at exit
+    with contextlib.suppress(OSError):
+        os.unlink(shared.path)
+    return np.ndarray(shared.shape, dtype=shared.dtype, buffer=buffer, offset=shared.offset, order=shared.order)
+
+
+def _share_values(values, mapped=True):
+    # share the large arrays of a tuple, list or dict; return the shared
+    # values and the files written
+    owned = []
+
+    def convert(value):
+        if isinstance(value, np.ndarray) and value.nbytes >= SHARED_MIN_BYTES and value.dtype != object:
+            shared, is_owned = share(value, mapped=mapped)
+            if is_owned:
+                owned.append(shared.path)
+            return shared
+        return value
+
+    if isinstance(values, dict):
+        return { k: convert(v) for k, v in values.items() }, owned
+    shared = [ convert(v) for v in values ]
+    return (tuple(shared) if isinstance(values, tuple) else shared), owned
+
+
+def _open_values(values):
+    # copy-on-write: a function writing to its arguments changes neither
+    # the caller's arrays nor the files they are mapped from
+    def convert(value):
+        return value.open('c') if isinstance(value, SharedArray) else value
+
+    if isinstance(values, dict):
+        return { k: convert(v) for k, v in values.items() }
+    return type(values)(convert(v) for v in values)
+
+
+def _call(func, args, kwargs):
+    # in the worker: map the arguments, share the large results. Results
+    # are always written to new files, which the caller unlinks
+    result = func(*_open_values(args), **_open_values(kwargs))
+    if isinstance(result, (tuple, list)):
+        shared, _ = _share_values(result, mapped=False)
+        return shared
+    shared, _ = _share_values((result,), mapped=False)
+    return shared[0]
+
+
+def _receive_values(value):
+    if isinstance(value, SharedArray):
+        return receive(value)
+    if isinstance(value, (tuple, list)):
+        return type(value)(_receive_values(v) for v in value)
+    return value
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(max_workers=None):
+    """Return the persistent worker pool, started on first use.
+
+    Workers are spawned, not forked, so that they do not inherit the Qt
+    state of napari's process.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=max_workers or nb_processes() or None,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def shutdown():
+    """Stop the worker pool; the next ``offload`` starts a new one."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def offload(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` in the worker pool and wait for it.
+
+    Large array arguments and results, at the top level of the arguments
+    and of a returned tuple or list, go through shared memory. ``func``
+    must be importable by the workers (a module-level function).
+
+    Returns
+    -------
+    result
+        What ``func`` returns, with its large arrays memory-mapped.
+    """
+    shared_args, owned_args = _share_values(args)
+    shared_kwargs, owned_kwargs = _share_values(kwargs)
+    try:
+        result = get_pool().submit(_call, func, shared_args, shared_kwargs).result()
+    finally:
+        for path in owned_args + owned_kwargs:
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+    return _receive_values(result)
+
+
+def log_local_maxima(rna, spot_radius_px, tile_size=0, keep_log=False):
+    """LoG filter and local maxima index of a channel, as spot_detection computes them.
+
+    Returns
+    -------
+    index : ThresholdIndex
+    rna_log : np.ndarray or None
+        The LoG filtered image if ``keep_log``.
+    """
+    from bigfish import detection, stack
+
+    from ._spots import ThresholdIndex
+    from ._tiling import log_filter_local_maxima
+
+    if tile_size:
+        rna_log, mask = log_filter_local_maxima(rna, spot_radius_px, spot_radius_px, tile_size=tile_size)
+    else:
+        rna_log = stack.log_filter(rna, sigma=spot_radius_px)
+        mask = detection.local_maximum_detection(rna_log, min_distance=spot_radius_px)
+    index = ThresholdIndex.from_local_maxima(rna_log, mask)
+    return index, (rna_log if keep_log else None)
@@ -0,0 +1,174 @@
+"""
+Opt-in per-stage instrumentation of the widgets and the reader.
+
+When enabled, every stage of a widget run (the code following each
+``yield '<stage>'`` of its generator) and of the reader is timed: wall time,
+CPU time of the process and peak memory allocated while the stage ran. A
+summary is added to the metadata of the resulting layers under 'profile',
+and each run can be appended as one JSON line to a log file.
+
+Enable from the environment, before starting napari::
+
+    NAPARI_FLOFISH_PROFILE=1                      # layer metadata only
+    NAPARI_FLOFISH_PROFILE=/path/to/profile.jsonl # and JSON lines log
+
+or by calling ``enable()``. Peak memory is measured with tracemalloc, which
+counts numpy allocations, for the whole process: stages running at the same
+time in other threads are included. When disabled, the cost is one flag test
+per run.
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+_enabled = False
+_log_file = None
+_log_lock = threading.Lock()
+
+
+def enable(log_file=None, memory=True):
+    """Turn instrumentation on.
+
+    Parameters
+    ----------
+    log_file : str or Path or None
+        JSON lines file to append runs to.
+    memory : bool
+        Measure peak allocations with tracemalloc (slows down allocations
+        of small Python objects).
+    """
+    global _enabled, _log_file
+    _enabled = True
+    _log_file = None if log_file is None else str(log_file)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled, _log_file
+    _enabled = False
+    _log_file = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enabled():
+    return _enabled
+
+
+class Profile:
+    """Stage measurements of one run.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run, e.g. the widget's stages function.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self._current = None
+
+    def start(self, stage):
+        """Stop the current stage, if any, and start timing ``stage``."""
+        self.stop()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+        else:
+            memory = None
+        self._current = (stage, time.perf_counter(), time.process_time(), memory)
+
+    def stop(self):
+        if self._current is None:
+            return
+        stage, wall, cpu, memory = self._current
+        self.stages.append({
+            'stage': stage,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'peak_memory': None if memory is None else tracemalloc.get_traced_memory()[1] - memory,
+        })
+        self._current = None
+
+    @contextmanager
+    def stage(self, stage):
+        self.start(stage)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def summary(self):
+        """Stage measurements and totals, JSON serializable."""
+        peaks = [ s['peak_memory'] for s in self.stages if s['peak_memory'] is not None ]
+        return {
+            'run': self.name,
+            'stages': self.stages,
+            'wall': sum(s['wall'] for s in self.stages),
+            'cpu': sum(s['cpu'] for s in self.stages),
+            'peak_memory': max(peaks) if peaks else None,
+        }
+
+    def log(self):
+        """Append the summary to the log file, if one is set."""
+        if _log_file is None:
+            return
+        line = json.dumps({ 'time': time.time(), 'pid': os.getpid(), **self.summary() })
+        with _log_lock, open(_log_file, 'a') as f:
+            f.write(line + '\n')
+
+    def attach(self, layer_data):
+        """Add the summary to the metadata of LayerData tuples and return them."""
+        tuples = layer_data if isinstance(layer_data, list) else [layer_data]
+        summary = self.summary()
+        for t in tuples:
+            if len(t) > 1:
+                metadata = t[1].setdefault('metadata', {})
+                metadata['profile'] = summary
+        return layer_data
+
+
+def start_profile(name):
+    """Return a new Profile if instrumentation is enabled, else None."""
+    return Profile(name) if _enabled else None
+
+
+def stage(profile, name):
+    """Context manager timing a stage of ``profile``; does nothing if it is None."""
+    return nullcontext() if profile is None else profile.stage(name)
+
+
+def profiled(stages):
+    """Wrap a widget's stages generator function to time each stage.
+
+    Returns ``stages`` itself when instrumentation is disabled.
+    """
+    if not _enabled:
+        return stages
+
+    def run(*args, **kwargs):
+        profile = Profile(stages.__name__)
+        generator = stages(*args, **kwargs)
+        try:
+            while True:
+                # the code after a stage's yield belongs to that stage
+                name = next(generator)
+                profile.start(name)
+                yield name
+        except StopIteration as result:
+            profile.stop()
+            profile.log()
+            return profile.attach(result.value)
+
+    run.__name__ = stages.__name__
+    return run
+
+
+_env = os.environ.get('NAPARI_FLOFISH_PROFILE')
+if _env:
+    enable(None if _env.lower() in ('1', 'true', 'yes') else _env)
@@ -0,0 +1,156 @@
+"""
+Multiscale pyramids of image and labels layers.
+
+napari draws a multiscale layer from the level matching the zoom, so a
+zoomed-out view of a large field reads and uploads only small planes.
+``pyramid`` halves the Y and X size at every level (z-planes are sliced,
+not zoomed, and are kept): images by 2x2 mean, labels by nearest neighbour
+so that label values stay valid. Level 0 is the data itself.
+
+``cached_pyramid`` stores the levels computed from a file in a Zarr store
+next to it, ``pyramids/<file name>.zarr``, chunked and compressed like the
+writer's stores, and rebuilds them when the file's size or modification
+time changes. Levels are read back lazily.
+
+The reader builds pyramids when asked to, or when the environment variable
+``NAPARI_FLOFISH_MULTISCALE`` is set to 1.
+"""
+import os
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from ._writer import _chunks, _compressors
+
+# levels are added while the smaller of Y and X stays at least this size
+MIN_LEVEL_SIZE = 512
+PYRAMID_DIRECTORY = 'pyramids'
+
+
+def multiscale_enabled():
+    """Whether the reader builds pyramids by default, from the environment."""
+    return os.environ.get('NAPARI_FLOFISH_MULTISCALE', '').lower() in ('1', 'true', 'yes')
+
+
+def nb_levels(shape, min_size=None):
+    """Number of pyramid levels, including the full resolution one."""
+    if min_size is None:
+        min_size = MIN_LEVEL_SIZE
+    levels, size = 1, min(shape[-2:])
+    while size // 2 >= min_size:
+        levels, size = levels + 1, size // 2
+    return levels
+
+
+def downsample(data, layer_type):
+    """Halve the Y and X size of an array, lazily.
+
+    Parameters
+    ----------
+    data : np.ndarray or dask.array.Array
+        Image or labels with shape (..., y, x).
+    layer_type : str
+        'labels' are subsampled, images are averaged over 2x2 blocks.
+
+    Returns
+    -------
+    level : dask.array.Array
+        Array with shape (..., y // 2, x // 2) and the dtype of ``data``.
+    """
+    import dask.array as da
+
+    if not isinstance(data, da.Array):
+        data = da.from_array(data, chunks=_chunks(data.shape, 'image'))
+    height, width = data.shape[-2:]
+    if layer_type == 'labels':
+        return data[..., :height - height % 2:2, :width - width % 2:2]
+
+    mean = da.coarsen(np.mean, data, { data.ndim - 2: 2, data.ndim - 1: 2 }, trim_excess=True)
+    if np.issubdtype(data.dtype, np.integer):
+        mean = da.round(mean)
+    return mean.astype(data.dtype)
+
+
+def pyramid(data, layer_type, min_size=None):
+    """Return the pyramid levels of ``data``, computed lazily.
+
+    Parameters
+    ----------
+    data : np.ndarray or dask.array.Array
+        Image or labels with shape (..., y, x).
+    layer_type : str
+        'image' or 'labels'.
+    min_size : int or None
+        Smallest Y or X size of the last level, by default MIN_LEVEL_SIZE.
+
+    Returns
+    -------
+    levels : list of arrays
+        ``data`` followed by the downsampled levels; only ``data`` if it is
+        too small for a pyramid.
+    """
+    levels = [data]
+    for _ in range(1, nb_levels(data.shape, min_size)):
+        levels.append(downsample(levels[-1], layer_type))
+    return levels
+
+
+def cached_pyramid(file, data, layer_type, min_size=None):
+    """Return the pyramid levels of a file's data, cached next to the file.
+
+    Parameters
+    ----------
+    file : str or Path
+        File ``data`` was read from.
+    data : np.ndarray or dask.array.Array
+        Its data, the full resolution level.
+    layer_type : str
+        'image' or 'labels'.
+    min_size : int or None
+        Smallest Y or X size of the last level, by default MIN_LEVEL_SIZE.
+
+    Returns
+    -------
+    levels : list of arrays
+        ``data`` followed by the cached levels, as dask arrays. If the cache
+        cannot be written, the levels are computed lazily instead.
+    """
+    import dask.array as da
+    import zarr
+
+    file = Path(file)
+    levels = nb_levels(data.shape, min_size)
+    if levels == 1:
+        return [data]
+
+    stat = file.stat()
+    source = { 'file': file.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+               'layer_type': layer_type, 'levels': levels }
+    store = file.parent / PYRAMID_DIRECTORY / f'{file.name}.zarr'
+
+    if store.is_dir():
+        try:
+            root = zarr.open_group(str(store), mode='r')
+            if root.attrs.get('source') == source:
+                return [data] + [ da.from_zarr(root[str(i)]) for i in range(1, levels) ]
+        except (OSError, KeyError, ValueError):
+            pass  # an unreadable store is rebuilt
+
+    try:
+        root = zarr.open_group(str(store), mode='w')
+        previous = data
+        for i in range(1, levels):
+            # each level is computed from the previous one, read back from the store
+            level = downsample(previous, layer_type)
+            array = root.create_array(str(i), shape=level.shape, dtype=level.dtype,
+                                      chunks=_chunks(level.shape, 'image'), compressors=_compressors())
+            da.store(level, array, lock=False)
+            previous = da.from_zarr(array)
+        # set once every level is stored: it marks a complete pyramid
+        root.attrs['source'] = source
+    except OSError as e:
+        warnings.warn(f'Cannot cache the pyramid of {file}: {e}', stacklevel=2)
+        return pyramid(data, layer_type, min_size)
+
+    return [data] + [ da.from_zarr(root[str(i)]) for i in range(1, levels) ]
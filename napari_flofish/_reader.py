@@ -10,6 +10,12 @@ import pandas as pd
 import json
 from skimage import io
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from ._profiling import stage, start_profile
+from ._pyramid import cached_pyramid, multiscale_enabled
+from ._spot_table import is_spot_table, read_spot_table
+from ._spots import in_cell
 
 
 def napari_get_reader(path):
@@ -27,20 +33,42 @@ def napari_get_reader(path):
         same path or list of paths, and returns a list of layer data tuples.
     """
     if isinstance(path, list):
+        # several img.json files: the FOVs of an experiment
+        if len(path) > 1 and all(Path(p).name == 'img.json' for p in path):
+            return read_experiment
         # reader plugins may be handed single path, or a list of paths.
         # if it is a list, it is assumed to be an image stack...
         # so we are only going to look at the first file.
         path = path[0]
 
+    # stores written by napari_flofish._writer
+    if str(path).rstrip('/').endswith(".zarr"):
+        return read_zarr
+
+    # output folder of an experiment, with an img.json per FOV
+    if Path(path).is_dir():
+        return read_experiment if img_files(path) else None
+
     # if we know we cannot read the file, we immediately return None.
-    if not path.endswith(".json"):
+    if not str(path).endswith(".json"):
         return None
 
     # otherwise we return the *function* that can read ``path``.
     return reader_function
 
 
-def reader_function(path):
+def img_files(directory):
+    """Return the img.json files of a directory and of its immediate subdirectories.
+
+    Only one level is searched: an output folder holds one directory per
+    FOV, and walking a whole tree, e.g. a home directory dropped on the
+    viewer, could take minutes.
+    """
+    directory = Path(directory)
+    return [ f for f in [directory / 'img.json', *directory.glob('*/img.json')] if f.is_file() ]
+
+
+def reader_function(path, lazy=True, max_workers=None, multiscale=None):
     """Take a path or list of paths and return a list of LayerData tuples.
 
     Readers are expected to return data as a list of tuples, where each tuple
@@ -51,6 +79,14 @@ def reader_function(path):
     ----------
     path : str
         Path to img.json file
+    lazy : bool
+        Memory-map .npy files and decode TIFF stacks one z-plane at a time,
+        on demand, instead of loading everything into memory up front.
+    max_workers : int or None
+        Number of threads used to read files, see read_smfish_json.
+    multiscale : bool or None
+        Return large images and labels as multiscale pyramids, see
+        read_smfish_json. By default, if ``NAPARI_FLOFISH_MULTISCALE`` is set.
 
     Returns
     -------
@@ -76,12 +112,160 @@ def reader_function(path):
     #
     # return [(data, add_kwargs, layer_type)]
 
-    layer_tuples = read_smfish_json(path)
+    if multiscale is None:
+        multiscale = multiscale_enabled()
+    layer_tuples = read_smfish_json(path, lazy=lazy, max_workers=max_workers, multiscale=multiscale)
     pass
     return layer_tuples
 
 
-def read_smfish_json(path):
+def imread_lazy(file):
+    """Wrap a TIFF file in a dask array with one chunk per page.
+
+    For the z-stacks written by flofish a page is a z-plane, so napari
+    only decodes the planes it actually displays.
+
+    Parameters
+    ----------
+    file : str or Path
+        Path to the TIFF file.
+
+    Returns
+    -------
+    data : dask.array.Array
+        Array with the same shape and dtype as ``io.imread(file)``.
+    """
+    import dask.array as da
+    import tifffile
+    from dask import delayed
+
+    with tifffile.TiffFile(file) as tif:
+        series = tif.series[0]
+        shape, dtype = series.shape, series.dtype
+        page_shape = series.keyframe.shape
+        n_pages = len(series.pages)
+
+    if n_pages < 2 or n_pages * int(np.prod(page_shape)) != int(np.prod(shape)):
+        # single plane, or a layout we cannot split by page: one chunk
+        data = delayed(tifffile.imread)(file)
+        return da.from_delayed(data, shape=shape, dtype=dtype)
+
+    planes = [
+        da.from_delayed(delayed(tifffile.imread)(file, key=i), shape=page_shape, dtype=dtype)
+        for i in range(n_pages)
+    ]
+    return da.stack(planes).reshape(shape)
+
+
+def read_layer(directory, layer, lazy=False, multiscale=False):
+    """Read the file of one layer_list entry into a LayerData tuple.
+
+    Parameters
+    ----------
+    directory : Path
+        Directory containing img.json.
+    layer : dict
+        Entry of the reader's layer list, with 'file', 'layer_type' and
+        'add_kwargs' keys.
+    lazy : bool
+        Memory-map .npy files and read TIFF files page by page.
+    multiscale : bool
+        Return large images and labels as a multiscale pyramid, built on
+        first read and cached next to the file (see _pyramid).
+
+    Returns
+    -------
+    layer_data : tuple or None
+        (data, add_kwargs, layer_type), or None if the file does not exist.
+    """
+    file = layer_path(directory, layer)
+    if file is None:
+        return None
+
+    if file.is_dir():
+        return read_spots(file, layer, lazy)
+    elif file.suffix == '.tif':
+        data = imread_lazy(file) if lazy else io.imread(file)
+        return with_pyramid(file, (data, layer['add_kwargs'], layer['layer_type']), multiscale)
+    elif file.suffix == '.npy':
+        data = np.load(file, mmap_mode='r' if lazy else None)
+        if layer['layer_type'] == "image":
+            return with_pyramid(file, (data, layer['add_kwargs'], layer['layer_type']), multiscale)
+        elif layer['layer_type'] == "decomposed_spots":
+            return (data, layer['add_kwargs'], "points")
+        elif layer['layer_type'] == "spots":
+            features = pd.DataFrame(data, columns=['z', 'y', 'x', 'intensity', 'filtered_intensity', 'label'])
+            features['in_cell'] = in_cell(features['label'], dtype=bool)
+            layer['add_kwargs']['border_color'] = 'in_cell'
+            layer['add_kwargs']['border_color_cycle'] = ['cyan', 'red'] if features.iloc[0]['in_cell'] else ['red', 'cyan']
+
+            spot_data = data[:, :3]
+            layer['add_kwargs'].update({'features': features})
+            return (spot_data, layer['add_kwargs'], "points")
+
+    return None
+
+
+def layer_path(directory, layer):
+    """Return the file of a layer_list entry, or None if it does not exist.
+
+    Spots are read from a spot table, the ``.npy`` file name without its
+    suffix, when there is one (see _spot_table).
+    """
+    file = directory / layer['file']
+    if layer['layer_type'] in ('spots', 'decomposed_spots') and is_spot_table(file.with_suffix('')):
+        return file.with_suffix('')
+    return file if file.is_file() else None
+
+
+def read_spots(path, layer, lazy=False):
+    """Read a spot table into a points LayerData tuple, with its columns as features.
+
+    The features are the coordinate and feature columns themselves, not
+    copies; with ``lazy``, they are memory-mapped.
+    """
+    coordinates, columns = read_spot_table(path, lazy=lazy)
+    axes = ['z', 'y', 'x'][-coordinates.shape[1]:]
+    features = pd.DataFrame({ **{ axis: coordinates[:, i] for i, axis in enumerate(axes) }, **columns }, copy=False)
+
+    add_kwargs = dict(layer['add_kwargs'])
+    if 'label' in features:
+        features['in_cell'] = in_cell(features['label'], dtype=bool)
+        if layer['layer_type'] == 'spots':
+            add_kwargs['border_color'] = 'in_cell'
+            add_kwargs['border_color_cycle'] = ['cyan', 'red'] if len(features) == 0 or features['in_cell'].iloc[0] \
+                else ['red', 'cyan']
+    add_kwargs['features'] = features
+
+    # napari moves points by fractions of a pixel: float coordinates
+    return (coordinates.astype(np.float32), add_kwargs, 'points')
+
+
+def with_pyramid(file, layer_data, multiscale=True):
+    """Replace the data of an image or labels LayerData tuple by its cached pyramid."""
+    data, add_kwargs, layer_type = layer_data
+    if not multiscale or layer_type not in ('image', 'labels'):
+        return layer_data
+    levels = cached_pyramid(file, data, layer_type)
+    if len(levels) == 1:
+        return layer_data
+    return (levels, { **add_kwargs, 'multiscale': True }, layer_type)
+
+
+def fov_layer_list(path):
+    """Return the reader's layer list of one field of view.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to img.json file.
+
+    Returns
+    -------
+    layer_list : list of dict
+        One entry per layer file that may exist next to img.json, with
+        'file', 'layer_type' and 'add_kwargs' keys.
+    """
     layer_list = [
         { 'file': 'DIC.tif', 'layer_type': "image",
           'add_kwargs': { 'name': "DIC", 'colormap': 'grey', 'visible': True, 'blending': 'additive' } },
@@ -95,8 +279,6 @@ def read_smfish_json(path):
           'add_kwargs': { 'name': "DAPI masks", 'visible': False, 'blending': 'additive', 'opacity': 0.2 } },
     ]
 
-
-    layer_tuples = []
     with open(path, "r") as f:
         img = json.load(f)
         colors = { i[0]: i[1]['colormap'] for i in img['results'].items() }
@@ -134,31 +316,106 @@ def read_smfish_json(path):
                                                'blending': 'translucent', 'visible': False, 'out_of_slice_display': True,
                                                'symbol': 'disc', 'size': 10, 'border_width': 0.1, 'border_color': colors[ch], 'face_color': 'transparent', 'opacity': 0.5 }})
 
-        for l in layer_list:
-            file = Path(path).parent / l['file']
-            print(l['file'])
-            if file.is_file():
-                if file.suffix == '.tif':
-                    data = io.imread(file)
-                    layer_tuples.append( (data, l['add_kwargs'], l['layer_type']) )
-                elif file.suffix == '.npy':
-                    data = np.load(file)
-                    if l['layer_type'] == "image":
-                        layer_tuples.append( (data, l['add_kwargs'], l['layer_type']) )
-                    elif l['layer_type'] == "decomposed_spots":
-                        l['layer_type'] = "points"
-                        layer_tuples.append((data, l['add_kwargs'], l['layer_type']))
-                    elif l['layer_type'] == "spots":
-                        l['layer_type'] = "points"
-
-                        features = pd.DataFrame(data, columns=['z', 'y', 'x', 'intensity', 'filtered_intensity', 'label'])
-                        features['in_cell'] = features.apply(lambda s: False if s['label'] == 0 else True, axis=1)
-                        l['add_kwargs']['border_color'] = 'in_cell'
-                        l['add_kwargs']['border_color_cycle'] = ['cyan', 'red'] if features.iloc[0]['in_cell'] == True else ['red', 'cyan']
-
-                        spot_data = data[:, :3]
-                        l['add_kwargs'].update({'features': features})
-                        layer_tuples.append( (spot_data, l['add_kwargs'], l['layer_type']) )
+    return layer_list
+
+
+def read_smfish_json(path, lazy=False, max_workers=None, multiscale=False):
+    """Read the layers of one field of view from its img.json file.
+
+    Parameters
+    ----------
+    path : str
+        Path to img.json file.
+    lazy : bool
+        Memory-map .npy files and read TIFF files page by page.
+    max_workers : int or None
+        Number of threads used to read files. Defaults to
+        ``min(32, os.cpu_count() + 4)`` (the ThreadPoolExecutor default).
+    multiscale : bool
+        Return large images and labels as multiscale pyramids, cached in a
+        ``pyramids`` directory next to img.json, so that zoomed-out views
+        only read low resolution levels.
+
+    Returns
+    -------
+    layer_tuples : list of tuples
+        LayerData tuples, in the order of the reader's layer list.
+    """
+    profile = start_profile('read_smfish_json')
+    with stage(profile, 'img.json'):
+        layer_list = fov_layer_list(path)
+
+    # files are independent: decode them concurrently (TIFF decompression
+    # and disk reads release the GIL) and keep the order of layer_list
+    with stage(profile, 'read files'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda layer: read_layer(Path(path).parent, layer, lazy, multiscale), layer_list)
+        layer_tuples = [ t for t in results if t is not None ]
+
+    if profile is not None:
+        profile.log()
+        profile.attach(layer_tuples)
 
     return layer_tuples
 
+
+def read_experiment(path, prefetch=2, max_workers=None):
+    """Read all the FOVs of an experiment, see ``_experiment.read_experiment``."""
+    from ._experiment import read_experiment
+
+    return read_experiment(path, prefetch=prefetch, max_workers=max_workers)
+
+
+def read_zarr(path, lazy=True, max_workers=None):
+    """Read the layers of a Zarr store written by ``write_multiple``.
+
+    Parameters
+    ----------
+    path : str or list of str
+        Path to the ``.zarr`` directory.
+    lazy : bool
+        Wrap images and labels in dask arrays that read chunks on demand,
+        instead of loading them into memory.
+    max_workers : int or None
+        Number of threads used to read points and their features.
+
+    Returns
+    -------
+    layer_tuples : list of tuples
+        LayerData tuples, in the order the layers were written.
+    """
+    import dask.array as da
+    import zarr
+
+    if isinstance(path, list):
+        path = path[0]
+    root = zarr.open_group(str(path), mode='r')
+
+    def read(key):
+        group = root[key]
+        layer_type = group.attrs['layer_type']
+        add_kwargs = dict(group.attrs['add_kwargs'])
+
+        if layer_type in ('image', 'labels') and lazy:
+            data = da.from_zarr(group['data'])
+        else:
+            data = group['data'][...]
+
+        if 'kwargs' in group:
+            for name, array in group['kwargs'].arrays():
+                add_kwargs[name] = array[...]
+        if 'features' in group:
+            columns = group['features']
+            add_kwargs['features'] = pd.DataFrame({ c: columns[c][...] for c in columns.attrs['columns'] })
+
+        return (data, add_kwargs, layer_type)
+
+    profile = start_profile('read_zarr')
+    keys = sorted(root.group_keys(), key=int)
+    with stage(profile, 'read layers'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        layer_tuples = list(executor.map(read, keys))
+
+    if profile is not None:
+        profile.log()
+        profile.attach(layer_tuples)
+
+    return layer_tuples
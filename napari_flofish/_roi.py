@@ -0,0 +1,167 @@
+"""
+Region of interest helpers for incremental re-detection.
+
+A region of interest (ROI) is a YX box, ``(y0, y1, x0, x1)``, spanning all
+z-planes: the bounding box of the shapes of a Shapes layer or of a few cell
+labels. It is processed with a halo of extra pixels on each side, so that
+filters see the same neighbourhood as on the whole image, and only the
+spots found in the box itself are merged back into the whole image's spots,
+replacing those previously found there.
+"""
+import numpy as np
+import pandas as pd
+from scipy import ndimage as ndi
+
+from ._spots import ThresholdIndex
+
+
+def shapes_box(shapes, shape):
+    """Return the YX bounding box of shapes, clipped to the image.
+
+    Parameters
+    ----------
+    shapes : list of np.ndarray
+        Vertices of each shape, with shape (nb_vertices, ndim), y and x
+        last, in the image's data coordinates.
+    shape : tuple of int
+        Shape of the image.
+
+    Returns
+    -------
+    box : tuple of int or None
+        (y0, y1, x0, x1), or None if there are no shapes.
+    """
+    if len(shapes) == 0:
+        return None
+    vertices = np.concatenate([ np.asarray(s)[:, -2:] for s in shapes ])
+    y0, x0 = np.floor(vertices.min(axis=0)).astype(int)
+    y1, x1 = np.ceil(vertices.max(axis=0)).astype(int) + 1
+    height, width = shape[-2:]
+    return (max(y0, 0), min(y1, height), max(x0, 0), min(x1, width))
+
+
+def labels_box(cell_masks, labels):
+    """Return the YX bounding box of some cell labels.
+
+    Parameters
+    ----------
+    cell_masks : np.ndarray
+        Labels with shape (z, y, x) or (y, x).
+    labels : list of int
+
+    Returns
+    -------
+    box : tuple of int or None
+        (y0, y1, x0, x1), or None if none of the labels is in the masks.
+    """
+    objects = ndi.find_objects(np.asarray(cell_masks))
+    slices = [ objects[label - 1] for label in labels if 0 < label <= len(objects) and objects[label - 1] ]
+    if not slices:
+        return None
+    return (min(s[-2].start for s in slices), max(s[-2].stop for s in slices),
+            min(s[-1].start for s in slices), max(s[-1].stop for s in slices))
+
+
+def with_halo(box, halo, shape):
+    """Return the box grown by ``halo`` pixels, clipped to the image."""
+    y0, y1, x0, x1 = box
+    height, width = shape[-2:]
+    return (max(y0 - halo, 0), min(y1 + halo, height), max(x0 - halo, 0), min(x1 + halo, width))
+
+
+def crop(data, box):
+    """Return the YX crop of an array, all leading axes included."""
+    y0, y1, x0, x1 = box
+    return data[..., y0:y1, x0:x1]
+
+
+def in_box(spots, box):
+    """Return whether each spot's YX coordinates are inside the box."""
+    y0, y1, x0, x1 = box
+    spots = np.asarray(spots)
+    y, x = spots[:, -2], spots[:, -1]
+    return (y >= y0) & (y < y1) & (x >= x0) & (x < x1)
+
+
+def merge_spots(spots, features, roi_spots, roi_features, box):
+    """Replace the spots of a box by those found in it.
+
+    Parameters
+    ----------
+    spots : np.ndarray or None
+        Spots of the whole image, with shape (nb_spots, ndim), or None.
+    features : pd.DataFrame or None
+        Their features, one row per spot.
+    roi_spots : np.ndarray
+        Spots found in the ROI with its halo, in image coordinates.
+    roi_features : pd.DataFrame
+        Their features.
+    box : tuple of int
+        (y0, y1, x0, x1) of the ROI, without the halo.
+
+    Returns
+    -------
+    spots : np.ndarray
+    features : pd.DataFrame
+        Spots and features out of the box, followed by those in it.
+    """
+    keep = in_box(roi_spots, box)
+    roi_spots, roi_features = np.asarray(roi_spots)[keep], roi_features[keep]
+    if spots is None or len(spots) == 0:
+        return roi_spots, roi_features.reset_index(drop=True)
+
+    outside = ~in_box(spots, box)
+    merged = np.concatenate([ np.asarray(spots)[outside].astype(roi_spots.dtype), roi_spots ])
+    if features is None:
+        features = pd.DataFrame(index=range(len(spots)))
+    merged_features = pd.concat([ features[outside], roi_features ], ignore_index=True)
+    return merged, merged_features
+
+
+def shift_spots(spots, features, box):
+    """Move spots found in a crop, and their 'y' and 'x' features, to image coordinates."""
+    y0, _, x0, _ = box
+    spots = np.asarray(spots).copy()
+    spots[:, -2] += y0
+    spots[:, -1] += x0
+    features = features.copy()
+    for column, offset in [('y', y0), ('x', x0)]:
+        if column in features:
+            features[column] += offset
+    return spots, features
+
+
+def merge_index(index, roi_index, box, halo_box):
+    """Replace the local maxima of a box in a threshold index by those found in it.
+
+    Parameters
+    ----------
+    index : ThresholdIndex or None
+        Local maxima of the whole image, or None.
+    roi_index : ThresholdIndex
+        Local maxima found in the ROI with its halo, in crop coordinates.
+    box : tuple of int
+        (y0, y1, x0, x1) of the ROI, without the halo.
+    halo_box : tuple of int
+        (y0, y1, x0, x1) of the crop the ROI was processed in.
+
+    Returns
+    -------
+    index : ThresholdIndex
+        The local maxima out of the box and those found in it, in raster
+        order. An index falling back to bigfish (see ThresholdIndex) is
+        merged from its table, as if its plateaus were flat.
+    """
+    y0, _, x0, _ = halo_box
+    roi_spots = roi_index.spots.copy()
+    roi_spots[:, -2] += y0
+    roi_spots[:, -1] += x0
+    keep = in_box(roi_spots, box)
+    parts = [ (roi_spots[keep], roi_index.values[keep], roi_index.intensities[keep]) ]
+    if index is not None and len(index):
+        outside = ~in_box(index.spots, box)
+        parts.insert(0, (index.spots[outside], index.values[outside], index.intensities[outside]))
+
+    spots, values, intensities = (np.concatenate(arrays) for arrays in zip(*parts))
+    order = np.lexsort(spots.T[::-1])
+    return ThresholdIndex(spots[order], values[order], intensities[order])
@@ -0,0 +1,129 @@
+"""
+Compact columnar storage of spots.
+
+A spot table is a directory, e.g. ``<channel>_spots`` next to img.json,
+with one .npy file per column::
+
+    coordinates.npy     (nb_spots, ndim), int16, or int32 for large images
+    <feature>.npy       (nb_spots,), float32, int32 or bool
+    table.json          {"columns": [...], "nb_spots": ..., "sorted_by": "z"}
+
+Rows are sorted by z, so the spots of a range of z-planes are a contiguous
+range of rows, found by a binary search. Columns are memory-mapped and
+only the columns asked for are opened, so reading a million spots costs
+opening a few files, without a pass over the rows.
+
+The reader falls back to the ``<channel>_spots.npy`` float64 tables written
+by flofish when there is no spot table.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+TABLE_FILE = 'table.json'
+COORDINATES = 'coordinates'
+
+
+def coordinate_dtype(coordinates):
+    """Smallest of int16 and int32 holding the coordinates."""
+    coordinates = np.asarray(coordinates)
+    if coordinates.size == 0:
+        return np.dtype(np.int16)
+    low, high = coordinates.min(), coordinates.max()
+    for dtype in (np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def feature_dtype(values):
+    """Storage dtype of a feature: float32, int32 (or int64 if needed), or bool."""
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values.dtype
+    if np.issubdtype(values.dtype, np.integer):
+        if values.size == 0 or (np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max):
+            return np.dtype(np.int32)
+        return np.dtype(np.int64)
+    if np.issubdtype(values.dtype, np.floating):
+        return np.dtype(np.float32)
+    raise ValueError(f'Cannot store a feature of dtype {values.dtype} in a spot table')
+
+
+def is_spot_table(path):
+    """Whether ``path`` is a complete spot table."""
+    return (Path(path) / TABLE_FILE).is_file()
+
+
+def write_spot_table(path, coordinates, features=None):
+    """Write spots and their features as a spot table.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory of the table, created if needed.
+    coordinates : np.ndarray
+        Integer spot coordinates with shape (nb_spots, ndim), z first.
+    features : dict or pd.DataFrame or None
+        Numeric features, one value per spot, by name.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    coordinates = np.asarray(coordinates)
+    features = {} if features is None else features
+
+    order = np.argsort(coordinates[:, 0], kind='stable')
+    np.save(path / f'{COORDINATES}.npy', coordinates[order].astype(coordinate_dtype(coordinates)))
+    columns = []
+    for name in features:
+        values = np.asarray(features[name])
+        np.save(path / f'{name}.npy', values[order].astype(feature_dtype(values)))
+        columns.append(str(name))
+
+    # readers check for this file, so it is written after the columns
+    with open(path / TABLE_FILE, 'w') as f:
+        json.dump({ 'columns': columns, 'nb_spots': len(coordinates), 'sorted_by': 'z' }, f)
+
+
+def read_spot_table(path, columns=None, z_range=None, lazy=True):
+    """Read the spots of a spot table, or some of them.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory of the table.
+    columns : list of str or None
+        Features to read, all of them by default.
+    z_range : tuple of int or None
+        Only read the spots with ``z_range[0] <= z < z_range[1]``.
+    lazy : bool
+        Memory-map the columns (copy-on-write) instead of reading them.
+
+    Returns
+    -------
+    coordinates : np.ndarray
+        Spot coordinates with shape (nb_spots, ndim), sorted by z.
+    features : dict
+        Array of each feature read, by name.
+    """
+    path = Path(path)
+    with open(path / TABLE_FILE) as f:
+        table = json.load(f)
+    if columns is None:
+        columns = table['columns']
+    unknown = set(columns) - set(table['columns'])
+    if unknown:
+        raise KeyError(f'No column {", ".join(sorted(unknown))} in spot table {path}')
+
+    def load(name, rows=slice(None)):
+        # only the rows read are copied into memory if not lazy
+        values = np.load(path / f'{name}.npy', mmap_mode='c')[rows]
+        return values if lazy else np.array(values)
+
+    rows = slice(None)
+    if z_range is not None:
+        z = np.load(path / f'{COORDINATES}.npy', mmap_mode='r')[:, 0]
+        rows = slice(*np.searchsorted(z, z_range, side='left'))
+
+    return load(COORDINATES, rows), { name: load(name, rows) for name in columns }
@@ -0,0 +1,469 @@
+"""
+Spot thresholding and spot feature helpers shared by the widgets and the
+reader.
+"""
+
+import numpy as np
+import pandas as pd
+from bigfish import detection, stack
+from scipy import ndimage as ndi
+
+
+class ThresholdIndex:
+    """Local maxima of a LoG filtered image, sorted by LoG intensity.
+
+    Built once per channel from the LoG filtered image and the local maxima
+    mask. Thresholding then reduces to a binary search in the sorted
+    intensities and gives the same spots, in the same order, as
+    ``bigfish.detection.spots_thresholding`` with ``remove_duplicate=True``.
+
+    Connected local maxima (plateaus) are merged into a single spot at their
+    centroid, as bigfish does. Local maxima computed with a maximum filter of
+    size >= 3 along every axis have the same value on the whole plateau, so
+    a plateau is either kept or dropped as a whole by any threshold. If that
+    is not the case, the index keeps the image and mask and thresholds them
+    with bigfish instead.
+
+    Parameters
+    ----------
+    spots : np.ndarray, np.int64
+        Spot coordinates with shape (nb_spots, ndim), in raster order.
+    values : np.ndarray
+        Intensity of each spot's plateau in the LoG filtered image, compared
+        to the threshold.
+    intensities : np.ndarray
+        Intensity of the LoG filtered image at each spot's coordinates.
+    """
+
+    def __init__(self, spots, values, intensities):
+        self.spots = spots
+        self.values = values
+        self.intensities = intensities
+        self._by_value = np.argsort(values, kind='stable')
+        self._sorted_values = values[self._by_value]
+        self._image = None
+        self._mask = None
+
+    def __len__(self):
+        return len(self.spots)
+
+    @property
+    def max_value(self):
+        """Largest LoG value of the local maxima, or None without any."""
+        return self._sorted_values[-1] if len(self) else None
+
+    @property
+    def nbytes(self):
+        """Memory taken by the index, with the image and mask it may keep."""
+        arrays = [ self.spots, self.values, self.intensities, self._by_value, self._sorted_values,
+                   self._image, self._mask ]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    @classmethod
+    def from_local_maxima(cls, rna_log, mask):
+        """Build the index from a LoG filtered image and its local maxima.
+
+        Parameters
+        ----------
+        rna_log : np.ndarray
+            LoG filtered image with shape (z, y, x) or (y, x).
+        mask : np.ndarray
+            Local maxima mask with the same shape as ``rna_log``.
+
+        Returns
+        -------
+        index : ThresholdIndex
+        """
+        mask = np.asarray(mask, dtype=bool)
+        labels, nb_spots = ndi.label(mask, structure=np.ones((3,) * mask.ndim, dtype=bool))
+        if nb_spots == 0:
+            return cls(np.zeros((0, rna_log.ndim), dtype=np.int64),
+                       np.zeros(0, dtype=rna_log.dtype), np.zeros(0, dtype=rna_log.dtype))
+
+        # labels are numbered in raster order of their first pixel, like
+        # skimage.measure.label, so centroids come out in bigfish's order
+        spot_labels = labels[mask]
+        counts = np.bincount(spot_labels)[1:]
+        centroids = np.stack(
+            [ np.bincount(spot_labels, weights=c)[1:] / counts for c in np.nonzero(mask) ], axis=1)
+        spots = centroids.astype(np.int64)
+
+        index = np.arange(1, nb_spots + 1)
+        values = np.asarray(ndi.maximum(rna_log, labels, index), dtype=rna_log.dtype)
+        threshold_index = cls(spots, values, rna_log[tuple(spots.T)])
+        if np.any(values != ndi.minimum(rna_log, labels, index)):
+            # a threshold could split a plateau, fall back to bigfish
+            threshold_index._image, threshold_index._mask = rna_log, mask
+
+        return threshold_index
+
+    @classmethod
+    def from_table(cls, spots, features):
+        """Rebuild the index from a local maxima table, see ``table``.
+
+        Parameters
+        ----------
+        spots : np.ndarray
+            Spot coordinates with shape (nb_spots, ndim).
+        features : pd.DataFrame
+            Table with 'threshold_value' and 'intensity_LoG' columns.
+
+        Returns
+        -------
+        index : ThresholdIndex
+        """
+        return cls(np.asarray(spots).astype(np.int64, copy=False),
+                   np.asarray(features['threshold_value']), np.asarray(features['intensity_LoG']))
+
+    def table(self):
+        """Return the local maxima as a table, one row per spot.
+
+        Returns
+        -------
+        features : pd.DataFrame
+            'intensity_LoG' and 'threshold_value' of each spot, in the order
+            of ``spots``. With ``spots``, enough to rebuild the index, unless
+            it falls back to bigfish.
+        """
+        return pd.DataFrame({ 'intensity_LoG': self.intensities, 'threshold_value': self.values })
+
+    def render(self, shape):
+        """Return a mask with the spots set, e.g. to display the local maxima.
+
+        Plateaus are rendered as their centroid.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            Shape of the LoG filtered image.
+
+        Returns
+        -------
+        mask : np.ndarray, bool
+        """
+        mask = np.zeros(shape, dtype=bool)
+        mask[tuple(self.spots.T)] = True
+        return mask
+
+    def threshold(self, threshold):
+        """Return the spots with a LoG intensity strictly above ``threshold``.
+
+        Parameters
+        ----------
+        threshold : float or int
+
+        Returns
+        -------
+        spots : np.ndarray, np.int64
+            Spot coordinates with shape (nb_spots, ndim), in raster order.
+        intensities : np.ndarray
+            LoG intensity at each spot.
+        """
+        if self._image is not None:
+            spots, _ = detection.spots_thresholding(self._image, self._mask, threshold)
+            return spots, self._image[tuple(spots.T)]
+
+        start = np.searchsorted(self._sorted_values, threshold, side='right')
+        selected = np.sort(self._by_value[start:])
+        return self.spots[selected], self.intensities[selected]
+
+    def counts(self, thresholds):
+        """Return the number of spots kept by each of many thresholds at once.
+
+        Parameters
+        ----------
+        thresholds : np.ndarray
+            Thresholds with shape (nb_thresholds,).
+
+        Returns
+        -------
+        counts : np.ndarray, np.int64
+            Number of spots strictly above each threshold.
+        """
+        return len(self) - np.searchsorted(self._sorted_values, thresholds, side='right').astype(np.int64)
+
+
+class SliceIndex:
+    """Spots sorted by z, to select those of a z-slab in O(log n).
+
+    Parameters
+    ----------
+    spots : np.ndarray
+        Spot coordinates with shape (nb_spots, ndim), z first.
+    """
+
+    def __init__(self, spots):
+        z = np.asarray(spots)[:, 0]
+        self._by_z = np.argsort(z, kind='stable')
+        self._sorted_z = z[self._by_z]
+
+    def __len__(self):
+        return len(self._by_z)
+
+    def select(self, start, stop):
+        """Return the indices of the spots with ``start <= z <= stop``.
+
+        Parameters
+        ----------
+        start, stop : float
+
+        Returns
+        -------
+        indices : np.ndarray
+            Indices into ``spots``, in increasing order.
+        """
+        lo = np.searchsorted(self._sorted_z, start, side='left')
+        hi = np.searchsorted(self._sorted_z, stop, side='right')
+        return np.sort(self._by_z[lo:hi])
+
+
+def spot_density(spots, shape, bin_size):
+    """Count spots in square YX bins, over all z-planes.
+
+    Parameters
+    ----------
+    spots : np.ndarray
+        Spot coordinates with shape (nb_spots, ndim), y and x last.
+    shape : tuple of int
+        (y, x) size of the image the spots were detected in.
+    bin_size : int
+        Side of a bin in pixels.
+
+    Returns
+    -------
+    density : np.ndarray, np.float32
+        Number of spots of each bin, with shape ceil(shape / bin_size).
+    """
+    bins = tuple(-(-n // bin_size) for n in shape)
+    yx = np.asarray(spots)[:, -2:].astype(np.intp) // bin_size
+    yx = np.clip(yx, 0, np.array(bins) - 1)
+    counts = np.bincount(yx[:, 0] * bins[1] + yx[:, 1], minlength=bins[0] * bins[1])
+    return counts.reshape(bins).astype(np.float32)
+
+
+def sample_at(image, spots, dtype=None):
+    """Return the values of ``image`` at the spot coordinates.
+
+    Spots and image may have different dimensions: the last ``image.ndim``
+    coordinates are used, so (z, y, x) spots can be looked up in a 2-d
+    (y, x) mask as well as in a 3-d one.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Image with shape (z, y, x) or (y, x).
+    spots : np.ndarray
+        Spot coordinates with shape (nb_spots, ndim). Float coordinates are
+        truncated.
+    dtype : dtype or None
+        dtype of the result, by default that of ``image``.
+
+    Returns
+    -------
+    values : np.ndarray
+        Array of shape (nb_spots,).
+    """
+    spots = np.asarray(spots)
+    if image.ndim > spots.shape[1]:
+        raise ValueError(f"Cannot look up {spots.shape[1]}-d spots in a {image.ndim}-d image.")
+    coordinates = spots[:, spots.shape[1] - image.ndim:].astype(np.intp, copy=False)
+    values = np.asarray(image)[tuple(coordinates.T)]
+    if dtype is not None:
+        values = values.astype(dtype, copy=False)
+    return values
+
+
+def in_cell(labels, dtype=np.int64):
+    """Return 1 (or True) for spots with a non-zero cell label, 0 otherwise."""
+    return (np.asarray(labels) != 0).astype(dtype)
+
+
+def cell_labels(cell_masks, spots, dtype=np.int64):
+    """Return the cell label of every spot and whether it is in a cell.
+
+    Parameters
+    ----------
+    cell_masks : np.ndarray
+        Labels with shape (z, y, x) or (y, x).
+    spots : np.ndarray
+        Spot coordinates with shape (nb_spots, ndim).
+    dtype : dtype
+        dtype of both results.
+
+    Returns
+    -------
+    labels, in_cell : np.ndarray
+        Arrays of shape (nb_spots,).
+    """
+    labels = sample_at(cell_masks, spots, dtype=dtype)
+    return labels, in_cell(labels, dtype=dtype)
+
+
+def spot_features(spots, log_intensities=None, cell_masks=None, dtype=None, label_dtype=np.int64):
+    """Build the features table of a points layer.
+
+    Parameters
+    ----------
+    spots : np.ndarray
+        Spot coordinates with shape (nb_spots, 3).
+    log_intensities : np.ndarray or None
+        LoG intensity of every spot, added as the 'intensity_LoG' column.
+    cell_masks : np.ndarray or None
+        Cell labels. If None, 'label' is -1 and 'in_cell' is 1 for all spots.
+    dtype : dtype or None
+        dtype of the coordinate and intensity columns. By default the common
+        dtype of ``spots`` and ``log_intensities``.
+    label_dtype : dtype
+        dtype of the 'label' and 'in_cell' columns.
+
+    Returns
+    -------
+    features : pd.DataFrame
+        Columns 'z', 'y', 'x', ['intensity_LoG',] 'label', 'in_cell'.
+    """
+    spots = np.asarray(spots)
+    if dtype is None:
+        dtype = spots.dtype if log_intensities is None else np.result_type(spots, log_intensities)
+
+    columns = { axis: spots[:, i].astype(dtype) for i, axis in enumerate(['z', 'y', 'x']) }
+    if log_intensities is not None:
+        columns['intensity_LoG'] = np.asarray(log_intensities).astype(dtype)
+
+    if cell_masks is None:
+        columns['label'] = np.full(len(spots), -1, dtype=label_dtype)
+        columns['in_cell'] = np.ones(len(spots), dtype=label_dtype)
+    else:
+        columns['label'], columns['in_cell'] = cell_labels(cell_masks, spots, dtype=label_dtype)
+
+    return pd.DataFrame(columns)
+
+
+def cell_statistics(cell_masks, spots_by_layer):
+    """Count spots and sum their intensities per cell.
+
+    Every aggregation is a ``np.bincount`` over the cell labels, so the cost
+    is linear in the number of pixels and spots, whatever the number of
+    cells.
+
+    Parameters
+    ----------
+    cell_masks : np.ndarray
+        Labels with shape (z, y, x) or (y, x), 0 for the background.
+    spots_by_layer : dict
+        (spots, intensities) of each spots layer, by name. ``intensities``
+        is an array of shape (nb_spots,), or None to only count spots.
+
+    Returns
+    -------
+    statistics : pd.DataFrame
+        One row per cell label present in ``cell_masks``, with columns
+        'label', 'area' (in pixels), and '<name> nb_spots' and
+        '<name> intensity_sum' for every spots layer.
+    """
+    cell_masks = np.asarray(cell_masks)
+    areas = np.bincount(cell_masks.ravel())
+    labels = np.flatnonzero(areas[1:]) + 1
+
+    columns = { 'label': labels, 'area': areas[labels] }
+    for name, (spots, intensities) in spots_by_layer.items():
+        spot_labels = sample_at(cell_masks, spots, dtype=np.intp)
+        columns[f'{name} nb_spots'] = np.bincount(spot_labels, minlength=len(areas))[labels]
+        if intensities is not None:
+            columns[f'{name} intensity_sum'] = np.bincount(
+                spot_labels, weights=intensities, minlength=len(areas))[labels]
+
+    return pd.DataFrame(columns)
+
+
+def candidate_thresholds(max_value):
+    """Thresholds tested by ``bigfish.detection.automated_threshold_setting``.
+
+    bigfish tests every integer from 0 to the 99.9999th percentile of the
+    LoG filtered image, or 100 evenly spaced thresholds if it is below 100.
+    The spot count curve is cut where fewer than e^2 spots remain, so ending
+    the integer grid at the largest local maximum instead gives the same
+    curve. Below 100, the spacing of the thresholds, hence the elbow, may
+    differ slightly from bigfish's.
+
+    Parameters
+    ----------
+    max_value : float
+        Largest threshold.
+
+    Returns
+    -------
+    thresholds : np.ndarray, np.float64
+    """
+    end = int(max_value)
+    if end < 100:
+        return np.linspace(0, end, num=100)
+    return np.arange(end + 1, dtype=np.float64)
+
+
+def elbow_threshold(thresholds, counts):
+    """Select the threshold at the elbow of a spot count curve, as bigfish does.
+
+    The log of the counts is smoothed by a centered moving average and cut
+    where it drops below 2, and the threshold is bigfish's breaking point of
+    the remaining curve.
+
+    Parameters
+    ----------
+    thresholds : np.ndarray
+        Increasing thresholds.
+    counts : np.ndarray
+        Number of spots above each threshold.
+
+    Returns
+    -------
+    threshold : float or None
+        None if too few spots are detected for the curve to have an elbow.
+    """
+    if len(counts) < 2:
+        return None
+    # a count of 0 gives -inf, and nan after smoothing, both cut below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_counts = stack.centered_moving_average(np.log(np.asarray(counts, dtype=np.float64)), n=5)
+    log_counts = log_counts[log_counts > 2]
+    if len(log_counts) < 2:
+        return None
+    try:
+        threshold, _, _ = detection.get_breaking_point(np.asarray(thresholds[:len(log_counts)], dtype=np.float64),
+                                                       log_counts)
+    except ValueError:
+        # the curve only decreases faster than its mean slope: no plateau
+        return None
+    return threshold
+
+
+def threshold_sweep(indices, thresholds=None):
+    """Spot count curves of several channels or images, and their elbows.
+
+    Every curve is one binary search of all the thresholds in the sorted
+    local maxima values, so a sweep costs about as much as a single
+    thresholding.
+
+    Parameters
+    ----------
+    indices : dict
+        ThresholdIndex of each channel or image, by name.
+    thresholds : np.ndarray or None
+        Thresholds shared by all the curves. By default, bigfish's candidate
+        thresholds up to the largest local maximum of all the indices.
+
+    Returns
+    -------
+    curves : pd.DataFrame
+        Number of spots above each threshold (the index), one column per name.
+    elbows : dict
+        Automatic threshold of each name, see ``elbow_threshold``.
+    """
+    if thresholds is None:
+        max_value = max([ index.max_value for index in indices.values() if len(index) ] or [0])
+        thresholds = candidate_thresholds(max_value)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    curves = pd.DataFrame({ name: index.counts(thresholds) for name, index in indices.items() },
+                          index=pd.Index(thresholds, name='threshold'))
+    elbows = { name: elbow_threshold(thresholds, curves[name].to_numpy()) for name in curves }
+    return curves, elbows
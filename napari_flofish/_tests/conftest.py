@@ -0,0 +1,12 @@
+import pytest
+
+from napari_flofish import _cache
+
+
+@pytest.fixture(autouse=True)
+def stage_cache(tmp_path, monkeypatch):
+    # a cache of its own for every test: results of earlier runs in the
+    # user's cache directory would skip the computations under test
+    cache = _cache.StageCache(tmp_path / 'stage-cache')
+    monkeypatch.setattr(_cache, '_cache', cache)
+    return cache
@@ -0,0 +1,19 @@
+from napari_flofish._batch import find_images, image_name
+
+
+def test_find_images(tmp_path):
+    for name in [
+        "MG1655_GLU_OD_0.3_left_CY5, CY3.5 NAR, CY3, DAPI_02.vsi",
+        "MG1655_GLU_OD_0.3_left_DIC_02.tif",
+        "MG1655_GLU_OD_0.3_left_CY5, CY3.5 NAR, CY3, DAPI_03.vsi",
+        "MG1655_GLU_OD_0.3_left_DIC_03.tif",
+        "MG1655_GLU_OD_0.3_right_DIC_01.tif",
+    ]:
+        (tmp_path / name).touch()
+
+    images = find_images(tmp_path, "config.json")
+    assert [ image_name(image['cell_file']) for image in images ] == [
+        "MG1655_GLU_OD_0.3_left_02", "MG1655_GLU_OD_0.3_left_03"
+    ]
+    assert images[0]['vsi_file'].endswith("DAPI_02.vsi")
+    assert images[0]['cfg_file'] == "config.json"
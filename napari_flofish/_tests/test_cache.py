@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from napari_flofish._cache import StageCache
+from napari_flofish._spots import ThresholdIndex
+
+
+@pytest.fixture
+def image():
+    return np.random.default_rng(0).integers(0, 1000, (4, 32, 32)).astype(np.uint16)
+
+
+def test_key(image, tmp_path):
+    cache = StageCache(tmp_path)
+    assert cache.key('stage', image, (1, 2)) == cache.key('stage', image.copy(), (1, 2))
+    assert cache.key('stage', image, (1, 2)) != cache.key('stage', image, (1, 3))
+    assert cache.key('stage', image, (1, 2)) != cache.key('other', image, (1, 2))
+    assert cache.key('stage', image) != cache.key('stage', image.astype(np.int32))
+    assert cache.key('stage', image) != cache.key('stage', image.reshape(8, 16, 32))
+
+
+def test_cached(image, tmp_path):
+    calls = []
+
+    def stage(image, sigma):
+        calls.append(sigma)
+        return image * sigma, { 'sigma': sigma }
+
+    cache = StageCache(tmp_path)
+    result = cache.cached('stage', stage, image, 2)
+    assert cache.cached('stage', stage, image.copy(), 2) is result
+    assert calls == [2]
+
+    # a new cache on the same directory reads the results from disk
+    cache = StageCache(tmp_path)
+    array, metadata = cache.cached('stage', stage, image, 2)
+    assert calls == [2]
+    assert isinstance(array, np.memmap)
+    np.testing.assert_array_equal(array, image * 2)
+    assert metadata == { 'sigma': 2 }
+    # writing to a disk hit leaves the cached file unchanged
+    array[0] = 0
+    np.testing.assert_array_equal(StageCache(tmp_path).cached('stage', stage, image, 2)[0], image * 2)
+
+    cache.cached('stage', stage, image, 3)
+    assert calls == [2, 3]
+
+
+def test_eviction(image, tmp_path):
+    cache = StageCache(tmp_path, max_bytes=int(2.5 * image.nbytes), memory_bytes=0)
+    for i in range(4):
+        cache.put(str(i), image + i)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['2', '3']
+    np.testing.assert_array_equal(StageCache(tmp_path).get('3'), image + 3)
+    assert StageCache(tmp_path).get('0') is None
+
+
+def test_memory_only(image):
+    cache = StageCache(None)
+    cache.put('key', image)
+    assert cache.get('key') is image
+    assert cache.get('other') is None
+
+
+def test_disabled(image):
+    cache = StageCache(None, memory_bytes=0)
+    assert not cache.enabled and cache.key('stage', image) is None
+    calls = []
+    cache.cached('stage', lambda image: calls.append(1) or image, image)
+    cache.cached('stage', lambda image: calls.append(1) or image, image)
+    assert calls == [1, 1] and cache._digests == {}
+
+
+def test_removed_entry(image, tmp_path):
+    # another process evicting an entry while it is read
+    cache = StageCache(tmp_path, memory_bytes=0)
+    cache.put('key', image)
+    (tmp_path / 'key' / '0.npy').unlink()
+    assert StageCache(tmp_path).get('key') is None
+    (tmp_path / 'key' / 'value.pkl').unlink()
+    assert StageCache(tmp_path).get('key') is None
+
+
+def test_memory_size(image):
+    index = ThresholdIndex.from_local_maxima(image.astype(np.float32), image > 900)
+    assert index.nbytes >= index.spots.nbytes + index.values.nbytes
+    cache = StageCache(None, memory_bytes=index.nbytes + image.nbytes)
+    cache.put('index', index)
+    cache.put('image', image)
+    assert cache.get('index') is index and cache._memory_size == index.nbytes + image.nbytes
+    # the least recently used go first
+    cache.put('other', image + 1)
+    assert cache.get('image') is None and cache.get('index') is index
+    assert cache._memory_size == index.nbytes + image.nbytes
+
+
+def test_modified_in_place(image):
+    cache = StageCache(None)
+    key = cache.key('stage', image)
+    image[0, 0, 0] += 1
+    assert cache.key('stage', image) != key
+    # read-only arrays are hashed once
+    image.flags.writeable = False
+    assert cache.key('stage', image) == cache.key('stage', image) and id(image) in cache._digests
+
+
+def test_larger_than_memory(image):
+    cache = StageCache(None, memory_bytes=2 * image.nbytes)
+    cache.put('small', image[:2])
+    cache.put('large', np.concatenate([image, image, image]))
+    assert cache.get('large') is None and cache.get('small') is not None
+
+
+def test_corrupt_entry(image, tmp_path):
+    cache = StageCache(tmp_path, memory_bytes=0)
+    cache.put('key', image)
+    (tmp_path / 'key' / 'value.pkl').write_bytes(b'\x80\x04truncated')
+    assert StageCache(tmp_path).get('key') is None
+    assert not (tmp_path / 'key').exists()
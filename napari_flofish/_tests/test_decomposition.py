@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from bigfish import detection
+from scipy import ndimage as ndi
+
+from napari_flofish import _decomposition
+from napari_flofish._decomposition import decompose_dense
+
+
+@pytest.fixture
+def rna_spots():
+    # crowded diffraction-limited spots on a Poisson background
+    rng = np.random.default_rng(0)
+    shape = (20, 96, 96)
+    spots = np.unique(rng.integers(0, shape, (800, 3)), axis=0)
+    signal = np.zeros(shape, dtype=np.float32)
+    np.add.at(signal, tuple(spots.T), rng.uniform(2000, 6000, len(spots)).astype(np.float32))
+    ndi.gaussian_filter(signal, sigma=(4, 1.85, 1.85), output=signal)
+    rna = rng.poisson(100, shape) + signal
+    return np.clip(rna, 0, 65535).astype(np.uint16), spots
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+def test_decompose_dense(rna_spots, ndim, monkeypatch):
+    rna, spots = rna_spots
+    monkeypatch.setattr(_decomposition, 'MIN_PARALLEL_REGIONS', 0)
+    if ndim == 2:
+        rna, spots = rna[10], np.unique(spots[:, 1:], axis=0)
+    voxel_size, spot_radius = (200, 65, 65)[-ndim:], (800, 120, 120)[-ndim:]
+
+    # bigfish picks the spots of the reference spot at random
+    np.random.seed(0)
+    expected = detection.decompose_dense(rna, spots, voxel_size, spot_radius, alpha=0.5, beta=2, gamma=1)
+    np.random.seed(0)
+    result = decompose_dense(rna, spots, voxel_size, spot_radius, alpha=0.5, beta=2, gamma=1, max_workers=2)
+
+    assert len(expected[1]) > 2
+    for r, e in zip(result, expected):
+        assert r.dtype == e.dtype
+        np.testing.assert_array_equal(r, e)
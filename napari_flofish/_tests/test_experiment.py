@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import pytest
+from skimage import io
+
+from napari_flofish import napari_get_reader
+from napari_flofish._experiment import (
+    FovCache,
+    find_fovs,
+    fit,
+    read_experiment,
+)
+
+NB_FOVS = 4
+
+
+def write_fov(directory, seed, shape=(5, 16, 16), dic=True):
+    rng = np.random.default_rng(seed)
+    directory.mkdir(parents=True)
+    img = { 'results': { 'rpoD': { 'colormap': 'green', 'threshold': 10 + seed } },
+            'parameters': { 'scale': [200, 65, 65], 'spot_radius': [300, 150, 150] } }
+    (directory / 'img.json').write_text(json.dumps(img))
+    if dic:
+        io.imsave(directory / 'DIC.tif', rng.integers(0, 1000, shape[1:], dtype=np.uint16), check_contrast=False)
+    io.imsave(directory / 'rpoD.tif', rng.integers(0, 1000, shape, dtype=np.uint16), check_contrast=False)
+    np.save(directory / 'rpoD_filtered.npy', rng.integers(0, 1000, shape, dtype=np.uint16))
+    spots = np.column_stack([ rng.integers(0, 5, (3, 3)), rng.random((3, 2)), [0, 1, 2] ])
+    np.save(directory / 'rpoD_spots.npy', spots)
+
+
+@pytest.fixture
+def experiment(tmp_path):
+    output = tmp_path / 'output'
+    for fov in range(NB_FOVS):
+        write_fov(output / f'fov_{fov:02d}', fov)
+    return output
+
+
+def layers_by_name(layer_tuples):
+    return { t[1]['name']: t for t in layer_tuples }
+
+
+def test_find_fovs(experiment):
+    files = find_fovs(experiment)
+    assert [ f.parent.name for f in files ] == [ f'fov_{fov:02d}' for fov in range(NB_FOVS) ]
+    # only the FOV directories are searched, not the whole tree
+    write_fov(experiment / 'fov_00' / 'backup' / 'fov_00', 0)
+    assert find_fovs(experiment) == files
+
+
+def test_get_reader_experiment(experiment, tmp_path):
+    assert napari_get_reader(str(experiment)).__name__ == 'read_experiment'
+    assert napari_get_reader([ str(f) for f in find_fovs(experiment) ]).__name__ == 'read_experiment'
+    (tmp_path / 'empty').mkdir()
+    assert napari_get_reader(str(tmp_path / 'empty')) is None
+
+
+def test_read_experiment(experiment):
+    layers = layers_by_name(read_experiment(experiment))
+
+    stack, add_kwargs, layer_type = layers['rpoD']
+    assert layer_type == 'image' and stack.shape == (NB_FOVS, 5, 16, 16)
+    assert stack.chunks[0] == (1,) * NB_FOVS
+    assert len(add_kwargs['metadata']['fovs']) == NB_FOVS
+    for fov in range(NB_FOVS):
+        assert np.array_equal(stack[fov].compute(), io.imread(experiment / f'fov_{fov:02d}' / 'rpoD.tif'))
+
+    # 2D layers get a single z-plane spanning the stacks
+    dic, add_kwargs, _ = layers['DIC']
+    assert dic.shape == (NB_FOVS, 1, 16, 16)
+    assert add_kwargs['scale'][1] == 5
+
+    # thresholds differ between FOVs
+    spots, add_kwargs, layer_type = layers['rpoD spots detected']
+    assert layer_type == 'points' and spots.shape == (3 * NB_FOVS, 4)
+    assert np.array_equal(np.unique(spots[:, 0]), np.arange(NB_FOVS))
+    assert np.array_equal(add_kwargs['features']['fov'], spots[:, 0])
+
+
+def test_read_experiment_mismatched_fovs(tmp_path):
+    write_fov(tmp_path / 'fov_0', 0)
+    write_fov(tmp_path / 'fov_1', 1, shape=(6, 20, 12), dic=False)
+    layers = layers_by_name(read_experiment(tmp_path))
+
+    stack = layers['rpoD'][0].compute()
+    assert stack.shape == (2, 5, 16, 16)
+    expected = io.imread(tmp_path / 'fov_1' / 'rpoD.tif')
+    assert np.array_equal(stack[1, :, :, :12], expected[:5, :16])
+    assert not stack[1, :, :, 12:].any()
+    # a missing file is an empty FOV
+    assert not layers['DIC'][0][1].compute().any()
+
+
+def test_fit():
+    data = np.ones((2, 3), dtype=np.uint8)
+    assert fit(data, (2, 3), np.uint8) is data
+    assert fit(data, (3, 2), np.uint8).sum() == 4
+    assert not fit(None, (3, 2), np.uint8).any()
+    assert not fit(np.ones(3), (3, 2), np.uint8).any()
+
+
+def test_fov_cache_prefetch():
+    loads = []
+
+    def load(fov, file):
+        loads.append(fov)
+        return np.full(2, fov)
+
+    cache = FovCache(load, 10, prefetch=2, max_items=4)
+    assert cache.get(5, 'a')[0] == 5
+    with cache._lock:
+        pending = list(cache._pending.values())
+    wait(pending)
+    assert sorted(loads) == [3, 4, 5, 6, 7]
+    # neighbours are served from the cache
+    assert cache.get(6, 'a')[0] == 6
+    assert loads.count(6) == 1
+    # only the most recently used are kept
+    assert len(cache._items) == 4 and (6, 'a') in cache
+    # closed: reads started before finish, no more are started
+    cache.close()
+    wait(list(cache._pending.values()))
+    assert cache.get(0, 'a')[0] == 0 and not cache._pending
+
+
+def test_fov_cache_concurrent_get():
+    loads = []
+    started = threading.Event()
+
+    def load(fov, file):
+        loads.append(fov)
+        started.set()
+        time.sleep(0.2)
+        return np.full(2, fov)
+
+    cache = FovCache(load, 1, prefetch=0)
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(cache.get, 0, 'a')
+        started.wait()
+        second = executor.submit(cache.get, 0, 'a')
+        assert first.result() is second.result()
+    assert loads == [0]
+    cache.close()
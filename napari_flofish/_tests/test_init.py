@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+import napari_flofish
+
+# imported by the widgets and the reader only
+HEAVY_MODULES = ['flofish', 'bigfish', 'pandas', 'skimage', 'appdirs', 'napari_flofish._widget']
+
+
+def test_lazy_import():
+    # in a fresh interpreter: this one has already imported everything
+    code = ("import sys, napari_flofish; "
+            f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ''
+
+
+def test_exports():
+    for name in napari_flofish.__all__:
+        assert callable(getattr(napari_flofish, name))
+    assert set(napari_flofish.__all__) <= set(dir(napari_flofish))
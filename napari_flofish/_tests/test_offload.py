@@ -0,0 +1,74 @@
+import mmap
+import os
+
+import numpy as np
+import pytest
+from bigfish import stack
+
+from napari_flofish import _offload
+from napari_flofish._offload import (
+    SHARED_MIN_BYTES,
+    log_local_maxima,
+    offload,
+    receive,
+    share,
+    shared_directory,
+)
+
+
+@pytest.fixture(scope="module")
+def pool():
+    yield _offload.get_pool(max_workers=2)
+    _offload.shutdown()
+
+
+@pytest.fixture
+def rna():
+    rng = np.random.default_rng(0)
+    rna = rng.poisson(5, (10, 128, 128)).astype(np.uint16)
+    rna[3:5, 10:12, 10:13] = 100
+    return rna
+
+
+def test_share_receive():
+    data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+    shared, owned = share(data)
+    assert owned and os.path.dirname(shared.path) == str(shared_directory())
+    received = receive(shared)
+    assert np.array_equal(received, data) and received.dtype == data.dtype
+    assert isinstance(received.base, mmap.mmap) and not isinstance(received, np.memmap)
+    assert not os.path.exists(shared.path)
+
+
+def test_share_mapped_file(tmp_path):
+    data = np.arange(24, dtype=np.uint16).reshape((2, 3, 4))
+    np.save(tmp_path / 'data.npy', data)
+    mapped = np.load(tmp_path / 'data.npy', mmap_mode='r')
+    shared, owned = share(mapped)
+    assert not owned and shared.path == str(tmp_path / 'data.npy')
+    assert np.array_equal(shared.open(), data)
+    # a slice is not the whole mapping: copied
+    copied, owned = share(mapped[1:])
+    assert owned
+    os.unlink(copied.path)
+
+
+def test_offload(pool):
+    data = np.arange(SHARED_MIN_BYTES // 8 + 1, dtype=np.float64)
+    result = offload(np.cumsum, data)
+    assert np.array_equal(result, np.cumsum(data))
+    assert isinstance(result.base, mmap.mmap)
+    # inputs and results were unlinked
+    assert os.listdir(shared_directory()) == []
+    assert offload(np.sum, data[:10]) == np.sum(data[:10])
+
+
+def test_offload_log_local_maxima(pool, rna):
+    spot_radius_px = (1, 1.5, 1.5)
+    index, rna_log = offload(log_local_maxima, rna, spot_radius_px, 0, True)
+    expected, expected_log = log_local_maxima(rna, spot_radius_px, keep_log=True)
+    assert np.array_equal(rna_log, expected_log)
+    assert np.array_equal(rna_log, stack.log_filter(rna, sigma=spot_radius_px))
+    for threshold in [0, 5, 50]:
+        for actual, wanted in zip(index.threshold(threshold), expected.threshold(threshold)):
+            assert np.array_equal(actual, wanted)
@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+import pytest
+
+from napari_flofish import _profiling
+from napari_flofish._profiling import profiled, stage, start_profile
+
+
+def stages(n):
+    yield 'allocate'
+    data = np.ones(n)
+    yield 'sum'
+    total = data.sum()
+    return [(data, { 'name': 'data', 'metadata': { 'total': total } }, 'image'), (data, { 'name': 'other' }, 'image')]
+
+
+def run(generator):
+    while True:
+        try:
+            next(generator)
+        except StopIteration as result:
+            return result.value
+
+
+@pytest.fixture
+def profiling(tmp_path):
+    log_file = tmp_path / 'profile.jsonl'
+    _profiling.enable(log_file)
+    yield log_file
+    _profiling.disable()
+
+
+def test_disabled():
+    assert profiled(stages) is stages
+    assert start_profile('run') is None
+    with stage(None, 'stage'):
+        pass
+
+
+def test_profiled(profiling):
+    layers = run(profiled(stages)(1_000_000))
+
+    summary = layers[0][1]['metadata']['profile']
+    assert layers[1][1]['metadata']['profile'] is summary
+    assert layers[0][1]['metadata']['total'] == 1_000_000
+    assert summary['run'] == 'stages'
+    assert [ s['stage'] for s in summary['stages'] ] == ['allocate', 'sum']
+    assert all(s['wall'] >= 0 and s['cpu'] >= 0 for s in summary['stages'])
+    assert summary['stages'][0]['peak_memory'] >= 8_000_000
+
+    run(profiled(stages)(10))
+    lines = [ json.loads(line) for line in profiling.read_text().splitlines() ]
+    assert len(lines) == 2
+    assert lines[0]['stages'] == summary['stages']
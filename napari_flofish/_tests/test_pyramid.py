@@ -0,0 +1,71 @@
+import dask.array as da
+import numpy as np
+from skimage import io
+
+from napari_flofish._pyramid import (
+    PYRAMID_DIRECTORY,
+    cached_pyramid,
+    nb_levels,
+    pyramid,
+)
+from napari_flofish._reader import read_layer
+
+
+def test_nb_levels():
+    assert nb_levels((10, 500, 2000)) == 1
+    assert nb_levels((10, 1024, 2048)) == 2
+    assert nb_levels((2048, 4096)) == 3
+    assert nb_levels((8, 64, 64), min_size=16) == 3
+
+
+def test_pyramid():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 1000, (3, 65, 64)).astype(np.uint16)
+    labels = np.kron(np.arange(16, dtype=np.int32).reshape(4, 4), np.ones((16, 16), dtype=np.int32))
+
+    levels = pyramid(image, 'image', min_size=16)
+    assert [ level.shape for level in levels ] == [(3, 65, 64), (3, 32, 32), (3, 16, 16)]
+    assert levels[0] is image
+    expected = np.round(image[:, :64].reshape(3, 32, 2, 32, 2).mean(axis=(2, 4))).astype(np.uint16)
+    np.testing.assert_array_equal(levels[1].compute(), expected)
+
+    label_levels = pyramid(labels, 'labels', min_size=16)
+    assert len(label_levels) == 3
+    assert label_levels[2].dtype == np.int32
+    assert set(np.unique(label_levels[2].compute())) == set(range(16))
+
+
+def test_cached_pyramid(tmp_path):
+    image = np.arange(2 * 64 * 64, dtype=np.uint16).reshape(2, 64, 64)
+    file = tmp_path / 'rpoD.tif'
+    io.imsave(file, image, check_contrast=False)
+
+    levels = cached_pyramid(file, image, 'image', min_size=16)
+    store = tmp_path / PYRAMID_DIRECTORY / 'rpoD.tif.zarr'
+    assert store.is_dir()
+    assert isinstance(levels[1], da.Array) and len(levels) == 3
+
+    # read back from the store
+    again = cached_pyramid(file, image, 'image', min_size=16)
+    for level, expected in zip(again[1:], pyramid(image, 'image', min_size=16)[1:]):
+        np.testing.assert_array_equal(level.compute(), expected.compute())
+
+    # a changed file is rebuilt
+    io.imsave(file, image[::-1], check_contrast=False)
+    changed = cached_pyramid(file, image[::-1], 'image', min_size=16)
+    np.testing.assert_array_equal(changed[2].compute(), pyramid(image[::-1], 'image', min_size=16)[2].compute())
+
+
+def test_read_layer_multiscale(tmp_path, monkeypatch):
+    monkeypatch.setattr('napari_flofish._pyramid.MIN_LEVEL_SIZE', 16)
+    masks = np.kron(np.arange(16, dtype=np.uint16).reshape(4, 4), np.ones((16, 16), dtype=np.uint16))
+    io.imsave(tmp_path / 'DIC_masks_pp.tif', masks, check_contrast=False)
+    entry = { 'file': 'DIC_masks_pp.tif', 'layer_type': 'labels', 'add_kwargs': { 'name': 'DIC masks' } }
+
+    data, add_kwargs, layer_type = read_layer(tmp_path, entry, lazy=True, multiscale=True)
+    assert layer_type == 'labels' and add_kwargs['multiscale']
+    assert [ level.shape for level in data ] == [(64, 64), (32, 32), (16, 16)]
+    np.testing.assert_array_equal(np.asarray(data[0]), masks)
+
+    data, add_kwargs, _ = read_layer(tmp_path, entry, lazy=True)
+    assert data.shape == (64, 64) and 'multiscale' not in add_kwargs
@@ -1,4 +1,8 @@
+import numpy as np
+from skimage import io
+
 from napari_flofish import napari_get_reader
+from napari_flofish._reader import imread_lazy, read_smfish_json
 
 
 def test_reader(make_napari_viewer):
@@ -20,3 +24,31 @@ def test_reader(make_napari_viewer):
 def test_get_reader_pass():
     reader = napari_get_reader("fake.file")
     assert reader is None
+
+
+def test_reader_lazy():
+    my_test_file = 'napari_flofish/_tests/data/exp16/output/MG1655_GLU_OD_0.3_left_02/img.json'
+    eager = read_smfish_json(my_test_file, lazy=False)
+    lazy = read_smfish_json(my_test_file, lazy=True)
+    assert [layer[1]['name'] for layer in lazy] == [layer[1]['name'] for layer in eager]
+    for (lazy_data, _, _), (data, _, _) in zip(lazy, eager):
+        assert lazy_data.shape == data.shape
+        assert np.array_equal(np.asarray(lazy_data), data)
+
+
+def test_imread_lazy(tmp_path):
+    data = np.arange(6 * 8 * 8, dtype=np.uint16).reshape((6, 8, 8))
+    io.imsave(tmp_path / 'stack.tif', data, check_contrast=False)
+    lazy_data = imread_lazy(tmp_path / 'stack.tif')
+    assert lazy_data.chunks[0] == (1,) * 6
+    assert np.array_equal(lazy_data.compute(), data)
+
+
+def test_reader_parallel():
+    my_test_file = 'napari_flofish/_tests/data/exp16/output/MG1655_GLU_OD_0.3_left_02/img.json'
+    serial = read_smfish_json(my_test_file, max_workers=1)
+    parallel = read_smfish_json(my_test_file, max_workers=8)
+    assert [layer[1]['name'] for layer in parallel] == [layer[1]['name'] for layer in serial]
+    for (data, _, layer_type), (serial_data, _, serial_layer_type) in zip(parallel, serial):
+        assert layer_type == serial_layer_type
+        assert np.array_equal(data, serial_data)
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from napari_flofish._roi import (
+    in_box,
+    labels_box,
+    merge_index,
+    merge_spots,
+    shapes_box,
+    shift_spots,
+    with_halo,
+)
+from napari_flofish._spots import ThresholdIndex
+
+
+def test_boxes():
+    shapes = [ np.array([[3, 10.5, 20], [3, 30, 40.2]]), np.array([[25, 5], [26, 6]]) ]
+    assert shapes_box(shapes, (5, 64, 64)) == (10, 31, 5, 42)
+    assert shapes_box([], (5, 64, 64)) is None
+    assert with_halo((10, 31, 5, 42), 8, (5, 64, 40)) == (2, 39, 0, 40)
+
+    masks = np.zeros((64, 64), dtype=np.uint16)
+    masks[5:10, 20:30] = 2
+    masks[40:50, 1:4] = 7
+    assert labels_box(masks, [2]) == (5, 10, 20, 30)
+    assert labels_box(masks, [2, 7]) == (5, 50, 1, 30)
+    assert labels_box(masks, [3, 100]) is None
+
+
+def test_merge_spots():
+    spots = np.array([[0, 1, 1], [0, 5, 5], [1, 9, 9]])
+    features = pd.DataFrame({ 'y': spots[:, 1], 'x': spots[:, 2], 'label': [1, 2, 3] })
+    # found in the crop (4, 12, 4, 12): one in the box (4, 8, 4, 8), one in the halo
+    roi_spots = np.array([[0, 2, 2], [1, 6, 6]])
+    roi_features = pd.DataFrame({ 'y': roi_spots[:, 1], 'x': roi_spots[:, 2], 'label': [4, 5] })
+
+    roi_spots, roi_features = shift_spots(roi_spots, roi_features, (4, 12, 4, 12))
+    assert np.array_equal(roi_spots, [[0, 6, 6], [1, 10, 10]])
+    assert roi_features['y'].tolist() == [6, 10]
+
+    merged, merged_features = merge_spots(spots, features, roi_spots, roi_features, (4, 8, 4, 8))
+    assert np.array_equal(merged, [[0, 1, 1], [1, 9, 9], [0, 6, 6]])
+    assert merged_features['label'].tolist() == [1, 3, 4]
+    assert in_box(merged, (4, 8, 4, 8)).tolist() == [False, False, True]
+
+    merged, merged_features = merge_spots(None, None, roi_spots, roi_features, (4, 8, 4, 8))
+    assert np.array_equal(merged, [[0, 6, 6]]) and merged_features['label'].tolist() == [4]
+
+
+def test_merge_index():
+    index = ThresholdIndex(np.array([[0, 1, 1], [0, 5, 5], [1, 9, 9]]), np.array([10, 20, 30]),
+                           np.array([1., 2., 3.]))
+    # found in the crop (4, 12, 4, 12): one in the box (4, 8, 4, 8), one in the halo
+    roi_index = ThresholdIndex(np.array([[0, 2, 2], [1, 6, 6]]), np.array([40, 50]), np.array([4., 5.]))
+
+    merged = merge_index(index, roi_index, (4, 8, 4, 8), (4, 12, 4, 12))
+    assert np.array_equal(merged.spots, [[0, 1, 1], [0, 6, 6], [1, 9, 9]])
+    assert merged.values.tolist() == [10, 40, 30]
+    assert merged.intensities.tolist() == [1., 4., 3.]
+    assert np.array_equal(merged.threshold(35)[0], [[0, 6, 6]])
+
+    merged = merge_index(None, roi_index, (4, 8, 4, 8), (4, 12, 4, 12))
+    assert np.array_equal(merged.spots, [[0, 6, 6]])
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from napari_flofish._reader import read_layer
+from napari_flofish._spot_table import (
+    is_spot_table,
+    read_spot_table,
+    write_spot_table,
+)
+
+
+@pytest.fixture
+def spots():
+    rng = np.random.default_rng(0)
+    coordinates = rng.integers(0, (20, 1024, 1024), (1000, 3))
+    features = {
+        'intensity': rng.random(1000) * 1000,
+        'label': rng.integers(0, 5, 1000),
+    }
+    return coordinates, features
+
+
+def test_write_read_spot_table(tmp_path, spots):
+    coordinates, features = spots
+    write_spot_table(tmp_path / 'rpoD_spots', coordinates, features)
+    assert is_spot_table(tmp_path / 'rpoD_spots')
+
+    table_coordinates, columns = read_spot_table(tmp_path / 'rpoD_spots')
+    assert table_coordinates.dtype == np.int16
+    assert columns['intensity'].dtype == np.float32 and columns['label'].dtype == np.int32
+    order = np.argsort(coordinates[:, 0], kind='stable')
+    assert np.array_equal(table_coordinates, coordinates[order])
+    assert np.array_equal(columns['label'], features['label'][order])
+    assert np.allclose(columns['intensity'], features['intensity'][order])
+
+
+def test_read_spot_table_partial(tmp_path, spots):
+    coordinates, features = spots
+    write_spot_table(tmp_path / 'rpoD_spots', coordinates, features)
+
+    table_coordinates, columns = read_spot_table(tmp_path / 'rpoD_spots', columns=['label'], z_range=(5, 8),
+                                                 lazy=False)
+    assert list(columns) == ['label']
+    in_range = (coordinates[:, 0] >= 5) & (coordinates[:, 0] < 8)
+    assert len(table_coordinates) == np.count_nonzero(in_range)
+    assert np.all((table_coordinates[:, 0] >= 5) & (table_coordinates[:, 0] < 8))
+    assert not isinstance(table_coordinates, np.memmap)
+
+    with pytest.raises(KeyError):
+        read_spot_table(tmp_path / 'rpoD_spots', columns=['area'])
+
+
+def test_spot_table_large_coordinates(tmp_path):
+    write_spot_table(tmp_path / 'spots', np.array([[0, 40000, 2]]))
+    coordinates, columns = read_spot_table(tmp_path / 'spots')
+    assert coordinates.dtype == np.int32 and columns == {}
+
+
+def test_read_layer_spot_table(tmp_path, spots):
+    coordinates, features = spots
+    # the spot table is read in place of the .npy file
+    np.save(tmp_path / 'rpoD_spots.npy', np.zeros((1, 6)))
+    write_spot_table(tmp_path / 'rpoD_spots', coordinates, features)
+    write_spot_table(tmp_path / 'rpoD_decomposed_spots', coordinates[:10], {})
+
+    entry = { 'file': 'rpoD_spots.npy', 'layer_type': 'spots', 'add_kwargs': { 'name': 'rpoD spots' } }
+    data, add_kwargs, layer_type = read_layer(tmp_path, entry, lazy=True)
+    assert layer_type == 'points' and data.shape == coordinates.shape
+    table = add_kwargs['features']
+    assert np.array_equal(table[['z', 'y', 'x']].to_numpy(), data)
+    assert np.array_equal(table['in_cell'], table['label'] != 0)
+    assert add_kwargs['border_color'] == 'in_cell'
+
+    entry = { 'file': 'rpoD_decomposed_spots.npy', 'layer_type': 'decomposed_spots', 'add_kwargs': {} }
+    data, add_kwargs, _ = read_layer(tmp_path, entry)
+    assert data.shape == (10, 3) and list(add_kwargs['features']) == ['z', 'y', 'x']
@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+from bigfish import detection, stack
+
+from napari_flofish._spots import (
+    SliceIndex,
+    ThresholdIndex,
+    cell_labels,
+    cell_statistics,
+    elbow_threshold,
+    spot_density,
+    spot_features,
+    threshold_sweep,
+)
+
+
+@pytest.fixture
+def rna_log():
+    rng = np.random.default_rng(0)
+    rna = rng.poisson(5, (10, 64, 64)).astype(np.uint16)
+    rna[3:5, 10:12, 10:13] = 100    # a plateau of local maxima
+    return stack.log_filter(rna, sigma=(1, 1.5, 1.5))
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 5, 20, 50, 1000])
+def test_threshold_index(rna_log, threshold):
+    mask = detection.local_maximum_detection(rna_log, min_distance=(1, 2, 2))
+    index = ThresholdIndex.from_local_maxima(rna_log, mask)
+
+    expected, _ = detection.spots_thresholding(rna_log, mask, threshold)
+    spots, intensities = index.threshold(threshold)
+    assert np.array_equal(spots, expected)
+    assert np.array_equal(intensities, rna_log[tuple(expected.T)])
+
+
+def test_threshold_index_table(rna_log):
+    mask = detection.local_maximum_detection(rna_log, min_distance=(1, 2, 2))
+    index = ThresholdIndex.from_local_maxima(rna_log, mask)
+    table = index.table()
+    rebuilt = ThresholdIndex.from_table(index.spots.astype(np.float64), table)
+
+    for threshold in [0, 5, 50]:
+        for expected, actual in zip(index.threshold(threshold), rebuilt.threshold(threshold)):
+            assert np.array_equal(actual, expected)
+    rendered = index.render(rna_log.shape)
+    assert rendered.sum() == len(index)
+    assert np.all(rendered[tuple(index.spots.T)])
+
+
+def test_threshold_index_empty(rna_log):
+    index = ThresholdIndex.from_local_maxima(rna_log, np.zeros(rna_log.shape, dtype=bool))
+    spots, intensities = index.threshold(0)
+    assert spots.shape == (0, 3)
+    assert len(intensities) == 0
+
+
+def test_threshold_sweep():
+    rng = np.random.default_rng(0)
+    rna = rng.poisson(1000, (10, 128, 128)).astype(np.uint16)
+    spots = rng.integers(0, (10, 128, 128), (100, 3))
+    rna[tuple(spots.T)] += rng.integers(2000, 20000, 100).astype(np.uint16)
+    rna_log = stack.log_filter(rna, sigma=(1, 1.5, 1.5))
+    mask = detection.local_maximum_detection(rna_log, min_distance=(1, 2, 2))
+    index = ThresholdIndex.from_local_maxima(rna_log, mask)
+
+    curves, elbows = threshold_sweep({ 'rpoD': index })
+    for threshold in [0, 5, 50, curves.index[-1]]:
+        assert curves.loc[threshold, 'rpoD'] == len(index.threshold(threshold)[0])
+    assert elbows['rpoD'] == detection.automated_threshold_setting(rna_log, mask)
+    assert index.max_value == rna_log[mask].max()
+    assert ThresholdIndex.from_local_maxima(rna_log, np.zeros_like(mask)).max_value is None
+
+
+def test_elbow_threshold_no_spots():
+    thresholds = np.arange(10.)
+    assert elbow_threshold(thresholds, np.zeros(10)) is None
+    assert elbow_threshold(thresholds[:1], np.ones(1)) is None
+
+
+def test_cell_labels():
+    cell_masks = np.array([[0, 1], [2, 0]], dtype=np.uint16)
+    spots = np.array([[0, 0, 0], [3, 0, 1], [5, 1, 0], [1, 1, 1]])
+    labels, in_cell = cell_labels(cell_masks, spots)
+    assert labels.tolist() == [0, 1, 2, 0]
+    assert in_cell.tolist() == [0, 1, 1, 0]
+
+    # 3-d masks are looked up with z as well
+    labels, _ = cell_labels(np.stack([cell_masks, cell_masks + 10]), spots[:, 0:3] % 2)
+    assert labels.tolist() == [0, 11, 12, 10]
+
+
+def test_spot_features():
+    spots = np.array([[0, 0, 0], [3, 0, 1]])
+    features = spot_features(spots, np.array([1.5, 2.5]), np.array([[0, 7]]))
+    assert list(features.columns) == ['z', 'y', 'x', 'intensity_LoG', 'label', 'in_cell']
+    assert features['x'].dtype == np.float64
+    assert features['label'].tolist() == [0, 7]
+    assert features['in_cell'].tolist() == [0, 1]
+
+    features = spot_features(spots, np.array([1.5, 2.5]), dtype=np.float32)
+    assert features['intensity_LoG'].dtype == np.float32
+    assert features['label'].tolist() == [-1, -1]
+
+
+def test_cell_statistics():
+    masks = np.zeros((6, 6), dtype=np.uint16)
+    masks[:2, :3] = 1
+    masks[4:, 4:] = 5
+    spots = np.array([[0, 0, 0], [1, 1, 2], [2, 5, 5], [3, 3, 3]])
+    intensities = np.array([1.0, 2.0, 4.0, 8.0])
+
+    statistics = cell_statistics(masks, { 'a': (spots, intensities), 'b': (spots[:1], None) })
+    assert list(statistics.columns) == ['label', 'area', 'a nb_spots', 'a intensity_sum', 'b nb_spots']
+    assert statistics['label'].tolist() == [1, 5]
+    assert statistics['area'].tolist() == [6, 4]
+    assert statistics['a nb_spots'].tolist() == [2, 1]
+    assert statistics['a intensity_sum'].tolist() == [3.0, 4.0]
+    assert statistics['b nb_spots'].tolist() == [1, 0]
+
+
+def test_slice_index():
+    rng = np.random.default_rng(0)
+    spots = np.column_stack([rng.integers(0, 20, 1000), rng.integers(0, 64, (1000, 2))])
+    index = SliceIndex(spots)
+    for start, stop in [(0, 0), (3, 7), (18.5, 25), (-5, -1)]:
+        expected = np.flatnonzero((spots[:, 0] >= start) & (spots[:, 0] <= stop))
+        assert np.array_equal(index.select(start, stop), expected)
+
+
+def test_spot_density():
+    spots = np.array([[0, 0, 0], [1, 3, 3], [2, 4, 9], [0, 9, 9]])
+    density = spot_density(spots, (10, 10), 4)
+    assert density.shape == (3, 3)
+    assert density.dtype == np.float32
+    assert density[0, 0] == 2 and density[1, 2] == 1 and density[2, 2] == 1
+    assert density.sum() == len(spots)
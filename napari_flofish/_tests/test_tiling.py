@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from bigfish import detection, stack
+
+from napari_flofish._tiling import log_filter_local_maxima, tile_regions
+
+
+@pytest.fixture
+def rna():
+    rng = np.random.default_rng(0)
+    rna = rng.poisson(100, (8, 150, 173)).astype(np.uint16)
+    for z, y, x in rng.integers((1, 4, 4), (7, 146, 169), (100, 3)):
+        rna[z - 1:z + 2, y - 2:y + 3, x - 2:x + 3] += 300
+    return rna
+
+
+def test_tile_regions():
+    tiles = tile_regions((8, 150, 173), 64)
+    assert len(tiles) == 3 * 3
+    covered = np.zeros((150, 173), dtype=int)
+    for y, x in tiles:
+        covered[y, x] += 1
+    assert np.all(covered == 1)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+@pytest.mark.parametrize("tile_size", [32, 50, 1000])
+def test_log_filter_local_maxima(rna, dtype, tile_size):
+    if dtype == np.float32:
+        rna = (rna / rna.max()).astype(np.float32)
+    spot_radius_px = (4.0, 1.846, 1.846)
+
+    rna_log = stack.log_filter(rna, sigma=spot_radius_px)
+    mask = detection.local_maximum_detection(rna_log, min_distance=spot_radius_px)
+
+    tiled_log, tiled_mask = log_filter_local_maxima(rna, spot_radius_px, spot_radius_px, tile_size=tile_size)
+    assert np.array_equal(tiled_log, rna_log)
+    assert np.array_equal(tiled_mask, mask)
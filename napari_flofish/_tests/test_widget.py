@@ -1,5 +1,6 @@
 import pytest
 
+import time
 import numpy as np
 import pandas as pd
 from skimage import io
@@ -9,9 +10,18 @@ from napari_flofish._widget import (
     read_in_vsi_widget,
     background_filtering_magic_widget,
     spot_detection_magic_widget,
+    multi_channel_spot_detection_magic_widget,
     spot_thresholding_magic_widget,
+    threshold_sweep_magic_widget,
     spot_decomposition_magic_widget,
+    spot_statistics_magic_widget,
+    spot_display_magic_widget,
+    roi_spot_detection_magic_widget,
+    start_worker,
 )
+from napari_flofish import _cache, _widget
+from napari_flofish._spots import ThresholdIndex, threshold_sweep
+from napari_flofish._widget import layer_array, read_in_vsi, run_stages
 
 @pytest.fixture
 def dic_masks():
@@ -55,27 +65,78 @@ scale = (200, 65, 65)
 spot_radius = (800, 120, 120)
 
 
-def test_read_in_vsi_widget(make_napari_viewer):
+def wait_for(qtbot, future):
+    # widgets run in a background worker and return a Future
+    qtbot.waitUntil(future.done, timeout=600_000)
+    return future.result()
+
+
+def test_read_in_vsi_widget(make_napari_viewer, qtbot):
     viewer = make_napari_viewer()
     my_widget = read_in_vsi_widget()
     base_dir = "napari_flofish/_tests/data/exp16"
     cfg_file = Path(base_dir) / "config.json"
     vsi_file = "MG1655_GLU_OD_0.3_left_CY5, CY3.5 NAR, CY3, DAPI_02.vsi"
     cell_file = "MG1655_GLU_OD_0.3_left_DIC_02.tif"
-    result = my_widget(cfg_file=cfg_file, vsi_file=vsi_file, cell_file=cell_file)
+    result = wait_for(qtbot, my_widget(cfg_file=cfg_file, vsi_file=vsi_file, cell_file=cell_file))
     assert len(result) == 5
 
 
-def test_background_filtering_magic_widget(make_napari_viewer, rna, rna_background_filtered):
+class FakeImage:
+    reads = 0
+
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.experiment = type('Experiment', (), { 'channels': { 'rpoD': { 'colormap': 'magenta' } } })
+        self.cells = { 'aligned': rng.integers(0, 1000, (32, 32)).astype(np.uint16) }
+        self.mrna = { 'rpoD': { 'aligned': rng.integers(0, 1000, (4, 32, 32)).astype(np.uint16) } }
+
+    @classmethod
+    def from_dict(cls, params, exp):
+        return cls()
+
+    def read_image(self):
+        FakeImage.reads += 1
+
+    def read_cells(self):
+        pass
+
+    def align(self):
+        pass
+
+
+def test_read_in_vsi_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(_widget, 'Image', FakeImage)
+    monkeypatch.setattr(_widget, 'Experiment', type('Experiment', (), { 'from_cfg_file': staticmethod(lambda cfg_file: None) }))
+    monkeypatch.setattr(_cache, '_cache', _cache.StageCache(tmp_path / 'cache', memory_bytes=0))
+    for name, content in [('config.json', '{}'), ('image.vsi', 'vsi'), ('image_DIC.tif', 'dic')]:
+        (tmp_path / name).write_text(content)
+    args = (tmp_path / 'config.json', 'image.vsi', 'image_DIC.tif')
+
+    first = run_stages(read_in_vsi, *args)
+    second = run_stages(read_in_vsi, *args)
+    assert FakeImage.reads == 1
+    assert [ props['name'] for _, props, _ in second ] == ['DIC', 'rpoD']
+    assert isinstance(second[1][0], np.memmap)
+    for (data, props, _), (expected, expected_props, _) in zip(second, first):
+        assert np.array_equal(data, expected) and props == expected_props
+
+    # a modified file is read again
+    (tmp_path / 'image.vsi').write_text('modified vsi')
+    run_stages(read_in_vsi, *args)
+    assert FakeImage.reads == 2
+
+
+def test_background_filtering_magic_widget(make_napari_viewer, qtbot, rna, rna_background_filtered):
     viewer = make_napari_viewer()
     layer = viewer.add_image(rna)
 
     my_widget = background_filtering_magic_widget()
-    result = my_widget(img_layer=layer, sigma_z=0.75, sigma_yx=2.3)
+    result = wait_for(qtbot, my_widget(img_layer=layer, sigma_z=0.75, sigma_yx=2.3))
     assert np.all(result[0] - rna_background_filtered == 0)
 
 
-def test_spot_detection_magic_widget(make_napari_viewer, dic_masks, rna_background_filtered, rna_LoG_filtered, rna_local_maxima, spots_detected_50):
+def test_spot_detection_magic_widget(make_napari_viewer, qtbot, dic_masks, rna_background_filtered, rna_LoG_filtered, rna_local_maxima, spots_detected_50):
     viewer = make_napari_viewer()
     layer = viewer.add_image(rna_background_filtered)
     layer.metadata['channel'] = 'rpoD'
@@ -85,15 +146,37 @@ def test_spot_detection_magic_widget(make_napari_viewer, dic_masks, rna_backgrou
     viewer.add_image(dic_masks, name='DIC masks')
 
     my_widget = spot_detection_magic_widget()
-    result = my_widget(img_layer=layer, threshold=50, scale_z=200, scale_yx=65, spot_radius_z=800, spot_radius_yx=120)
+    result = wait_for(qtbot, my_widget(img_layer=layer, threshold=50, scale_z=200, scale_yx=65, spot_radius_z=800, spot_radius_yx=120, keep_log=True))
 
     assert np.all(result[0][0] - rna_LoG_filtered == 0)
-    assert np.all(result[1][0] - rna_local_maxima == 0)
+    expected_maxima = ThresholdIndex.from_local_maxima(rna_LoG_filtered, rna_local_maxima)
+    assert np.array_equal(result[1][0], expected_maxima.spots)
+    assert np.array_equal(result[1][1]['features']['intensity_LoG'], expected_maxima.intensities)
     test_spots = pd.concat([pd.DataFrame(result[2][0]), result[2][1]['features']], axis=1)
     assert test_spots.equals(spots_detected_50)
 
 
-def test_spot_thresholding_magic_widget(make_napari_viewer, dic_masks, rna_LoG_filtered, rna_local_maxima, spots_detected_50, spots_thresholded_100):
+def test_multi_channel_spot_detection_magic_widget(make_napari_viewer, qtbot, dic_masks, rna_background_filtered, rna_LoG_filtered, rna_local_maxima, spots_detected_50):
+    viewer = make_napari_viewer()
+    for channel in ['rpoD', 'rpoD copy']:
+        viewer.add_image(rna_background_filtered, name=f'{channel} background filtered', metadata={ 'channel': channel })
+    viewer.add_image(dic_masks, name='DIC masks')
+
+    my_widget = multi_channel_spot_detection_magic_widget()
+    result = wait_for(qtbot, my_widget(viewer=viewer, threshold=50, scale_z=200, scale_yx=65, spot_radius_z=800, spot_radius_yx=120))
+
+    assert [ props['name'] for _, props, _ in result ] == [
+        'rpoD local maxima', 'rpoD spots detected thr=50',
+        'rpoD copy local maxima', 'rpoD copy spots detected thr=50',
+    ]
+    expected_maxima = ThresholdIndex.from_local_maxima(rna_LoG_filtered, rna_local_maxima)
+    for i in [0, 2]:
+        assert np.array_equal(result[i][0], expected_maxima.spots)
+        test_spots = pd.concat([pd.DataFrame(result[i + 1][0]), result[i + 1][1]['features']], axis=1)
+        assert test_spots.equals(spots_detected_50)
+
+
+def test_spot_thresholding_magic_widget(make_napari_viewer, qtbot, dic_masks, rna_LoG_filtered, rna_local_maxima, spots_detected_50, spots_thresholded_100):
     viewer = make_napari_viewer()
     layer = viewer.add_points(spots_detected_50.iloc[:, 0:3])
     layer.features = spots_detected_50.iloc[:, 3:]
@@ -104,16 +187,58 @@ def test_spot_thresholding_magic_widget(make_napari_viewer, dic_masks, rna_LoG_f
 
     my_widget = spot_thresholding_magic_widget()
 
-    same_spots, props, _ = my_widget(viewer=viewer, img_layer=viewer.layers[0], threshold=50)
+    same_spots, props, _ = wait_for(qtbot, my_widget(viewer=viewer, img_layer=viewer.layers[0], threshold=50))
     test_spots = pd.concat([pd.DataFrame(same_spots), props['features']], axis=1)
     assert test_spots.equals(spots_detected_50)
 
-    fewer_spots, props, _ = my_widget(img_layer=layer, threshold=100)
+    fewer_spots, props, _ = wait_for(qtbot, my_widget(img_layer=layer, threshold=100))
     test_spots = pd.concat([pd.DataFrame(fewer_spots), props['features']], axis=1)
     assert test_spots.equals(spots_thresholded_100)
 
 
-def test_spot_decomposition_magic_widget(make_napari_viewer, dic_masks, rna, spots_detected_50, spots_decomposed_50):
+def test_spot_thresholding_from_local_maxima_table(make_napari_viewer, qtbot, dic_masks, rna_LoG_filtered, rna_local_maxima, spots_detected_50, spots_thresholded_100):
+    # a local maxima points layer without its index, e.g. saved and reopened
+    index = ThresholdIndex.from_local_maxima(rna_LoG_filtered, rna_local_maxima)
+    viewer = make_napari_viewer()
+    layer = viewer.add_points(spots_detected_50.iloc[:, 0:3])
+    layer.features = spots_detected_50.iloc[:, 3:]
+    layer.metadata['channel'] = 'rpoD'
+    viewer.add_points(index.spots, features=index.table(), name='rpoD local maxima')
+    viewer.add_image(dic_masks, name='DIC masks')
+
+    my_widget = spot_thresholding_magic_widget()
+
+    fewer_spots, props, _ = wait_for(qtbot, my_widget(viewer=viewer, img_layer=layer, threshold=100))
+    test_spots = pd.concat([pd.DataFrame(fewer_spots), props['features']], axis=1)
+    assert test_spots.equals(spots_thresholded_100)
+    assert 'threshold_index' in viewer.layers['rpoD local maxima'].metadata
+    # the live layer has a fixed name, the input layer is left as it is
+    assert props['name'] == 'rpoD spots thresholded' and props['metadata']['threshold'] == 100
+    assert 'threshold' not in layer.metadata
+
+
+def test_threshold_sweep_magic_widget(make_napari_viewer, qtbot, dic_masks, rna_LoG_filtered, rna_local_maxima):
+    index = ThresholdIndex.from_local_maxima(rna_LoG_filtered, rna_local_maxima)
+    viewer = make_napari_viewer()
+    maxima_layer = viewer.add_points(index.spots, features=index.table(), name='rpoD local maxima')
+    maxima_layer.metadata['channel'] = 'rpoD'
+    viewer.add_image(dic_masks, name='DIC masks')
+
+    my_widget = threshold_sweep_magic_widget()
+    result = wait_for(qtbot, my_widget(viewer=viewer, apply=True))
+
+    auto_threshold = maxima_layer.metadata['auto_threshold']
+    assert auto_threshold == threshold_sweep({ 'rpoD': index })[1]['rpoD']
+    curve = maxima_layer.metadata['threshold_curve']
+    assert curve.iloc[0] == len(index.threshold(curve.index[0])[0])
+    spots, props, _ = result[0]
+    assert props['name'] == f'rpoD spots thresholded thr={auto_threshold}'
+    assert props['metadata']['threshold'] == auto_threshold
+    assert np.array_equal(spots, index.threshold(auto_threshold)[0])
+    assert 'Threshold sweep' in viewer.window.dock_widgets
+
+
+def test_spot_decomposition_magic_widget(make_napari_viewer, qtbot, dic_masks, rna, spots_detected_50, spots_decomposed_50):
     viewer = make_napari_viewer()
     layer = viewer.add_points(spots_detected_50.iloc[:, 0:3])
     layer.metadata['channel'] = 'rpoD'
@@ -125,9 +250,122 @@ def test_spot_decomposition_magic_widget(make_napari_viewer, dic_masks, rna, spo
     viewer.add_image(rna, name='rpoD')
 
     my_widget = spot_decomposition_magic_widget()
-    result = my_widget(viewer=viewer, point_layer=layer)
+    result = wait_for(qtbot, my_widget(viewer=viewer, point_layer=layer))
 
     test_spots = pd.concat([ pd.DataFrame(result[1][0]), result[1][1]['features']], axis=1)
     # assert test_spots.equals(spots_decomposed_50)    # etc.
     assert abs(test_spots.shape[0] - spots_decomposed_50.shape[0]) / spots_decomposed_50.shape[0] < 0.1
-    assert test_spots.shape[0] > spots_detected_50.shape[0]
\ No newline at end of file
+    assert test_spots.shape[0] > spots_detected_50.shape[0]
+
+
+def test_spot_statistics_magic_widget(make_napari_viewer, qtbot, tmp_path, dic_masks, spots_detected_50):
+    viewer = make_napari_viewer()
+    masks_layer = viewer.add_labels(dic_masks, name='DIC masks')
+    layer = viewer.add_points(spots_detected_50.iloc[:, 0:3], name='rpoD spots detected thr=50')
+    layer.features = spots_detected_50.iloc[:, 3:]
+    layer.metadata['channel'] = 'rpoD'
+
+    my_widget = spot_statistics_magic_widget()
+    result = wait_for(qtbot, my_widget(viewer=viewer, masks_layer=masks_layer, output=tmp_path / 'statistics.csv'))
+
+    statistics = result[0][1]['metadata']['statistics']
+    labels = spots_detected_50['label']
+    expected = labels[labels > 0].value_counts().reindex(statistics['label'], fill_value=0)
+    assert np.array_equal(statistics['rpoD spots detected thr=50 nb_spots'], expected)
+    assert statistics['area'].sum() == np.count_nonzero(dic_masks)
+    assert pd.read_csv(tmp_path / 'statistics.csv').equals(statistics)
+
+
+def test_spot_display_magic_widget(make_napari_viewer, spots_detected_50):
+    viewer = make_napari_viewer()
+    layer = viewer.add_points(spots_detected_50.iloc[:, 0:3], features=spots_detected_50.iloc[:, 3:],
+                              name='rpoD spots detected thr=50', metadata={ 'channel': 'rpoD' })
+
+    my_widget = spot_display_magic_widget()
+    my_widget(viewer=viewer, point_layer=layer, mode='slab', half_width=1)
+    slab = viewer.layers['rpoD spots detected thr=50 slab']
+    z = spots_detected_50['z'].to_numpy()
+    for step in [0, 5]:
+        viewer.dims.set_current_step(0, step)
+        assert len(slab.data) == np.count_nonzero(np.abs(z - step) <= 1)
+        assert np.array_equal(slab.features['label'], spots_detected_50['label'][np.abs(z - step) <= 1])
+
+    my_widget(viewer=viewer, point_layer=layer, mode='density', bin_size=8)
+    assert viewer.layers['rpoD spots detected thr=50 density'].data.sum() == len(spots_detected_50)
+
+    # local maxima are rendered from their index
+    with pytest.raises(ValueError):
+        my_widget(viewer=viewer, point_layer=layer, mode='mask')
+    spots = spots_detected_50.iloc[:, 0:3].to_numpy().astype(np.int64)
+    index = ThresholdIndex(spots, np.ones(len(spots)), np.ones(len(spots)))
+    maxima = viewer.add_points(spots, name='rpoD local maxima', features=index.table(),
+                               metadata={ 'channel': 'rpoD', 'threshold_index': index })
+    my_widget(viewer=viewer, point_layer=maxima, mode='mask')
+    mask = viewer.layers['rpoD local maxima mask'].data
+    assert mask.sum() == len(np.unique(spots, axis=0)) and np.all(mask[tuple(spots.T)])
+
+
+def test_roi_spot_detection_magic_widget(make_napari_viewer, qtbot, rna, dic_masks, spots_detected_50):
+    viewer = make_napari_viewer()
+    layer = viewer.add_image(rna, name='rpoD', metadata={ 'channel': 'rpoD' })
+    viewer.add_image(dic_masks, name='DIC masks')
+    spots_layer = viewer.add_points(spots_detected_50.iloc[:, 0:3], features=spots_detected_50.iloc[:, 3:],
+                                    name='rpoD spots detected thr=50')
+    label = int(np.unique(dic_masks)[1])
+
+    my_widget = roi_spot_detection_magic_widget()
+    result = wait_for(qtbot, my_widget(viewer=viewer, img_layer=layer, cells=str(label), threshold=50))
+
+    maxima, props, _ = result[0]
+    assert props['name'] == 'rpoD local maxima'
+    assert np.array_equal(props['metadata']['threshold_index'].spots, maxima)
+    spots, props, _ = result[1]
+    # the layer of the channel is updated whatever its threshold
+    assert props['name'] == spots_layer.name
+    # spots out of the ROI are kept, the ROI's are found again
+    assert abs(len(spots) - len(spots_detected_50)) <= 0.05 * len(spots_detected_50)
+    assert np.array_equal(props['features']['y'], spots[:, 1])
+
+    # spots detected at another threshold are not merged into
+    with pytest.raises(ValueError, match='thresholded at 50'):
+        my_widget(viewer=viewer, img_layer=layer, cells=str(label), threshold=100)
+
+
+def test_start_worker_superseded(qtbot):
+    def stages(result):
+        yield 'first'
+        time.sleep(0.5)
+        yield 'second'
+        return result
+
+    superseded = start_worker(('test',), stages, ['superseded'])
+    latest = start_worker(('test',), stages, ['latest'])
+    assert wait_for(qtbot, superseded) == []
+    assert wait_for(qtbot, latest) == ['latest']
+
+
+def test_start_worker_error(qtbot, monkeypatch):
+    def stages():
+        yield 'failing'
+        raise KeyError('threshold')
+
+    shown = []
+    monkeypatch.setattr(_widget, 'show_error', shown.append)
+    future = start_worker(('test',), stages)
+    qtbot.waitUntil(future.done, timeout=10_000)
+    assert isinstance(future.exception(), KeyError)
+    assert shown == ["KeyError: 'threshold'"]
+
+
+def test_layer_array():
+    import dask.array as da
+
+    data = da.from_array(np.arange(24).reshape(2, 3, 4), chunks=(1, 3, 4))
+    array = layer_array(data)
+    assert isinstance(array, np.ndarray) and not array.flags.writeable
+    np.testing.assert_array_equal(array, np.arange(24).reshape(2, 3, 4))
+    # computed once for the lifetime of the dask array
+    assert layer_array(data) is array
+    assert _cache.get_cache().key('stage', array) == _cache.get_cache().key('stage', layer_array(data))
+    numpy_data = np.zeros(3)
+    assert layer_array(numpy_data) is numpy_data and layer_array(None) is None
@@ -1,7 +1,74 @@
-from flofish import write_multiple
+import dask.array as da
+import numpy as np
+import pandas as pd
 
-# add your tests here...
+from napari_flofish._reader import napari_get_reader, read_zarr
+from napari_flofish._writer import write_multiple, write_single_image
 
 
-def test_write_multiple():
-    pass
+def layers():
+    rng = np.random.default_rng(0)
+    rna = rng.integers(0, 1000, (6, 40, 50)).astype(np.uint16)
+    masks = np.zeros((40, 50), dtype=np.int32)
+    masks[5:20, 5:20] = 1
+    masks[25:35, 30:45] = 2
+    spots = rng.integers(0, 40, (30, 3)).astype(np.int64)
+    features = pd.DataFrame({
+        'z': spots[:, 0].astype(np.float64), 'y': spots[:, 1].astype(np.float64), 'x': spots[:, 2].astype(np.float64),
+        'intensity_LoG': rng.random(30).astype(np.float32),
+        'label': rng.integers(0, 3, 30), 'in_cell': rng.integers(0, 2, 30).astype(bool),
+    })
+    metadata = { 'channel': 'rpoD', 'threshold': 50, 'scale': (200, 65, 65), 'spot_radius': (800, 120, 120),
+                 'threshold_index': object() }
+    border_color = np.tile([[0., 1., 1., 1.]], (30, 1))
+    border_color[features['in_cell'].to_numpy()] = [1., 0., 0., 1.]
+
+    return [
+        (rna, { 'name': 'rpoD', 'colormap': 'magenta', 'metadata': metadata, 'visible': False }, 'image'),
+        (masks, { 'name': 'DIC masks', 'opacity': 0.2 }, 'labels'),
+        (spots, { 'name': 'rpoD spots detected thr=50', 'metadata': metadata, 'features': features,
+                  'size': np.full(30, 10), 'border_color': border_color }, 'points'),
+    ]
+
+
+def test_write_multiple(tmp_path):
+    path = str(tmp_path / 'analysis.zarr')
+    assert write_multiple(path, layers()) == [path]
+    assert napari_get_reader(path) is read_zarr
+
+    for (data, meta, layer_type), (expected, expected_meta, expected_type) in zip(read_zarr(path), layers()):
+        assert layer_type == expected_type
+        assert meta['name'] == expected_meta['name']
+        np.testing.assert_array_equal(np.asarray(data), expected)
+        assert np.asarray(data).dtype == expected.dtype
+
+    rna, image_meta, _ = read_zarr(path)[0]
+    assert isinstance(rna, da.Array)
+    assert image_meta['colormap'] == 'magenta'
+    assert image_meta['metadata'] == { 'channel': 'rpoD', 'threshold': 50,
+                                       'scale': [200, 65, 65], 'spot_radius': [800, 120, 120] }
+
+    _, points_meta, _ = read_zarr(path)[2]
+    expected_meta = layers()[2][1]
+    pd.testing.assert_frame_equal(points_meta['features'], expected_meta['features'])
+    assert points_meta['size'] == 10
+    np.testing.assert_array_equal(points_meta['border_color'], expected_meta['border_color'])
+
+
+def test_write_lazy(tmp_path):
+    rna = da.from_array(layers()[0][0], chunks=(1, 40, 50))
+    path = str(tmp_path / 'rna.zarr')
+    write_single_image(path, rna, { 'name': 'rpoD' })
+
+    [(data, meta, layer_type)] = read_zarr(path, lazy=False)
+    assert layer_type == 'image'
+    np.testing.assert_array_equal(data, layers()[0][0])
+
+
+def test_write_multiscale(tmp_path):
+    rna = layers()[0][0]
+    path = str(tmp_path / 'rna.zarr')
+    write_single_image(path, [rna, rna[:, ::2, ::2]], { 'name': 'rpoD', 'multiscale': True })
+
+    [(data, _, _)] = read_zarr(path, lazy=False)
+    np.testing.assert_array_equal(data, rna)
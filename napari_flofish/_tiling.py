@@ -0,0 +1,119 @@
+"""
+Tiled LoG filtering and local maximum detection for large stacks.
+
+The volume is split into YX tiles (z is never split). Each tile is read with
+a halo wide enough for the LoG kernel and the maximum filter, so the
+stitched results are identical to ``stack.log_filter`` followed by
+``detection.local_maximum_detection`` on the whole volume, while the float
+temporaries are only allocated per tile.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import numpy as np
+from bigfish import detection, stack
+from scipy import ndimage as ndi
+
+# scipy.ndimage gaussian kernels extend to truncate * sigma (default 4)
+TRUNCATE = 4.0
+
+
+def log_halo(sigma):
+    """Radius in pixels of the LoG kernel for each sigma."""
+    return tuple(int(TRUNCATE * float(s) + 0.5) for s in sigma)
+
+
+def maximum_halo(min_distance):
+    """Radius in pixels of the maximum filter of local_maximum_detection."""
+    return tuple(int(np.ceil(d)) for d in min_distance)
+
+
+def _expand(region, halo, size):
+    return slice(max(region.start - halo, 0), min(region.stop + halo, size))
+
+
+def _relative(region, outer):
+    return slice(region.start - outer.start, region.stop - outer.start)
+
+
+def tile_regions(shape, tile_size):
+    """Return the (y, x) slices of the tiles covering the last two axes of ``shape``."""
+    ys = [ slice(y, min(y + tile_size, shape[-2])) for y in range(0, shape[-2], tile_size) ]
+    xs = [ slice(x, min(x + tile_size, shape[-1])) for x in range(0, shape[-1], tile_size) ]
+    return list(product(ys, xs))
+
+
+def _log_filter_float(image, sigma):
+    # stack.log_filter without the final cast, which would check the range
+    # of the invalid pixels near the edges of a tile
+    if image.dtype == np.uint8:
+        image_float = stack.cast_img_float32(image)
+    elif image.dtype == np.uint16:
+        image_float = stack.cast_img_float64(image)
+    else:
+        image_float = image
+
+    return np.clip(-ndi.gaussian_laplace(image_float, sigma=sigma), a_min=0, a_max=None)
+
+
+def _cast_like(image_filtered, dtype):
+    if dtype == np.uint8:
+        return stack.cast_img_uint8(image_filtered)
+    elif dtype == np.uint16:
+        return stack.cast_img_uint16(image_filtered)
+    return image_filtered
+
+
+def _process_tile(image, rna_log, mask, tile, sigma, min_distance):
+    # tile: write region, maxima: pixels the maximum filter reads,
+    # read: pixels the LoG filter reads
+    shape = image.shape
+    halo_max = maximum_halo(min_distance)[-2:]
+    halo_log = log_halo(sigma)[-2:]
+    maxima = tuple(_expand(r, h, n) for r, h, n in zip(tile, halo_max, shape[-2:]))
+    read = tuple(_expand(r, h, n) for r, h, n in zip(maxima, halo_log, shape[-2:]))
+
+    filtered = _log_filter_float(image[..., read[0], read[1]], sigma)
+    tile_log = _cast_like(filtered[..., _relative(maxima[0], read[0]), _relative(maxima[1], read[1])], image.dtype)
+    del filtered
+    tile_mask = detection.local_maximum_detection(tile_log, min_distance=min_distance)
+
+    inner = tuple(_relative(r, m) for r, m in zip(tile, maxima))
+    rna_log[..., tile[0], tile[1]] = tile_log[..., inner[0], inner[1]]
+    mask[..., tile[0], tile[1]] = tile_mask[..., inner[0], inner[1]]
+
+
+def log_filter_local_maxima(image, sigma, min_distance, tile_size=512, max_workers=None):
+    """Tiled, multi-threaded ``stack.log_filter`` + ``detection.local_maximum_detection``.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Image with shape (z, y, x) or (y, x).
+    sigma : tuple of float
+        Standard deviation of the LoG filter, one per axis.
+    min_distance : tuple of float
+        Minimum distance between local maxima, one per axis.
+    tile_size : int
+        Size in pixels of the YX tiles, without their halo.
+    max_workers : int or None
+        Number of threads processing tiles.
+
+    Returns
+    -------
+    rna_log : np.ndarray
+        LoG filtered image, same dtype as ``image``.
+    mask : np.ndarray, bool
+        Local maxima of ``rna_log``.
+    """
+    image = np.asarray(image)
+    rna_log = np.empty(image.shape, dtype=image.dtype)
+    mask = np.empty(image.shape, dtype=bool)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [ executor.submit(_process_tile, image, rna_log, mask, tile, sigma, min_distance)
+                    for tile in tile_regions(image.shape, tile_size) ]
+        for future in futures:
+            future.result()
+
+    return rna_log, mask
@@ -3,7 +3,14 @@ Widgets to call Big-FISH functions.
 """
 
 import napari
-from typing import List
+from napari.qt.threading import create_worker
+from napari.utils.notifications import show_error
+import re
+import threading
+import weakref
+from functools import partial
+from typing import List, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 from magicgui import magic_factory
 
@@ -17,61 +24,217 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 
+from ._cache import get_cache
+from ._decomposition import decompose_dense
+from ._filtering import remove_background_gaussian
+from ._offload import log_local_maxima, nb_processes, offload
+from ._profiling import profiled
+from ._pyramid import pyramid
+from ._roi import crop, labels_box, merge_index, merge_spots, shapes_box, shift_spots, with_halo
+from ._spots import (
+    SliceIndex,
+    ThresholdIndex,
+    cell_labels,
+    cell_statistics,
+    sample_at,
+    spot_density,
+    spot_features,
+    threshold_sweep,
+)
+from ._tiling import log_filter_local_maxima
+
+
+_workers = {}
+
+
+def start_worker(key, stages, *args, desc=None, total=0, **kwargs):
+    """Run a widget's stages in a background thread and return a Future of their layers.
+
+    ``stages`` yields a description of each stage before running it. A run
+    still going with the same ``key`` is superseded: it stops once its
+    current stage is over and resolves to []. Errors are shown in the viewer.
+    """
+    previous = _workers.pop(key, None)
+    if previous is not None:
+        previous.quit()
+
+    future = Future()
+    worker = create_worker(profiled(stages), *args, _progress={'desc': desc, 'total': total}, _ignore_errors=True, **kwargs)
+    worker.yielded.connect(lambda stage: worker.pbar.set_description(f'{desc}: {stage}'))
+    worker.returned.connect(future.set_result)
+    worker.errored.connect(lambda e: _fail(future, e))
+    worker.finished.connect(lambda: _finish(key, worker, future))
+    _workers[key] = worker
+    worker.start()
+
+    return future
+
+
+def _fail(future, error):
+    show_error(f'{type(error).__name__}: {error}')
+    future.set_exception(error)
+
+
+def _finish(key, worker, future):
+    # a superseded run neither returns nor errors
+    if not future.done():
+        future.set_result([])
+    if _workers.get(key) is worker:
+        del _workers[key]
+
+
+def full_resolution(layer):
+    """Return the data of a layer, the first level of a multiscale one."""
+    return layer.data[0] if getattr(layer, 'multiscale', False) else layer.data
+
+
+_computed = {}
+_computed_lock = threading.Lock()
+
+
+def layer_array(data):
+    """Return layer data as an array; dask data is computed once and kept read-only."""
+    if data is None or isinstance(data, np.ndarray) or not hasattr(data, 'compute'):
+        return None if data is None else np.asarray(data)
+    with _computed_lock:
+        known = _computed.get(id(data))
+        if known is not None and known[0]() is data:
+            return known[1]
+
+    array = np.asarray(data.compute())
+    array.flags.writeable = False
+    with _computed_lock:
+        _computed[id(data)] = (weakref.ref(data, partial(_forget_computed, id(data))), array)
+    return array
+
+
+def _forget_computed(key, ref):
+    with _computed_lock:
+        if _computed.get(key, (None,))[0] is ref:
+            del _computed[key]
+
+
+def run_stages(stages, *args, **kwargs):
+    """Run a widget's stages in the calling thread and return the layer data."""
+    generator = profiled(stages)(*args, **kwargs)
+    while True:
+        try:
+            next(generator)
+        except StopIteration as result:
+            return result.value
+
+
+def file_identity(path, cfg_file):
+    """Return (resolved path, size, mtime) of an input file, or None if not found.
+
+    File names that are not found as given are looked up next to the
+    experiment configuration file, and below its directory.
+    """
+    path = Path(path)
+    if not path.is_file():
+        cfg_dir = Path(cfg_file).parent
+        path = next((p for p in [cfg_dir / path, *cfg_dir.rglob(path.name)] if p.is_file()), None)
+        if path is None:
+            return None
+    stat = path.stat()
+    return (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+def read_in_vsi(cfg_file, vsi_file, cell_file, multiscale=False, use_cache=True):
+    # reading and aligning take tens of seconds: cached by file identity
+    cache = get_cache()
+    files = [ file_identity(f, cfg_file) for f in (vsi_file, cell_file) ]
+    key = None
+    if use_cache and None not in files and Path(cfg_file).is_file():
+        key = cache.key('read_in_vsi', *files, Path(cfg_file).read_bytes())
+    cached = cache.get(key) if key is not None else None
+
+    if cached is not None:
+        yield 'read image (cached)'
+        channels, dic, *mrna = cached
+    else:
+        img = Image.from_dict(params={ "vsi_file": vsi_file, "cell_file": cell_file }, exp=Experiment.from_cfg_file(cfg_file=cfg_file))
+        yield 'read image'
+        img.read_image()
+        yield 'read cells'
+        img.read_cells()
+        yield 'align'
+        img.align()
+
+        channels = [ (ch, img.experiment.channels[ch]['colormap']) for ch in reversed(img.mrna.keys()) ]
+        dic = np.asarray(img.cells['aligned'])
+        mrna = [ np.asarray(img.mrna[ch]['aligned']) for ch, _ in channels ]
+        if key is not None:
+            cache.put(key, (channels, dic, *mrna))
+
+    layer_data_tuples = []
+    layer_data_tuples.append((dic, { 'name': "DIC", 'colormap': 'grey', 'visible': True, 'blending': 'additive' }, 'image'))
+    for (ch, colormap), data in zip(channels, mrna):
+        layer_data_tuples.append((data, { 'name': ch, 'colormap': colormap, 'visible': False, 'blending': 'additive' }, 'image'))
+
+    if multiscale:
+        # downsampled levels are small: keep them in memory
+        yield 'pyramids'
+        for i, (data, add_kwargs, layer_type) in enumerate(layer_data_tuples):
+            levels = pyramid(data, layer_type)
+            if len(levels) > 1:
+                levels = [data] + [ np.asarray(level) for level in levels[1:] ]
+                layer_data_tuples[i] = (levels, { **add_kwargs, 'multiscale': True }, layer_type)
+
+    return layer_data_tuples
 
 
 @magic_factory(
     cfg_file={"label": "Config file"},
     vsi_file={"label": "VSI file"},
     cell_file={"label": "DIC file"},
+    multiscale={"label": "Multiscale (large images)"},
+    use_cache={"label": "Cache decoded images"},
 )
 def read_in_vsi_widget(
         cfg_file=Path.home(),
         vsi_file=Path.home(),
         cell_file=Path.home(),
-) -> List[napari.types.LayerDataTuple]:
-
-    img = Image.from_dict(params={ "vsi_file": vsi_file, "cell_file": cell_file }, exp=Experiment.from_cfg_file(cfg_file=cfg_file))
-    img.read_image()
-    img.read_cells()
-    img.align()
-
-    layer_data_tuples = []
-    layer_data_tuples.append((img.cells['aligned'], { 'name': "DIC", 'colormap': 'grey', 'visible': True, 'blending': 'additive' }, 'image'))
-    for ch, data in reversed(img.mrna.items()):
-        layer_data_tuples.append((data['aligned'], { 'name': ch, 'colormap': img.experiment.channels[ch]['colormap'], 'visible': False, 'blending': 'additive' }, 'image'))
-
-    return layer_data_tuples
+        multiscale: bool=False,
+        use_cache: bool=True,
+) -> Future[List[napari.types.LayerDataTuple]]:
+    return start_worker(('read_in_vsi',), read_in_vsi, cfg_file, vsi_file, cell_file, multiscale, use_cache,
+                        desc='Reading VSI file', total=4 if multiscale else 3)
+
+
+def background_filtering(rna, name, sigma_z, sigma_yx, lean=False, z_batch=0):
+    yield 'background filtering'
+    if lean:
+        # float32, with reused work buffers, z_batch planes at a time
+        filter_background = partial(remove_background_gaussian, z_batch=z_batch)
+    else:
+        filter_background = stack.remove_background_gaussian
+    filtered = get_cache().cached('background_filtering_float32' if lean else 'background_filtering',
+                                  filter_background, layer_array(rna), (sigma_z, sigma_yx, sigma_yx))
+    return (filtered,
+            { 'name': f'{name} background filtered', 'metadata': { 'channel' : name } }, 'image')
 
 
 @magic_factory(
     sigma_z={"widget_type": "FloatSlider", "max": 5},
     sigma_yx={"widget_type": "FloatSlider", "max": 5},
+    lean={"label": "Memory-lean (float32)"},
+    z_batch={"label": "Z batch (0: whole stack)", "min": 0, "max": 1024},
     auto_call=False
 )
 def background_filtering_magic_widget(
-    img_layer: "napari.layers.Image", sigma_z: "float" = 0.75, sigma_yx: "float" = 2.3
-) -> "napari.types.LayerDataTuple":
-    return (stack.remove_background_gaussian(img_layer.data, (sigma_z, sigma_yx, sigma_yx)),
-            { 'name': f'{img_layer.name} background filtered', 'metadata': { 'channel' : img_layer.name } }, 'image')
+    img_layer: "napari.layers.Image", sigma_z: "float" = 0.75, sigma_yx: "float" = 2.3,
+    lean: bool = False, z_batch: int = 0,
+) -> Future[napari.types.LayerDataTuple]:
+    return start_worker(('background_filtering', img_layer.name), background_filtering,
+                        full_resolution(img_layer), img_layer.name, sigma_z, sigma_yx, lean, z_batch,
+                        desc=f'Filtering {img_layer.name}', total=1)
 
 
-@magic_factory(
-    threshold={"widget_type": "IntSlider", "min": 0, "max": 200},
-    scale_z={"widget_type": "FloatSlider", "max": 2000},
-    scale_yx={"widget_type": "FloatSlider", "max": 2000},
-    spot_radius_z={"widget_type": "FloatSlider", "max": 2000},
-    spot_radius_yx={"widget_type": "FloatSlider", "max": 2000},
-    auto_call=False
-)
-def spot_detection_magic_widget(
-    viewer: "napari.Viewer",
-    img_layer: "napari.layers.Image",
-    threshold: int=50,
-    scale_z: float=200, scale_yx: float=65,
-    spot_radius_z: float=800, spot_radius_yx: float=120,
-) -> List[napari.types.LayerDataTuple]:
-    # if we return the mask and the LoG filtered image as layers, then we can re-threshold
-    # the spots *after* spot detection
+def spot_detection(rna, metadata, threshold, scale_z, scale_yx, spot_radius_z, spot_radius_yx, cell_masks=None,
+                   tile_size=0, keep_log=False):
+    # the local maxima are returned as a points layer indexed by LoG
+    # intensity, so that we can re-threshold the spots without the LoG image
 
     # spot radius
     spot_radius_px = detection.get_object_radius_pixel(
@@ -79,21 +242,56 @@ def spot_detection_magic_widget(
         object_radius_nm=(spot_radius_z, spot_radius_yx, spot_radius_yx),
         ndim=3)
 
-    # LoG filter
-    rna_log = stack.log_filter(img_layer.data, sigma=spot_radius_px)
-
-    # local maximum detection
-    mask = detection.local_maximum_detection(rna_log, min_distance=spot_radius_px)
-
-    spots, features = threshold_spots(rna_log, mask, threshold)
+    # the LoG filtered image and the local maxima index only depend on the
+    # image and the spot radius (tiling gives the same result)
+    rna = layer_array(rna)
+    cache = get_cache()
+    index_key = cache.key('local_maxima_index', rna, spot_radius_px)
+    log_key = cache.key('log_filter', rna, spot_radius_px)
+    index = cache.get(index_key)
+    rna_log = cache.get(log_key) if keep_log else None
+    if index is not None and (rna_log is not None or not keep_log):
+        yield 'LoG filter and local maxima (cached)'
+    elif nb_processes():
+        # in a worker process, out of the GIL of napari's process
+        yield 'LoG filter and local maxima'
+        index, rna_log = offload(log_local_maxima, rna, spot_radius_px, tile_size, keep_log)
+        cache.put(index_key, index)
+        if keep_log:
+            cache.put(log_key, rna_log)
+    else:
+        if tile_size:
+            # LoG filter and local maximum detection on overlapping YX tiles,
+            # in parallel, with the same result as on the whole volume
+            yield 'LoG filter and local maxima'
+            rna_log, mask = log_filter_local_maxima(rna, spot_radius_px, spot_radius_px, tile_size=tile_size)
+        else:
+            # LoG filter
+            yield 'LoG filter'
+            rna_log = stack.log_filter(rna, sigma=spot_radius_px)
+
+            # local maximum detection
+            yield 'local maxima'
+            mask = detection.local_maximum_detection(rna_log, min_distance=spot_radius_px)
+
+        # re-thresholding is then a binary search in the index
+        yield 'threshold'
+        if index is None:
+            index = ThresholdIndex.from_local_maxima(rna_log, mask)
+            cache.put(index_key, index)
+        del mask
+        if keep_log:
+            cache.put(log_key, rna_log)
+        else:
+            rna_log = None
 
     # if we have DIC masks, we add the cell labels to the spot
     # features for display purposes
-    if 'DIC masks' in viewer.layers:
-        cell_masks = viewer.layers['DIC masks'].data
-        features['label'], features['in_cell'] = get_labels(cell_masks, spots)
+    yield 'labels'
+    cell_masks = layer_array(cell_masks)
+    spots, features = threshold_spots(index, threshold, cell_masks)
 
-    spots_metadata = img_layer.metadata
+    spots_metadata = metadata
     channel = spots_metadata['channel']
     spots_metadata.update({
         'threshold': threshold,
@@ -101,9 +299,23 @@ def spot_detection_magic_widget(
         'spot_radius': (spot_radius_z, spot_radius_yx, spot_radius_yx)
     })
 
-    return [
-        (rna_log, { 'name': f'{channel} LoG filtered', 'metadata': img_layer.metadata }, 'image'),
-        (mask, { 'name': f'{channel} local maxima', 'metadata': img_layer.metadata }, 'labels'),
+    layers = []
+    if keep_log:
+        layers.append((rna_log, { 'name': f'{channel} LoG filtered', 'metadata': metadata }, 'image'))
+    # layers get their own spots: napari edits points in place, and the index
+    # is shared with the cache
+    layers += [
+        (index.spots.copy(), {
+            'name': f'{channel} local maxima',
+            'features': index.table(),
+            'metadata': { **metadata, 'threshold_index': index },
+            'symbol': 'square',
+            'size': 3,
+            'border_width': 0,
+            'face_color': 'yellow',
+            'visible': False,
+            },
+         'points'),
         (spots, {
             'name': f'{channel} spots detected thr={threshold}',
             'features': features,
@@ -112,60 +324,132 @@ def spot_detection_magic_widget(
             'size': 10,
             'border_width': 0.1,
             'border_color': 'in_cell',
-            'border_color_cycle': ['cyan', 'red'] if features.iloc[0]['in_cell'] == True else ['red', 'cyan'],
+            'border_color_cycle': border_color_cycle(features),
             'face_color': 'transparent',
             'opacity': 0.5,
             'out_of_slice_display': True
             },
          'points'),
     ]
+    return layers
+
+
+@magic_factory(
+    threshold={"widget_type": "IntSlider", "min": 0, "max": 200},
+    scale_z={"widget_type": "FloatSlider", "max": 2000},
+    scale_yx={"widget_type": "FloatSlider", "max": 2000},
+    spot_radius_z={"widget_type": "FloatSlider", "max": 2000},
+    spot_radius_yx={"widget_type": "FloatSlider", "max": 2000},
+    tile_size={"label": "Tile size (0: no tiling)", "max": 8192, "step": 128},
+    keep_log={"label": "Keep LoG filtered image"},
+    auto_call=False
+)
+def spot_detection_magic_widget(
+    viewer: "napari.Viewer",
+    img_layer: "napari.layers.Image",
+    threshold: int=50,
+    scale_z: float=200, scale_yx: float=65,
+    spot_radius_z: float=800, spot_radius_yx: float=120,
+    tile_size: int=0,
+    keep_log: bool=False,
+) -> Future[List[napari.types.LayerDataTuple]]:
+    cell_masks = full_resolution(viewer.layers['DIC masks']) if 'DIC masks' in viewer.layers else None
+    return start_worker(('spot_detection', img_layer.name), spot_detection,
+                        full_resolution(img_layer), img_layer.metadata, threshold,
+                        scale_z, scale_yx, spot_radius_z, spot_radius_yx, cell_masks, tile_size, keep_log,
+                        desc=f'Detecting spots in {img_layer.name}', total=3 if tile_size else 4)
 
 
-def threshold_spots(rna_log, mask, threshold):
-    spots, _ = detection.spots_thresholding(rna_log, mask, threshold)
-    log_intensities = np.resize(np.array([rna_log[s[0], s[1], s[2]] for s in spots]), (len(spots), 1))
+def multi_channel_spot_detection(channels, threshold, scale_z, scale_yx, spot_radius_z, spot_radius_yx,
+                                 cell_masks=None, tile_size=0, keep_log=False, max_workers=None):
+    """Run spot_detection on several (image, metadata) channels concurrently."""
+    cell_masks = layer_array(cell_masks)
 
-    spots_with_intensities = np.concatenate((spots, log_intensities), axis=1)
-    features = pd.DataFrame(spots_with_intensities, columns=['z', 'y', 'x', 'intensity_LoG'])
-    features['label'] = -1
-    features['in_cell'] = 1
+    # the filters release the GIL: channels run in parallel threads
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(channels), 1)) as executor:
+        futures = { executor.submit(run_stages, spot_detection, layer_array(rna), metadata, threshold,
+                                    scale_z, scale_yx, spot_radius_z, spot_radius_yx, cell_masks, tile_size, keep_log):
+                    metadata['channel'] for rna, metadata in channels }
+        yield 'detecting spots in ' + ', '.join(futures.values())
+        for future in as_completed(futures):
+            yield f'{futures[future]} done'
 
-    return spots, features
+    return [ layer for future in futures for layer in future.result() ]
 
 
 @magic_factory(
-    threshold={"widget_type": "IntSlider", "min": 0, "max": 2000},
+    threshold={"widget_type": "IntSlider", "min": 0, "max": 200},
+    scale_z={"widget_type": "FloatSlider", "max": 2000},
+    scale_yx={"widget_type": "FloatSlider", "max": 2000},
+    spot_radius_z={"widget_type": "FloatSlider", "max": 2000},
+    spot_radius_yx={"widget_type": "FloatSlider", "max": 2000},
+    tile_size={"label": "Tile size (0: no tiling)", "max": 8192, "step": 128},
+    keep_log={"label": "Keep LoG filtered images"},
     auto_call=False
 )
-def spot_thresholding_magic_widget(
+def multi_channel_spot_detection_magic_widget(
     viewer: "napari.Viewer",
-    img_layer: "napari.layers.Points", threshold: float=50,
-) -> "napari.types.LayerDataTuple":
-    spots_metadata = img_layer.metadata
-    spots_metadata.update({ 'threshold': threshold})
-    channel = spots_metadata['channel']
+    threshold: int=50,
+    scale_z: float=200, scale_yx: float=65,
+    spot_radius_z: float=800, spot_radius_yx: float=120,
+    tile_size: int=0,
+    keep_log: bool=False,
+) -> Future[List[napari.types.LayerDataTuple]]:
+    # every background filtered channel
+    layers = [ layer for layer in viewer.layers
+               if isinstance(layer, napari.layers.Image) and layer.name.endswith('background filtered')
+               and 'channel' in layer.metadata ]
+    cell_masks = full_resolution(viewer.layers['DIC masks']) if 'DIC masks' in viewer.layers else None
+    return start_worker(('multi_channel_spot_detection',), multi_channel_spot_detection,
+                        [ (full_resolution(layer), layer.metadata) for layer in layers ], threshold,
+                        scale_z, scale_yx, spot_radius_z, spot_radius_yx, cell_masks, tile_size, keep_log,
+                        desc=f'Detecting spots in {len(layers)} channels', total=len(layers) + 1)
+
+
+def threshold_spots(index, threshold, cell_masks=None):
+    spots, log_intensities = index.threshold(threshold)
+    return spots, spot_features(spots, log_intensities, cell_masks)
+
+
+def border_color_cycle(features):
+    # the first color goes to the first value of in_cell
+    if len(features) == 0 or features.iloc[0]['in_cell']:
+        return ['cyan', 'red']
+    return ['red', 'cyan']
+
+
+def spot_thresholding(metadata, maxima_metadata, rna_log, maxima, threshold, cell_masks=None,
+                      maxima_features=None, live=False):
+    # a copy: the input layer's metadata must keep describing its spots
+    metadata = dict(metadata, threshold=threshold)
+    channel = metadata['channel']
 
-    rna_log = viewer.layers[f'{channel} LoG filtered'].data
-    mask = viewer.layers[f'{channel} local maxima'].data.astype(bool)
-    spots, features = threshold_spots(rna_log, mask, threshold)
+    # the index built by spot_detection, or rebuilt for a reopened layer
+    index = maxima_metadata.get('threshold_index')
+    if index is None:
+        yield 'index local maxima'
+        if maxima_features is not None:
+            index = ThresholdIndex.from_table(maxima, maxima_features)
+        else:
+            index = ThresholdIndex.from_local_maxima(np.asarray(rna_log), np.asarray(maxima))
+        maxima_metadata['threshold_index'] = index
 
     # if we have DIC masks, we add the cell labels to the spot
     # features for display purposes
-    if 'DIC masks' in viewer.layers:
-        cell_masks = viewer.layers['DIC masks'].data
-        features['label'], features['in_cell'] = get_labels(cell_masks, spots)
+    yield 'threshold'
+    cell_masks = layer_array(cell_masks)
+    spots, features = threshold_spots(index, threshold, cell_masks)
 
     return (spots, {
-        'name': f'{channel} spots thresholded thr={threshold}',
+        # a fixed name while live, so that the slider updates a single layer
+        'name': f'{channel} spots thresholded' if live else f'{channel} spots thresholded thr={threshold}',
         'features': features,
-        'metadata': spots_metadata,
+        'metadata': metadata,
         'symbol': 'disc',
         'size': 10,
         'border_width': 0.1,
         'border_color': 'in_cell',
-        # this breaks if we don't have features, ie when reading img.json
-        # actually we do have features when reading img.json
-        'border_color_cycle': ['cyan', 'red'] if features.iloc[0]['in_cell'] == True else ['red', 'cyan'],
+        'border_color_cycle': border_color_cycle(features),
         'face_color': 'transparent',
         'opacity': 0.5,
         'out_of_slice_display': True
@@ -173,49 +457,168 @@ def spot_thresholding_magic_widget(
             'points')
 
 
-def get_labels(cell_masks, spots):
-    labels = [ cell_masks[y, x] for (y, x) in spots[:, 1:3] ]
-    in_cell = [ 0 if l == 0 else 1 for l in labels ]
-
-    return pd.Series(labels, dtype='int64'), pd.Series(in_cell, dtype='int64')
+@magic_factory(
+    threshold={"widget_type": "IntSlider", "min": 0, "max": 2000},
+    auto_call=True
+)
+def spot_thresholding_magic_widget(
+    viewer: "napari.Viewer",
+    img_layer: "napari.layers.Points", threshold: float=50,
+) -> Future[napari.types.LayerDataTuple]:
+    channel = img_layer.metadata['channel']
+    maxima_layer = viewer.layers[f'{channel} local maxima']
+    cell_masks = full_resolution(viewer.layers['DIC masks']) if 'DIC masks' in viewer.layers else None
+
+    # only the local maxima table is needed to threshold, the volumes of
+    # older local maxima layers are read once to build it
+    rna_log = maxima = maxima_features = None
+    if 'threshold_index' not in maxima_layer.metadata:
+        maxima = maxima_layer.data
+        if isinstance(maxima_layer, napari.layers.Points):
+            maxima_features = maxima_layer.features
+        else:
+            rna_log = full_resolution(viewer.layers[f'{channel} LoG filtered'])
+
+    # a new threshold supersedes the run for the previous one
+    return start_worker(('spot_thresholding', channel), spot_thresholding,
+                        img_layer.metadata, maxima_layer.metadata, rna_log, maxima,
+                        threshold, cell_masks, maxima_features, True,
+                        desc=f'Thresholding {channel} spots', total=2)
+
+
+def spot_threshold_sweep(channels, apply=False, cell_masks=None):
+    """Spot count curves of the local maxima of channels, by channel, and their elbows.
+
+    Curves and elbows are kept in the local maxima metadata; with ``apply``,
+    each channel is also thresholded at its elbow.
+    """
+    indices = {}
+    for channel, (maxima_metadata, maxima, maxima_features) in channels.items():
+        index = maxima_metadata.get('threshold_index')
+        if index is None:
+            yield f'index {channel} local maxima'
+            index = ThresholdIndex.from_table(maxima, maxima_features)
+            maxima_metadata['threshold_index'] = index
+        indices[channel] = index
+
+    # every threshold of every channel at once
+    yield 'sweep'
+    curves, elbows = threshold_sweep(indices)
+    for channel, (maxima_metadata, _, _) in channels.items():
+        maxima_metadata.update({ 'threshold_curve': curves[channel], 'auto_threshold': elbows[channel] })
+
+    layers = []
+    if apply:
+        for channel, (maxima_metadata, maxima, maxima_features) in channels.items():
+            if elbows[channel] is None:
+                continue
+            metadata = { k: v for k, v in maxima_metadata.items()
+                         if k not in ('threshold_index', 'threshold_curve', 'auto_threshold') }
+            layers.append((yield from spot_thresholding(metadata, maxima_metadata, None, maxima, elbows[channel],
+                                                        cell_masks, maxima_features)))
+    return layers
+
+
+def show_threshold_curves(viewer, curves, elbows):
+    """Plot spot count curves in a dock widget, replacing a previous one."""
+    title = 'Threshold sweep'
+    if title in viewer.window.dock_widgets:
+        viewer.window.remove_dock_widget(viewer.window.dock_widgets[title])
+
+    try:
+        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+        from matplotlib.figure import Figure
+    except ImportError:
+        # without matplotlib, the curves as a table
+        from magicgui.widgets import Table
+        viewer.window.add_dock_widget(Table(value=curves.reset_index()), name=title, area='bottom')
+        return
+
+    figure = Figure(figsize=(5, 3), tight_layout=True)
+    axes = figure.add_subplot()
+    for channel in curves:
+        elbow = elbows[channel]
+        label = channel if elbow is None else f'{channel} (auto {elbow:g})'
+        line, = axes.plot(curves.index, curves[channel], label=label)
+        if elbow is not None:
+            axes.axvline(elbow, color=line.get_color(), linestyle='--')
+    axes.set_yscale('log')
+    axes.set_xlabel('threshold')
+    axes.set_ylabel('number of spots')
+    axes.legend()
+    viewer.window.add_dock_widget(FigureCanvasQTAgg(figure), name=title, area='bottom')
 
 
 @magic_factory(
+    apply={"label": "Threshold at the elbows"},
     auto_call=False
 )
-def spot_decomposition_magic_widget(
+def threshold_sweep_magic_widget(
     viewer: "napari.Viewer",
-    point_layer: "napari.layers.Points",
-) -> List[napari.types.LayerDataTuple]:
-    spots = point_layer.data
-    metadata = point_layer.metadata
+    apply: bool=False,
+) -> Future[List[napari.types.LayerDataTuple]]:
+    # the local maxima of every channel
+    channels = { layer.metadata['channel']: (layer.metadata, layer.data, layer.features)
+                 for layer in viewer.layers
+                 if isinstance(layer, napari.layers.Points) and layer.name.endswith('local maxima')
+                 and 'channel' in layer.metadata }
+    cell_masks = full_resolution(viewer.layers['DIC masks']) if 'DIC masks' in viewer.layers else None
+
+    future = start_worker('threshold_sweep', spot_threshold_sweep, channels, apply, cell_masks,
+                          desc='Threshold sweep', total=len(channels) + 1 + (2 * len(channels) if apply else 0))
+
+    def show(future):
+        # a superseded run leaves no curves
+        swept = channels and all('threshold_curve' in m for m, _, _ in channels.values())
+        if future.exception() is None and swept and hasattr(viewer, 'window'):
+            curves = pd.DataFrame({ c: m['threshold_curve'] for c, (m, _, _) in channels.items() })
+            show_threshold_curves(viewer, curves, { c: m['auto_threshold'] for c, (m, _, _) in channels.items() })
+
+    future.add_done_callback(show)
+    return future
+
+
+def get_labels(cell_masks, spots):
+    labels, in_cell = cell_labels(cell_masks, spots)
+
+    return pd.Series(labels, dtype='int64'), pd.Series(in_cell, dtype='int64')
+
+
+def spot_decomposition(rna, spots, metadata, cell_masks=None, max_workers=None):
     channel = metadata['channel']
 
-    rna = viewer.layers[f'{channel}'].data
-
-    decomp_spots, dense_regions, reference_spot = detection.decompose_dense(
-        rna,
-        spots,
-        voxel_size=metadata['scale'],
-        spot_radius=metadata['spot_radius'],
-        alpha=0.5,  # alpha impacts the number of spots per candidate region
-        beta=2,  # beta impacts the number of candidate regions to decompose
-        gamma=1  # gamma the filtering step to denoise the image
-    )
-
-    features = pd.DataFrame(decomp_spots, columns=['z', 'y', 'x'])
-    features['label'] = -1
-    features['in_cell'] = 1
+    def decompose(rna, spots, voxel_size, spot_radius):
+        # dense regions are simulated in max_workers processes; offloaded,
+        # the whole decomposition runs serially in one worker
+        offloaded = nb_processes() > 0
+        run = partial(offload, decompose_dense) if offloaded else decompose_dense
+        return run(
+            rna,
+            spots,
+            voxel_size=voxel_size,
+            spot_radius=spot_radius,
+            alpha=0.5,  # alpha impacts the number of spots per candidate region
+            beta=2,  # beta impacts the number of candidate regions to decompose
+            gamma=1,  # gamma the filtering step to denoise the image
+            max_workers=1 if offloaded else max_workers
+        )
+
+    yield 'decompose dense regions'
+    decomp_spots, dense_regions, reference_spot = get_cache().cached(
+        'decompose_dense', decompose,
+        layer_array(rna), np.asarray(spots), tuple(metadata['scale']), tuple(metadata['spot_radius']))
+
     # if we have DIC masks, we add the cell labels to the spot
     # features for display purposes
-    if 'DIC masks' in viewer.layers:
-        cell_masks = viewer.layers['DIC masks'].data
-        features['label'], features['in_cell'] = get_labels(cell_masks, decomp_spots)
+    yield 'labels'
+    cell_masks = layer_array(cell_masks)
+    features = spot_features(decomp_spots, cell_masks=cell_masks)
 
     metadata.update({ 'decomposed': 1 })
 
+    # the cached arrays are not given to napari, which edits points in place
     return [
-        (dense_regions[:, 1:3], {
+        (np.array(dense_regions[:, 1:3]), {
             'name': f'{channel} dense regions thr={metadata["threshold"]}',
             'symbol': 'disc',
             'size': 10,
@@ -224,7 +627,7 @@ def spot_decomposition_magic_widget(
             'opacity': 0.5
         },
          'points'),
-        (decomp_spots, {
+        (np.array(decomp_spots), {
             'name': f'{channel} spots decomposed thr={metadata["threshold"]}',
             'features': features,
             'metadata': metadata,
@@ -232,9 +635,338 @@ def spot_decomposition_magic_widget(
             'size': 10,
             'border_width': 0.1,
             'border_color': 'in_cell',
-            'border_color_cycle': ['cyan', 'red'] if features.iloc[0]['in_cell'] == True else ['red', 'cyan'],
+            'border_color_cycle': border_color_cycle(features),
             'face_color': 'transparent',
             'opacity': 0.5
         },
          'points')
-    ]
\ No newline at end of file
+    ]
+
+
+@magic_factory(
+    workers={"label": "Workers (0: all CPUs)", "min": 0, "max": 256},
+    auto_call=False
+)
+def spot_decomposition_magic_widget(
+    viewer: "napari.Viewer",
+    point_layer: "napari.layers.Points",
+    workers: int=0,
+) -> Future[List[napari.types.LayerDataTuple]]:
+    channel = point_layer.metadata['channel']
+    cell_masks = full_resolution(viewer.layers['DIC masks']) if 'DIC masks' in viewer.layers else None
+    return start_worker(('spot_decomposition', channel), spot_decomposition,
+                        full_resolution(viewer.layers[f'{channel}']), point_layer.data, point_layer.metadata, cell_masks,
+                        workers or None,
+                        desc=f'Decomposing {channel} spots', total=2)
+
+
+def spot_statistics(cell_masks, name, spot_layers, output=None):
+    """Per-cell statistics of (name, spots, intensities, image) spots layers."""
+    yield 'spot intensities'
+    spots_by_layer = {}
+    for layer_name, spots, intensities, image in spot_layers:
+        if intensities is None and image is not None:
+            intensities = sample_at(layer_array(image), spots)
+        spots_by_layer[layer_name] = (np.asarray(spots), intensities)
+
+    yield 'statistics'
+    cell_masks = layer_array(cell_masks)
+    statistics = cell_statistics(cell_masks, spots_by_layer)
+
+    if output:
+        yield 'export'
+        statistics.to_csv(output, index=False)
+
+    return [
+        # napari looks up the features of a label in the 'index' column
+        (cell_masks, {
+            'name': f'{name} statistics',
+            'features': statistics.rename(columns={ 'label': 'index' }),
+            'metadata': { 'statistics': statistics },
+            'visible': False,
+            'blending': 'additive',
+            'opacity': 0.2
+        },
+         'labels')
+    ]
+
+
+def show_statistics(viewer, name, statistics):
+    """Show a statistics table in a dock widget, replacing a previous one."""
+    from magicgui.widgets import Table
+
+    title = f'{name} statistics'
+    if title in viewer.window.dock_widgets:
+        viewer.window.remove_dock_widget(viewer.window.dock_widgets[title])
+    viewer.window.add_dock_widget(Table(value=statistics), name=title, area='bottom')
+
+
+@magic_factory(
+    output={"label": "Export CSV (optional)", "mode": "w", "filter": "*.csv"},
+    auto_call=False
+)
+def spot_statistics_magic_widget(
+    viewer: "napari.Viewer",
+    masks_layer: "napari.layers.Labels",
+    output: Path=Path(),
+) -> Future[List[napari.types.LayerDataTuple]]:
+    # every spots layer: detected, thresholded or decomposed, of every channel
+    spot_layers = []
+    for layer in viewer.layers:
+        if not isinstance(layer, napari.layers.Points) or 'channel' not in layer.metadata \
+                or layer.name.endswith('local maxima'):
+            continue
+        channel = layer.metadata['channel']
+        intensities = layer.features['intensity'].to_numpy() if 'intensity' in layer.features else None
+        image = full_resolution(viewer.layers[channel]) if channel in viewer.layers else None
+        spot_layers.append((layer.name, layer.data, intensities, image))
+
+    output = output if output.suffix == '.csv' else None
+    future = start_worker(('spot_statistics', masks_layer.name), spot_statistics,
+                          full_resolution(masks_layer), masks_layer.name, spot_layers, output,
+                          desc=f'Statistics of {masks_layer.name}', total=3 if output else 2)
+
+    def show(future):
+        if future.exception() is None and future.result() and hasattr(viewer, 'window'):
+            show_statistics(viewer, masks_layer.name, future.result()[0][1]['metadata']['statistics'])
+
+    future.add_done_callback(show)
+    return future
+
+
+def roi_spot_detection(rna, metadata, box, halo, sigma_z, sigma_yx, threshold, scale_z, scale_yx,
+                       spot_radius_z, spot_radius_yx, cell_masks=None, detected=None, decompose=False,
+                       decomposed=None, maxima=None):
+    """Background filtering, spot detection and decomposition in a ROI.
+
+    The image is processed in the (y0, y1, x0, x1) box grown by a halo, and
+    what is found in the box replaces it in the existing local maxima and
+    spots layers, given as (name, data, features[, metadata]) tuples.
+    """
+    channel = metadata['channel']
+    # only the ROI of lazy data is read
+    halo_box = with_halo(box, halo, rna.shape)
+    rna_roi = np.ascontiguousarray(crop(rna, halo_box))
+    masks_roi = None if cell_masks is None else np.ascontiguousarray(crop(cell_masks, halo_box))
+
+    yield 'background filtering'
+    filtered, _, _ = run_stages(background_filtering, rna_roi, channel, sigma_z, sigma_yx)
+
+    yield 'spot detection'
+    layers = run_stages(spot_detection, filtered, dict(metadata), threshold, scale_z, scale_yx,
+                        spot_radius_z, spot_radius_yx, masks_roi)
+    # the whole image's local maxima, so that re-thresholding keeps the
+    # ROI's; a previous threshold sweep no longer describes them
+    _, maxima_kwargs, _ = layers[-2]
+    roi_index = maxima_kwargs['metadata']['threshold_index']
+    index = None
+    if maxima is not None:
+        name, maxima_data, maxima_features, maxima_metadata = maxima
+        index = maxima_metadata.get('threshold_index')
+        if index is None and 'threshold_value' in maxima_features:
+            index = ThresholdIndex.from_table(maxima_data, maxima_features)
+        maxima_kwargs = { **maxima_kwargs, 'name': name,
+                          'metadata': { k: v for k, v in maxima_metadata.items()
+                                        if k not in ('threshold_curve', 'auto_threshold') } }
+    index = merge_index(index, roi_index, box, halo_box)
+    maxima_kwargs['metadata'] = { **maxima_kwargs['metadata'], 'threshold_index': index }
+    result = [(index.spots.copy(), { **maxima_kwargs, 'features': index.table() }, 'points')]
+
+    roi_spots, add_kwargs, _ = layers[-1]
+    name, *existing = detected or (add_kwargs['name'], None, None)
+    spots, features = merge_spots(*existing, *shift_spots(roi_spots, add_kwargs['features'], halo_box), box)
+    metadata = { **add_kwargs['metadata'], 'roi': box }
+    result.append((spots, { **add_kwargs, 'name': name, 'features': features, 'metadata': metadata,
+                            'border_color_cycle': border_color_cycle(features) }, 'points'))
+
+    if decompose:
+        yield 'spot decomposition'
+        roi_decomposed, add_kwargs, _ = run_stages(spot_decomposition, rna_roi, roi_spots, dict(metadata),
+                                                   masks_roi, 1)[-1]
+        name, *existing = decomposed or (add_kwargs['name'], None, None)
+        spots, features = merge_spots(*existing, *shift_spots(roi_decomposed, add_kwargs['features'], halo_box), box)
+        result.append((spots, { **add_kwargs, 'name': name, 'features': features,
+                                'metadata': { **add_kwargs['metadata'], 'roi': box },
+                                'border_color_cycle': border_color_cycle(features) }, 'points'))
+
+    return result
+
+
+def _channel_points(viewer, channel, kind):
+    # the most recent points layer of a channel whose name starts with
+    # '<channel> <kind>', whatever its threshold, or None
+    layers = [ layer for layer in viewer.layers
+               if isinstance(layer, napari.layers.Points) and layer.name.startswith(f'{channel} {kind}')
+               and layer.metadata.get('channel', channel) == channel ]
+    return layers[-1] if layers else None
+
+
+def _layer_threshold(layer):
+    # threshold of a spots layer, from its metadata or its name, or None
+    if 'threshold' in layer.metadata:
+        return layer.metadata['threshold']
+    match = re.search(r'thr=(\d+)', layer.name)
+    return int(match.group(1)) if match else None
+
+
+def _layer_spots(layer):
+    # name, spots and features of an existing points layer, or None
+    if layer is None:
+        return None
+    return layer.name, np.asarray(layer.data), layer.features
+
+
+@magic_factory(
+    roi_layer={"label": "ROI shapes"},
+    cells={"label": "or cell labels (e.g. 3, 12)"},
+    halo={"label": "Halo (px)", "min": 0, "max": 512},
+    threshold={"widget_type": "IntSlider", "min": 0, "max": 200},
+    sigma_z={"widget_type": "FloatSlider", "max": 5},
+    sigma_yx={"widget_type": "FloatSlider", "max": 5},
+    scale_z={"widget_type": "FloatSlider", "max": 2000},
+    scale_yx={"widget_type": "FloatSlider", "max": 2000},
+    spot_radius_z={"widget_type": "FloatSlider", "max": 2000},
+    spot_radius_yx={"widget_type": "FloatSlider", "max": 2000},
+    auto_call=False
+)
+def roi_spot_detection_magic_widget(
+    viewer: "napari.Viewer",
+    img_layer: "napari.layers.Image",
+    roi_layer: Optional[napari.layers.Shapes] = None,
+    cells: str='',
+    halo: int=32,
+    threshold: int=50,
+    sigma_z: float=0.75, sigma_yx: float=2.3,
+    scale_z: float=200, scale_yx: float=65,
+    spot_radius_z: float=800, spot_radius_yx: float=120,
+    decompose: bool=False,
+) -> Future[List[napari.types.LayerDataTuple]]:
+    rna = full_resolution(img_layer)
+    channel = img_layer.metadata.get('channel', img_layer.name)
+    cell_masks = full_resolution(viewer.layers['DIC masks']) if 'DIC masks' in viewer.layers else None
+
+    # the ROI: selected cells of the DIC masks, or the shapes of a Shapes layer
+    labels = [ int(label) for label in cells.replace(',', ' ').split() ]
+    if labels:
+        if cell_masks is None:
+            raise ValueError('Selecting cells needs a "DIC masks" layer.')
+        box = labels_box(cell_masks, labels)
+    else:
+        box = shapes_box(roi_layer.data if roi_layer is not None else [], rna.shape)
+    if box is None:
+        raise ValueError('Draw a ROI in a Shapes layer, or give cell labels.')
+
+    # the ROI's results replace those of the channel's layers in the box
+    name = f'{channel} local maxima'
+    if name in viewer.layers and not isinstance(viewer.layers[name], napari.layers.Points):
+        raise ValueError(f'"{name}" is not a points layer: run the spot detection again first.')
+    maxima = _channel_points(viewer, channel, 'local maxima')
+    if maxima is not None:
+        maxima = (maxima.name, maxima.data, maxima.features, maxima.metadata)
+    detected = _channel_points(viewer, channel, 'spots detected')
+    decomposed = _channel_points(viewer, channel, 'spots decomposed')
+    for layer in (detected, decomposed):
+        if layer is not None and _layer_threshold(layer) not in (None, threshold):
+            raise ValueError(f'"{layer.name}" was thresholded at {_layer_threshold(layer)}, not {threshold}.')
+
+    metadata = { **img_layer.metadata, 'channel': channel }
+    return start_worker(('roi_spot_detection', channel), roi_spot_detection,
+                        rna, metadata, box, halo, sigma_z, sigma_yx, threshold,
+                        scale_z, scale_yx, spot_radius_z, spot_radius_yx, cell_masks,
+                        _layer_spots(detected), decompose, _layer_spots(decomposed), maxima,
+                        desc=f'Detecting spots in a {channel} ROI', total=3 if decompose else 2)
+
+
+def _uniform(values):
+    # the value shared by every point, or None
+    values = np.asarray(values)
+    if len(values) and np.all(values == values[0]):
+        return values[0]
+    return None
+
+
+def add_slab_layer(viewer, point_layer, half_width):
+    """Show the spots of a points layer within half_width planes of the current slice."""
+    spots = np.asarray(point_layer.data)
+    features = point_layer.features
+    index = SliceIndex(spots)
+
+    kwargs = { 'symbol': _uniform(point_layer.symbol), 'size': _uniform(point_layer.size),
+               'border_width': _uniform(point_layer.border_width), 'face_color': _uniform(point_layer.face_color),
+               'opacity': point_layer.opacity, 'out_of_slice_display': point_layer.out_of_slice_display,
+               'scale': point_layer.scale, 'translate': point_layer.translate, 'metadata': point_layer.metadata }
+    if 'in_cell' in features:
+        kwargs.update({ 'border_color': 'in_cell', 'border_color_cycle': border_color_cycle(features) })
+    else:
+        kwargs['border_color'] = _uniform(point_layer.border_color)
+    kwargs = { k: v for k, v in kwargs.items() if v is not None }
+
+    slab = viewer.add_points(spots[:0], features=features.iloc[:0], name=f'{point_layer.name} slab', **kwargs)
+    point_layer.visible = False
+
+    def update(event=None):
+        if slab not in viewer.layers:
+            viewer.dims.events.current_step.disconnect(update)
+            return
+        z = point_layer.world_to_data(viewer.dims.point)[0]
+        selected = index.select(z - half_width, z + half_width)
+        slab.data = spots[selected]
+        slab.features = features.iloc[selected].reset_index(drop=True)
+
+    viewer.dims.events.current_step.connect(update)
+    update()
+    return slab
+
+
+def add_density_layer(viewer, point_layer, bin_size):
+    """Show the spot density of a points layer, in bins of bin_size pixels."""
+    channel = point_layer.metadata.get('channel')
+    if channel in viewer.layers:
+        shape = full_resolution(viewer.layers[channel]).shape[-2:]
+    else:
+        shape = tuple(np.asarray(point_layer.data)[:, -2:].max(axis=0).astype(int) + 1)
+    density = spot_density(point_layer.data, shape, bin_size)
+    # bins are centered on the spots they count
+    scale = np.asarray(point_layer.scale[-2:]) * bin_size
+    translate = np.asarray(point_layer.translate[-2:]) + (bin_size - 1) / 2 * np.asarray(point_layer.scale[-2:])
+    return viewer.add_image(density, name=f'{point_layer.name} density', colormap='inferno',
+                            scale=scale, translate=translate, blending='additive')
+
+
+def add_mask_layer(viewer, point_layer):
+    """Render the local maxima of a points layer as a labels mask, for display only."""
+    index = point_layer.metadata.get('threshold_index')
+    if index is None:
+        if 'threshold_value' not in point_layer.features:
+            raise ValueError(f'{point_layer.name} is not a local maxima layer.')
+        index = ThresholdIndex.from_table(point_layer.data, point_layer.features)
+    channel = point_layer.metadata.get('channel')
+    if channel in viewer.layers:
+        shape = full_resolution(viewer.layers[channel]).shape
+    else:
+        shape = tuple(index.spots.max(axis=0) + 1) if len(index) else (1,) * index.spots.shape[1]
+    return viewer.add_labels(index.render(shape), name=f'{point_layer.name} mask',
+                             scale=point_layer.scale, translate=point_layer.translate, blending='additive')
+
+
+@magic_factory(
+    mode={"choices": ['slab', 'density', 'mask']},
+    half_width={"label": "Slab half width (planes)", "min": 0, "max": 100},
+    bin_size={"label": "Density bin size (px)", "min": 1, "max": 256},
+    auto_call=False
+)
+def spot_display_magic_widget(
+    viewer: "napari.Viewer",
+    point_layer: "napari.layers.Points",
+    mode: str='slab',
+    half_width: int=2,
+    bin_size: int=16,
+) -> None:
+    # large spot layers: the spots of the current z-slab only, or a density
+    # heatmap for zoomed-out views; local maxima can also be shown as a mask
+    if mode == 'slab':
+        add_slab_layer(viewer, point_layer, half_width)
+    elif mode == 'density':
+        add_density_layer(viewer, point_layer, bin_size)
+    else:
+        add_mask_layer(viewer, point_layer)
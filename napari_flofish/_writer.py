@@ -1,67 +1,201 @@
 """
-This module is an example of a barebones writer plugin for napari.
+Writer plugin: save layers to a Zarr store that the reader opens lazily.
 
-It implements the Writer specification.
-see: https://napari.org/stable/plugins/guides.html?#writers
+Layout of a ``.zarr`` store written by ``write_multiple``::
+
+    analysis.zarr/
+        zarr.json               attrs: {"napari_flofish": 1, "layers": [...]}
+        0/                      one group per layer, in layer order
+            zarr.json           attrs: name, layer_type, add_kwargs
+            data                chunked, compressed layer data
+            features/<column>   points features, one array per column
+            kwargs/<key>        per-point layer attributes (colors, sizes...)
+
+Images and labels are chunked by z-plane and YX tiles, so napari reads back
+only the planes it displays. Chunks are compressed with Blosc/zstd by zarr's
+codec pipeline, concurrently, and layers are written in parallel.
 
-Replace code below according to your needs.
+see: https://napari.org/stable/plugins/guides.html?#writers
 """
 from __future__ import annotations
 
+import json
 from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
 from typing import TYPE_CHECKING, Any, Union
 
+import numpy as np
+import pandas as pd
+
 if TYPE_CHECKING:
     DataType = Union[Any, Sequence[Any]]
     FullLayerData = tuple[DataType, dict, str]
 
+FORMAT_VERSION = 1
+
+# layer attributes written to the store; the rest of a layer's state is
+# either derived (properties, colormaps...) or napari-version specific
+LAYER_KWARGS = {
+    'image': ['name', 'metadata', 'scale', 'translate', 'opacity', 'blending', 'visible',
+              'colormap', 'contrast_limits', 'gamma'],
+    'labels': ['name', 'metadata', 'scale', 'translate', 'opacity', 'blending', 'visible'],
+    'points': ['name', 'metadata', 'scale', 'translate', 'opacity', 'blending', 'visible',
+               'symbol', 'size', 'border_width', 'border_color', 'border_color_cycle', 'face_color',
+               'out_of_slice_display'],
+}
+
+IMAGE_CHUNK = 1024
+ROW_CHUNK = 2**16
+
+
+def _compressors():
+    from zarr.codecs import BloscCodec
+    return [BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle')]
+
+
+def _chunks(shape, layer_type):
+    if layer_type in ('image', 'labels'):
+        # one z-plane (or time point) per chunk, tiled in YX
+        return tuple([1] * (len(shape) - 2) + [min(max(n, 1), IMAGE_CHUNK) for n in shape[-2:]])
+    return (min(max(shape[0], 1), ROW_CHUNK),) + tuple(shape[1:])
+
+
+def _jsonable(value):
+    """Convert a value to JSON types, or return None if it cannot be."""
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        items = { str(k): _jsonable(v) for k, v in value.items() }
+        return { k: v for k, v in items.items() if v is not None }
+    if isinstance(value, (list, tuple)):
+        items = [ _jsonable(v) for v in value ]
+        return None if any(v is None for v in items) else items
+    try:
+        json.dumps(value)
+    except TypeError:
+        return None
+    return value
+
+
+def _write_array(group, name, data, layer_type):
+    data = data if hasattr(data, 'dtype') else np.asarray(data)
+    if data.dtype == object:
+        data = np.asarray(data).astype(str)
+    array = group.create_array(name, shape=data.shape, dtype=data.dtype,
+                               chunks=_chunks(data.shape, layer_type), compressors=_compressors())
+    if hasattr(data, 'dask'):
+        # stream lazy layers chunk by chunk
+        import dask.array as da
+        da.store(data, array, lock=False)
+    else:
+        array[...] = np.asarray(data)
+    return array
+
+
+def _split_kwargs(meta, layer_type, nb_rows):
+    """Split layer attributes into JSON attributes and per-row arrays."""
+    attrs, arrays = {}, {}
+    for key in LAYER_KWARGS.get(layer_type, ['name', 'metadata']):
+        if key not in meta:
+            continue
+        value = meta[key]
+        if key == 'colormap' and isinstance(value, dict):
+            value = value.get('name')
+        elif key == 'colormap' and hasattr(value, 'name'):
+            value = value.name
+
+        if isinstance(value, np.ndarray) and value.ndim > 0 and len(value) == nb_rows and nb_rows > 0:
+            if np.all(value == value[0]):
+                # one value for all points
+                value = value[0]
+            else:
+                arrays[key] = np.asarray([ v.value if isinstance(v, Enum) else v for v in value ]) \
+                    if value.dtype == object else value
+                continue
+
+        value = _jsonable(value)
+        if value is not None:
+            attrs[key] = value
+
+    return attrs, arrays
+
+
+def _write_layer(root, i, layer_data):
+    data, meta, layer_type = layer_data
+    if meta.get('multiscale'):
+        # lower resolution levels are rebuilt by the reader if needed
+        data = data[0]
+    group = root.create_group(str(i))
+
+    nb_rows = len(data) if layer_type == 'points' else 0
+    add_kwargs, arrays = _split_kwargs(meta, layer_type, nb_rows)
+    group.attrs.update({ 'name': meta.get('name'), 'layer_type': layer_type, 'add_kwargs': add_kwargs })
+
+    _write_array(group, 'data', data, layer_type)
+
+    for key, value in arrays.items():
+        _write_array(group.require_group('kwargs'), key, value, 'table')
+
+    features = meta.get('features')
+    if isinstance(features, pd.DataFrame) and len(features.columns):
+        columns = group.create_group('features')
+        columns.attrs['columns'] = [ str(c) for c in features.columns ]
+        for column in features.columns:
+            _write_array(columns, str(column), features[column].to_numpy(), 'table')
+
+    return group.path
 
-def write_single_image(path: str, data: Any, meta: dict) -> list[str]:
-    """Writes a single image layer.
+
+def write_multiple(path: str, data: list[FullLayerData]) -> list[str]:
+    """Writes multiple layers of different types to a Zarr store.
 
     Parameters
     ----------
     path : str
-        A string path indicating where to save the image file.
-    data : The layer data
-        The `.data` attribute from the napari layer.
-    meta : dict
-        A dictionary containing all other attributes from the napari layer
-        (excluding the `.data` layer attribute).
+        Path of the ``.zarr`` directory. It is overwritten if it exists.
+    data : A list of layer tuples.
+        Tuples contain three elements: (data, meta, layer_type)
+        `data` is the layer data
+        `meta` is a dictionary containing all other metadata attributes
+        from the napari layer (excluding the `.data` layer attribute).
+        `layer_type` is a string, eg: "image", "labels", "points".
 
     Returns
     -------
-    [path] : A list containing the string path to the saved file.
+    [path] : A list containing the string path to the saved store.
     """
+    import zarr
 
-    # implement your writer logic here ...
+    root = zarr.open_group(str(path), mode='w')
+    root.attrs.update({ 'napari_flofish': FORMAT_VERSION, 'layers': [ meta.get('name') for _, meta, _ in data ] })
 
-    # return path to any file(s) that were successfully written
-    return [path]
+    # layers are independent: compress them concurrently
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(lambda item: _write_layer(root, *item), enumerate(data)))
 
+    return [str(path)]
 
-def write_multiple(path: str, data: list[FullLayerData]) -> list[str]:
-    """Writes multiple layers of different types.
+
+def write_single_image(path: str, data: Any, meta: dict) -> list[str]:
+    """Writes a single image layer to a Zarr store.
 
     Parameters
     ----------
     path : str
-        A string path indicating where to save the data file(s).
-    data : A list of layer tuples.
-        Tuples contain three elements: (data, meta, layer_type)
-        `data` is the layer data
-        `meta` is a dictionary containing all other metadata attributes
-        from the napari layer (excluding the `.data` layer attribute).
-        `layer_type` is a string, eg: "image", "labels", "surface", etc.
+        Path of the ``.zarr`` directory.
+    data : The layer data
+        The `.data` attribute from the napari layer.
+    meta : dict
+        A dictionary containing all other attributes from the napari layer
+        (excluding the `.data` layer attribute).
 
     Returns
     -------
-    [path] : A list containing (potentially multiple) string paths to the saved file(s).
+    [path] : A list containing the string path to the saved store.
     """
-
-    # implement your writer logic here ...
-
-    # return path to any file(s) that were successfully written
-    for l in data:
-        print(l)
-    return [path]
+    return write_multiple(path, [(data, meta, 'image')])